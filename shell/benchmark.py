@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the functions of the fact and maintenance scripts in this directory against stub
+executables and fixture files, so a change can be compared with the previous run.
+
+Every case runs in its own python process with the stubs first on PATH. The stubs log each
+call, sleep for --latency seconds and print fixture output sized by --output-lines. Each case
+reports wall time, how many processes it spawned, how many stub commands it or those processes
+ran, peak RSS, the import time of its module and the startup time of a fresh interpreter
+importing it. Results are written as JSON; --compare flags cases that got slower or spawn more
+than in an earlier results file.
+"""
+import argparse
+import glob
+import importlib
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from procfs import write_fake_process
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STUB = '''#!/bin/sh
+printf '%s\\n' "{name} $*" >> "$BENCH_CALLS"
+sleep {latency}
+{body}
+'''
+
+# what each stubbed command prints, {fixtures} is the fixture directory
+STUB_BODIES = {
+    'dspmq': 'cat "{fixtures}/dspmq.out"',
+    'dspmqinst': 'if [ "$1" = "-n" ]; then awk -v name="$2" \'/^InstName:/ {{show = ($2 == name)}} show\' "{fixtures}/dspmqinst.out"; '
+                 'else cat "{fixtures}/dspmqinst.out"; fi',
+    'dspmqver': 'cat "{fixtures}/dspmqver.out"',
+    # lreg -p KEY prints every property of the key, lreg -getp KEY PROPERTY one value
+    'lreg': 'case "$1" in -p) printf "%s = value-of-%s\\n" CoreFSINode CoreFSINode HAInterfaceHomeNode HAInterfaceHomeNode '
+            'HASingleInstList HASingleInstList;; *) printf "%s\\n" "value-of-$3";; esac',
+    # rpm -qa PATTERN --queryformat ... prints the tab separated rows whose name contains PATTERN without its '*'
+    'rpm': 'case "$*" in *--queryformat*) awk -F "\\t" -v pattern="$2" \'BEGIN {{gsub(/\\*/, "", pattern)}} index($1, pattern)\' "{fixtures}/rpm.qf";; '
+           '"-q "*) shift; printf "%s\\n" "$@";; *) cat "{fixtures}/rpm.out";; esac',
+    'rpmdb_verify': 'true',
+    'pgrep': 'echo 4242',
+    'hostname': 'echo node01.example.com',
+}
+
+
+def write_fixtures(fixtures, output_lines, installations, cib_sizes, tree_files, rpmdb_mb, proc_processes, proc_fds):
+    with open(os.path.join(fixtures, 'dspmq.out'), 'w') as f:
+        for i in range(output_lines):
+            f.write(f'QMNAME(CERN.NODE{i % 16:02d}.ENV{i % 40:03d}){" " * 30}STATUS(Running)\n')
+    with open(os.path.join(fixtures, 'dspmqinst.out'), 'w') as f:
+        for i in range(installations):
+            primary = 'Yes' if i == installations - 1 else 'No'
+            f.write(f'InstName:       Installation{i + 1}\nInstDesc:       \nIdentifier:     {i + 1}\n'
+                    f'InstPath:       /opt/mqm{i if i else ""}\nVersion:        9.{i % 4}.0.0\nPrimary:        {primary}\n'
+                    f'State:          Available\nMSIProdCode:    \n\n')
+    with open(os.path.join(fixtures, 'dspmqver.out'), 'w') as f:
+        f.write(f'9.{(installations - 1) % 4}.0.0\n')
+    with open(os.path.join(fixtures, 'rpm.out'), 'w') as out, open(os.path.join(fixtures, 'rpm.qf'), 'w') as qf:
+        for i in range(output_lines):
+            name = f'MQSeriesRuntime_{i}' if i % 50 == 0 else f'package{i}'
+            out.write(f'{name}-9.3.0-{i}.x86_64\n')
+            qf.write(f'{name}\t9.3.0\t{i}\tx86_64\t{1700000000 + i}\n')
+    # an installation tree per dspmqinst entry, /opt/mqm is the primary
+    for i in range(installations):
+        for j in range(tree_files):
+            directory = os.path.join(fixtures, 'opt', f'mqm{i if i else ""}', 'lib', f'd{j // 100}')
+            if j % 100 == 0:
+                os.makedirs(directory)
+            with open(os.path.join(directory, f'f{j}'), 'wb') as f:
+                f.write(b'\0' * (j % 8192))
+    # an RPM database: one large Packages file, a few indexes and a Berkeley DB environment file
+    os.makedirs(os.path.join(fixtures, 'rpm'))
+    for name, size in [('Packages', rpmdb_mb << 20), ('Name', 1 << 20), ('Providename', 2 << 20), ('__db.001', 1 << 16)]:
+        with open(os.path.join(fixtures, 'rpm', name), 'wb') as f:
+            for offset in range(0, size, 1 << 16):
+                # half random, half zero pages, so the files compress about as well as a real rpmdb
+                f.write(os.urandom(min(1 << 16, size - offset)) if offset & (1 << 16) else bytes(min(1 << 16, size - offset)))
+    # a /proc tree of JVM-like processes with many open files, none of them under /var/lib/rpm
+    for i in range(proc_processes):
+        write_fake_process(os.path.join(fixtures, 'proc'), 1000 + i, 'java', ['/usr/bin/java', f'-Dname=app{i}'], exe='/usr/bin/java',
+                           fds=[f'/opt/app{i}/lib/jar{j}.jar' if j % 3 else 'socket:[%d]' % (i * proc_fds + j) for j in range(proc_fds)])
+    for nodes in cib_sizes:
+        write_cib(os.path.join(fixtures, f'cib-{nodes}.xml'), nodes)
+
+
+def write_cib(path, nodes):
+    with open(path, 'w') as f:
+        f.write('<cib epoch="1"><configuration><crm_config><cluster_property_set id="cib-bootstrap-options">'
+                '<nvpair id="cib-bootstrap-options-cluster-name" name="cluster-name" value="p1_cluster"/>'
+                '</cluster_property_set></crm_config><nodes>\n')
+        for i in range(nodes):
+            f.write(f'<node id="{i}" uname="node{i:05d}"><instance_attributes id="nodes-{i}">'
+                    f'<nvpair id="nodes-{i}-standby" name="standby" value="off"/></instance_attributes></node>\n')
+        f.write('</nodes><resources><primitive id="PROD1_vip" class="ocf" provider="heartbeat" type="IPaddr2"/>'
+                '</resources></configuration><status/></cib>\n')
+
+
+def write_stubs(bin_dir, fixtures, latency):
+    for name, body in STUB_BODIES.items():
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(STUB.format(name=name, latency=latency, body=body.format(fixtures=fixtures)))
+        os.chmod(path, 0o755)
+
+
+def build_cases(fixtures, cib_sizes):
+    """Map case name -> (module, function that takes the imported module and returns the call to time)."""
+    cases = {
+        'cluster_info.get_mq_cluster': ('cluster_info', lambda m: lambda: m.get_mq_cluster('env007')),
+        'cluster_info.get_lreg_properties': ('cluster_info', lambda m: lambda: m.get_lreg_properties('prod1', m.LREG_PROPERTIES, refresh=True)),
+        'cluster_info.get_fqdn': ('cluster_info', lambda m: m.get_fqdn),
+        'mq_clean_old.get_installations': ('mq_clean_old', lambda m: lambda: m.get_installations(refresh=True)),
+        'mq_clean_old.MQInstallation.get_install_path': ('mq_clean_old', lambda m: m.MQInstallation('Installation1').get_install_path),
+        'mq_clean_old.MQInstallation.get_dspmqver_version': ('mq_clean_old', lambda m: m.MQInstallation('Installation1').get_dspmqver_version),
+        'mq_clean_old.primary_lookups': ('mq_clean_old', lambda m: lambda: primary_lookups(m)),
+        'mq_clean_old.delete_mq_directories[dry_run]': ('mq_clean_old', lambda m: lambda: m.delete_mq_directories(
+            os.path.join(fixtures, 'opt', 'mqm'), dry_run=True, pattern=os.path.join(fixtures, 'opt', 'mq*'))),
+        'mq_clean_old.check_installed_mq_packages': ('mq_clean_old', lambda m: lambda: m.check_installed_mq_packages('mq93')),
+        'dentry_cleanup.read_sample': ('dentry_cleanup', lambda m: m.read_sample),
+        'rpm_database_cleanup.check_rpm[unchanged]': ('rpm_database_cleanup', lambda m: check_rpm(m, fixtures, changed=False)),
+        'rpm_database_cleanup.check_rpm[changed]': ('rpm_database_cleanup', lambda m: check_rpm(m, fixtures, changed=True)),
+        'rpm_database_cleanup.preflight[procfs, fixture /proc]': ('rpm_database_cleanup', lambda m: lambda: preflight(m, os.path.join(fixtures, 'proc'))),
+        'rpm_database_cleanup.preflight[procfs, /proc]': ('rpm_database_cleanup', lambda m: lambda: preflight(m, '/proc')),
+        'rpm_database_cleanup.preflight[ps + lsof, /proc]': ('rpm_database_cleanup', lambda m: lambda: (
+            subprocess.run(['ps', 'aux'], stdout=subprocess.PIPE, check=True),
+            subprocess.run(['lsof', '+d', m.RPM_DB_DIR], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL))),
+        'rpm_database_cleanup.backup_rpm_database[unchanged]': ('rpm_database_cleanup', lambda m: lambda: m.backup_rpm_database(
+            os.path.join(fixtures, 'rpm'), os.path.join(fixtures, 'rpmstore'))),
+        'rpm_database_cleanup.backup_rpm_database[index changed]': ('rpm_database_cleanup', lambda m: lambda: backup_changed(m, fixtures)),
+        'rpm_database_cleanup.backup[tar -z]': ('rpm_database_cleanup', lambda m: lambda: subprocess.run(
+            ['tar', '-zcf', os.path.join(fixtures, 'rpmdb.tar.gz'), '-C', fixtures, 'rpm'], check=True)),
+        'rpm_database_cleanup.backup_rpm_database[full]': ('rpm_database_cleanup', lambda m: lambda: backup_full(m, fixtures)),
+        'rpm_database_cleanup.restore[tar -z]': ('rpm_database_cleanup', lambda m: restore_tar(fixtures)),
+        'rpm_database_cleanup.restore_rpm_database': ('rpm_database_cleanup', lambda m: restore_snapshot(m, fixtures)),
+    }
+    for nodes in cib_sizes:
+        cib = os.path.join(fixtures, f'cib-{nodes}.xml')
+        cases[f'cluster_info.scan_cluster_config[nodes={nodes}]'] = (
+            'cluster_info', lambda m, cib=cib: lambda: m.scan_cluster_config(cib, 'prod1'))
+        cases[f'cluster_info.read_cluster_config[nodes={nodes},cached]'] = (
+            'cluster_info', lambda m, cib=cib: lambda: m.read_cluster_config(cib, 'prod1', cib + '.cache.json'))
+    return cases
+
+
+def primary_lookups(mq_clean_old):
+    # the lookups main() makes before it checks packages, starting from an empty registry
+    installations = mq_clean_old.get_installations(refresh=True)
+    primary = mq_clean_old.MQInstallation(next(name for name, value in installations.items() if value == 'Yes'))
+    return primary.get_dspmqver_version(), primary.get_dspmqinst_version(), primary.get_install_path()
+
+
+def preflight(rpm_database_cleanup, proc_root):
+    # what rebuild_rpm_database checks before it touches anything, lsof cannot be pointed at a fixture tree
+    return rpm_database_cleanup.rebuild_preflight(rpm_database_cleanup.RPM_DB_DIR, proc_root)
+
+
+def check_rpm(rpm_database_cleanup, fixtures, changed):
+    # the health check of the fixture database, with the stub rpmdb_verify and a verdict file of its own
+    rpm_database_cleanup.RPMDB_VERIFY = os.path.join(os.path.dirname(fixtures), 'bin', 'rpmdb_verify')
+    db_dir = os.path.join(fixtures, 'rpm')
+    state_file = os.path.join(fixtures, 'rpm-health.json')
+
+    def check():
+        if changed:
+            with open(os.path.join(db_dir, 'Name'), 'ab') as f:
+                f.write(os.urandom(64))
+        return rpm_database_cleanup.check_rpm(db_dir, state_file)
+
+    return check
+
+
+def backup_changed(rpm_database_cleanup, fixtures):
+    # one index file changes between backups, as after installing a package
+    with open(os.path.join(fixtures, 'rpm', 'Name'), 'ab') as f:
+        f.write(os.urandom(64))
+    return rpm_database_cleanup.backup_rpm_database(os.path.join(fixtures, 'rpm'), os.path.join(fixtures, 'rpmstore'))
+
+
+def backup_full(rpm_database_cleanup, fixtures):
+    # a backup into an empty store, so every file is compressed as tar -z would
+    store = os.path.join(fixtures, 'rpmstore-full')
+    shutil.rmtree(store, ignore_errors=True)
+    return rpm_database_cleanup.backup_rpm_database(os.path.join(fixtures, 'rpm'), store)
+
+
+def restore_tar(fixtures):
+    archive = os.path.join(fixtures, 'rpmdb.tar.gz')
+    target = os.path.join(fixtures, 'restore-tar')
+    subprocess.run(['tar', '-zcf', archive, '-C', fixtures, 'rpm'], check=True)
+
+    def restore():
+        shutil.rmtree(target, ignore_errors=True)
+        os.mkdir(target)
+        subprocess.run(['tar', '-zxf', archive, '-C', target], check=True)
+
+    return restore
+
+
+def restore_snapshot(rpm_database_cleanup, fixtures):
+    manifest = rpm_database_cleanup.backup_rpm_database(os.path.join(fixtures, 'rpm'), os.path.join(fixtures, 'rpmstore'))
+    target = os.path.join(fixtures, 'restore')
+    os.mkdir(target)
+
+    def restore():
+        for previous in glob.glob(target + '.pre-restore-*'):
+            shutil.rmtree(previous)
+        if rpm_database_cleanup.restore_rpm_database(manifest, target) is None:
+            raise RuntimeError('restore failed')
+
+    return restore
+
+
+def peak_rss_kb():
+    # VmHWM starts over at exec, ru_maxrss carries over the peak of the harness that forked this worker
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_spawns():
+    """Count every process this interpreter spawns through subprocess, which the commands runner, os.popen and
+    subprocess.run all go through, and return the list the argv of each one is appended to."""
+    spawned = []
+    execute_child = subprocess.Popen._execute_child
+
+    def counting_execute_child(self, args, *rest):
+        spawned.append(args)
+        return execute_child(self, args, *rest)
+
+    subprocess.Popen._execute_child = counting_execute_child
+    return spawned
+
+
+def run_case(name, fixtures, cib_sizes, repeat):
+    """Runs inside the worker process: import the module, time the call and print one JSON result."""
+    spawned = count_spawns()
+    module_name, factory = build_cases(fixtures, cib_sizes)[name]
+    calls_log = os.environ['BENCH_CALLS']
+    sys.path.insert(0, SCRIPT_DIR)
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    import_time = time.perf_counter() - start
+    call = factory(module)
+    commands = importlib.import_module('commands')
+    spawned.clear()
+    timings = []
+    for _ in range(repeat):
+        # each repetition is a run of its own, nothing is reused from the one before
+        commands.reset()
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    with open(calls_log) as f:
+        calls = sum(1 for _ in f)
+    return {'wall_ms': statistics.median(timings) * 1000,
+            # processes spawned by the call itself, and stub commands run by it or by its children such as sh or timeout
+            'processes': len(spawned) / repeat,
+            'stubbed': calls / repeat,
+            'peak_rss_kb': peak_rss_kb(),
+            'import_ms': import_time * 1000}
+
+
+def startup_time(module_name, env):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', f'import sys; sys.path.insert(0, {SCRIPT_DIR!r}); import {module_name}'],
+                   env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - start) * 1000
+
+
+def run_all(args):
+    work_dir = tempfile.mkdtemp(prefix='shell-benchmark.')
+    try:
+        fixtures = os.path.join(work_dir, 'fixtures')
+        bin_dir = os.path.join(work_dir, 'bin')
+        os.makedirs(fixtures)
+        os.makedirs(bin_dir)
+        write_fixtures(fixtures, args.output_lines, args.installations, args.cib_sizes, args.tree_files, args.rpmdb_mb,
+                       args.proc_processes, args.proc_fds)
+        write_stubs(bin_dir, fixtures, args.latency)
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+        cases = build_cases(fixtures, args.cib_sizes)
+        startup = {}
+        results = []
+        for number, (name, (module_name, _)) in enumerate(cases.items()):
+            if args.cases and not any(pattern in name for pattern in args.cases):
+                continue
+            calls_log = os.path.join(work_dir, f'{number}.calls')
+            open(calls_log, 'w').close()
+            result = {'case': name, 'module': module_name}
+            worker = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', name, '--fixtures', fixtures,
+                                     '--repeat', str(args.repeat), '--cib-sizes', ','.join(map(str, args.cib_sizes))],
+                                    env=dict(env, BENCH_CALLS=calls_log), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if worker.returncode == 0:
+                result.update(json.loads(worker.stdout.splitlines()[-1]))
+                if module_name not in startup:
+                    startup[module_name] = startup_time(module_name, env)
+                result['startup_ms'] = startup[module_name]
+            else:
+                result['error'] = (worker.stderr.strip().splitlines() or ['exit code %d' % worker.returncode])[-1]
+            results.append(result)
+        return {'meta': {'python': platform.python_version(), 'host': platform.node(),
+                         'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'latency': args.latency,
+                         'output_lines': args.output_lines, 'installations': args.installations,
+                         'cib_sizes': args.cib_sizes, 'tree_files': args.tree_files,
+                         'rpmdb_mb': args.rpmdb_mb, 'proc_processes': args.proc_processes, 'proc_fds': args.proc_fds,
+                         'repeat': args.repeat},
+                'results': results}
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(report, baseline=None, threshold=0.1):
+    previous = {result['case']: result for result in (baseline or {}).get('results', [])}
+    regressions = 0
+    for result in report['results']:
+        if 'error' in result:
+            print(f"{result['case']:<58} ERROR {result['error']}")
+            continue
+        line = (f"{result['case']:<58} {result['wall_ms']:>9.2f} ms {result['processes']:>5.3g} procs {result['stubbed']:>5.3g} stubbed "
+                f"{result['peak_rss_kb'] / 1024:>7.1f} MiB  import {result['import_ms']:>6.1f} ms  startup {result['startup_ms']:>6.1f} ms")
+        before = previous.get(result['case'])
+        if before and 'error' not in before:
+            change = result['wall_ms'] / before['wall_ms'] - 1 if before['wall_ms'] else 0
+            line += f'  {change:+.0%}'
+            # results written before the processes column only counted stub commands, as subprocesses
+            stubbed_before = before.get('stubbed', before.get('subprocesses', 0))
+            if (change > threshold or result['processes'] > before.get('processes', stubbed_before)
+                    or result['stubbed'] > stubbed_before):
+                line += '  REGRESSION'
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the shell/ scripts against stub executables and fixture files")
+    parser.add_argument('cases', nargs='*', help="only run cases whose name contains one of these strings")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds every stub command sleeps")
+    parser.add_argument('--output-lines', type=int, default=1000, help="lines of dspmq and rpm -qa output")
+    parser.add_argument('--installations', type=int, default=8, help="MQ installations listed by dspmqinst")
+    parser.add_argument('--tree-files', type=int, default=2000, help="files in each fixture MQ installation tree")
+    parser.add_argument('--rpmdb-mb', type=int, default=64, help="size of the fixture RPM Packages file in MiB")
+    parser.add_argument('--proc-processes', type=int, default=300, help="processes in the fixture /proc tree")
+    parser.add_argument('--proc-fds', type=int, default=100, help="open files of each fixture process")
+    parser.add_argument('--cib-sizes', type=lambda value: [int(size) for size in value.split(',')], default=[10, 1000, 20000],
+                        help="comma separated node counts of the CIB fixtures")
+    parser.add_argument('--repeat', type=int, default=5, help="timed calls per case, the median is reported")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="slowdown that counts as a regression with --compare")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--fixtures', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_case(args.worker, args.fixtures, args.cib_sizes, args.repeat)))
+        return
+
+    report = run_all(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = print_report(report, baseline, args.threshold)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
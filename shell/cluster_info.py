@@ -1,71 +1,242 @@
 #!/usr/bin/env python3
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
 from operator import itemgetter
 import subprocess as sp
-import platform
+import ctypes.util
+import socketserver
+import threading
+import argparse
+import select
+import shutil
+import socket
+import struct
+import hashlib
+import logging
+import ctypes
+import json
+import time
 import re
 import sys
 import os
 
+import commands
+from procfs import build_fake_proc, find_process, write_fake_process
 
-def get_os_release():
-    # deprecated in 3.7 -> distro.linux_distribution()
-    return float(platform.linux_distribution()[1])
+logger = logging.getLogger('cluster_info')
 
+# seconds each external probe may run before it is killed and its fact is left empty
+PROBE_TIMEOUTS = {'fqdn': 5, 'lreg': 10, 'dspmq': 20}
+# registry properties read with lreg and the facts they are printed as
+LREG_KEY = 'cernerha'
+LREG_PROPERTIES = {'CoreFSINode': 'core_fsi_node', 'HAInterfaceHomeNode': 'ha_interface_home_node',
+                   'HASingleInstList': 'ha_single_inst_list'}
+_lreg_cache = {}
 
-def get_fqdn():
-    fqdn = sp.getoutput('hostname --fqdn')
+# set our configuration files
+OS_RELEASE_FILE = '/etc/os-release'
+CLUSTER_CONFIG_FILE = '/var/lib/pacemaker/cib/cib.xml'
+ATG_FILE = '/usr/local/cluster/cerner.functions'
+
+# facts in the order they are printed
+FACT_NAMES = ('fqdn', 'atg_version', 'cluster_name', 'cluster_nodes', 'cluster_node_count',
+              'core_fsi_node', 'ha_interface_home_node', 'ha_single_inst_list', 'mq_cluster')
+
+# one queue manager per line, e.g. QMNAME(CERN.NODE1.PROD1)    STATUS(Running)
+DSPMQ_LINE = re.compile(r'^QMNAME\(([^)]*)\)\s+STATUS\(([^)]*)\)', re.MULTILINE)
+
+# --changed-only keeps the last emitted facts here
+FACTS_STATE_FILE = '/var/tmp/cluster_info.facts.json'
+ENCODINGS = ('xml', 'json', 'binary')
+BINARY_NAME = struct.Struct('>H')
+BINARY_VALUE = struct.Struct('>I')
+
+# daemon mode: where facts are served and how many seconds each command-based fact is reused
+SOCKET_PATH = '/run/cluster_info.sock'
+# only the owner and the socket's group may query the facts
+SOCKET_MODE = 0o660
+FACT_TTLS = {'fqdn': 3600, 'registry': 300, 'mq_cluster': 60}
+
+# inotify(7) masks for a file being written, replaced or removed
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# facts parsed from the CIB, reused until the file changes
+CIB_CACHE_FILE = '/var/tmp/cluster_info.cib.json'
+CIB_CHUNK_SIZE = 1 << 16
+
+
+def get_os_release(path=OS_RELEASE_FILE):
+    # major.minor of VERSION_ID in os-release(5), platform.linux_distribution() is gone since Python 3.8
+    # a host without the file predates systemd, i.e. RHEL 6 or older, and counts as 0
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.strip().partition('=')
+                if key == 'VERSION_ID':
+                    return float('.'.join(value.strip('"\'').split('.')[:2]))
+    except (OSError, ValueError):
+        pass
+    return 0.0
+
+
+def getoutput(argv, timeout, reuse=True):
+    # sp.getoutput without the shell and with a deadline, the output of a run is reused unless reuse is off
+    try:
+        output = commands.run(argv, timeout, stderr=commands.STDOUT, reuse=reuse).stdout
+    except FileNotFoundError:
+        return ''
+    if output[-1:] == '\n':
+        output = output[:-1]
+    return output
+
+
+def get_fqdn(timeout=PROBE_TIMEOUTS['fqdn'], refresh=False):
+    fqdn = getoutput(['hostname', '--fqdn'], timeout, reuse=not refresh)
     return fqdn.lower()
 
 
-def get_mq_cluster(environment):
-    nodes = []
-    pattern = '(?<=CERN\.)(.*?)(?=\.)'
-    mq_cluster_info = sp.getoutput('dspmq')
-    for line in iter(mq_cluster_info.splitlines()):
-        if environment.lower() in line.lower():
-            match = re.search(pattern, line)
-            nodes.append(match.group())
+class QueueManager(namedtuple('QueueManager', ('name', 'status'))):
+    __slots__ = ()
+
+    @property
+    def node(self):
+        # queue managers are named CERN.<node>.<environment>, None when the name has no node part
+        _, found, rest = self.name.partition('CERN.')
+        node, dot, _ = rest.partition('.')
+        return node if found and dot else None
+
+
+def lines_containing(text, needle):
+    # the lines of text that contain needle ignoring case, found with str.find on one lowered copy
+    lowered = text.lower()
+    needle = needle.lower()
+    position = lowered.find(needle)
+    while position >= 0:
+        end = lowered.find('\n', position)
+        if end < 0:
+            end = len(text)
+        yield text[lowered.rfind('\n', 0, position) + 1:end]
+        position = lowered.find(needle, end)
+
+
+def parse_dspmq(output, environment=None):
+    """Parse the QMNAME(...) STATUS(...) lines of dspmq output into QueueManager records.
+
+    With an environment only the lines that mention it are parsed, the other queue
+    managers cost neither a regex match nor a record.
+    """
+    if environment is None:
+        return list(map(QueueManager._make, DSPMQ_LINE.findall(output)))
+    matches = map(DSPMQ_LINE.match, lines_containing(output, environment))
+    return [QueueManager._make(match.groups()) for match in matches if match]
+
+
+def get_mq_cluster(environment, timeout=PROBE_TIMEOUTS['dspmq'], refresh=False):
+    output = getoutput(['dspmq'], timeout, reuse=not refresh)
+    environment = environment.lower()
+    nodes = [queue_manager.node for queue_manager in parse_dspmq(output, environment)
+             if environment in queue_manager.name.lower() and queue_manager.node]
     mq_cluster_nodes = ",".join(sorted(nodes)).lower()
     return mq_cluster_nodes
 
 
 def get_process_id(process_name):
-    child = sp.Popen(['pgrep', '-f', process_name], stdout=sp.PIPE, shell=False)
-    response = child.communicate()[0]
-    pid_list = [int(pid) for pid in response.split()]
-    if len(pid_list) > 0:
-        return True
-    else:
-        return False
+    # scans /proc in-process and stops at the first match instead of forking pgrep -f
+    return find_process(process_name) is not None
 
 
-def is_cluster(cluster_config_file, environment):
-    if os.path.isfile(cluster_config_file):
-        with open(cluster_config_file) as f:
-            # ensure the environment name exists in the cluster config to determine if the cluster is associated to the domain
-            if environment.lower() in f.read().lower():
-                return True
-            else:
-                return False
-    else:
-        return False
+def scan_cluster_config(cluster_config_file, environment):
+    """Stream the pacemaker CIB once for everything main() needs from it.
 
+    The raw text is searched for the environment name exactly like the old full-file
+    read did, while the same chunks feed an incremental parser that picks up the
+    cluster-name nvpair and node unames and drops every element once it is closed.
 
-def parse_cluster_config(cluster_config_file):
+    Returns:
+        dict: is_cluster, cluster_name, cluster_nodes and cluster_node_count
+    """
+    environment = environment.lower()
+    overlap = max(len(environment) - 1, 0)
+    member = False
+    tail = ''
+    cluster_name = None
     cluster_nodes = []
-    tree = ET.parse(cluster_config_file)
-    root = tree.getroot()
-    # store cluster name
-    for value in root.findall('.//nvpair[@name="cluster-name"]'):
-        cluster_name = value.attrib['value']
-    for node in root.iter('node'):
-        cluster_nodes.append(node.get('uname'))
-    cluster_node_count = len(cluster_nodes)
-    # generate a string of numerically ordered comma separated nodes that are clustered with the local node inclusive
-    cluster_nodes = ",".join(sorted(cluster_nodes))
-    # return all parsed values as a dictionary
-    return {'cluster_name': cluster_name, 'cluster_nodes': cluster_nodes, 'cluster_node_count': cluster_node_count}
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    parents = []
+    with open(cluster_config_file) as f:
+        for chunk in iter(lambda: f.read(CIB_CHUNK_SIZE), ''):
+            if not member:
+                # keep the end of the previous chunk so a name split across two reads still matches
+                window = tail + chunk.lower()
+                member = environment in window
+                tail = window[-overlap:] if overlap else ''
+            parser.feed(chunk)
+            for event, element in parser.read_events():
+                if event == 'start':
+                    if element.tag == 'nvpair' and element.get('name') == 'cluster-name':
+                        cluster_name = element.get('value')
+                    elif element.tag == 'node':
+                        cluster_nodes.append(element.get('uname'))
+                    parents.append(element)
+                else:
+                    parents.pop()
+                    if parents:
+                        del parents[-1][-1]
+    parser.close()
+    return {'is_cluster': member,
+            'cluster_name': cluster_name,
+            # numerically ordered comma separated nodes that are clustered with the local node inclusive
+            'cluster_nodes': ",".join(sorted(cluster_nodes)),
+            'cluster_node_count': len(cluster_nodes)}
+
+
+def read_cluster_config(cluster_config_file, environment, cache_file=CIB_CACHE_FILE):
+    """scan_cluster_config() cached on disk until the CIB's inode, mtime or size changes.
+
+    Returns None when there is no CIB, which means this node is not clustered.
+    """
+    try:
+        st = os.stat(cluster_config_file)
+    except FileNotFoundError:
+        return None
+    key = [cluster_config_file, st.st_ino, st.st_mtime_ns, st.st_size, environment]
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return cached['facts']
+    except (OSError, ValueError, KeyError):
+        pass
+    facts = scan_cluster_config(cluster_config_file, environment)
+    try:
+        tmp_file = f'{cache_file}.{os.getpid()}'
+        with open(tmp_file, 'w') as f:
+            json.dump({'key': key, 'facts': facts}, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        # the cache only saves work, never fail the facts over it
+        pass
+    return facts
+
+
+def is_cluster(cluster_config_file, environment):
+    # ensure the environment name exists in the cluster config to determine if the cluster is associated to the domain
+    facts = read_cluster_config(cluster_config_file, environment)
+    return bool(facts and facts['is_cluster'])
+
+
+def parse_cluster_config(cluster_config_file, environment=''):
+    facts = read_cluster_config(cluster_config_file, environment)
+    return {name: facts[name] for name in ('cluster_name', 'cluster_nodes', 'cluster_node_count')}
 
 
 def get_atg_version(atg_file):
@@ -82,22 +253,471 @@ def get_atg_version(atg_file):
         return None
 
 
-def get_lreg_property(environment, property):
-    lreg_key = "cernerha"
-    lreg_command = "lreg -getp \\\\{lreg_key}\\\\{environment}\\\\ {property} 2>/dev/null".format(lreg_key=lreg_key,
-                                                                                                  environment=environment,
-                                                                                                  property=property)
-    property_val = sp.getoutput(lreg_command)
-    return property_val
+def lreg_key(environment):
+    return f'\\{LREG_KEY}\\{environment}\\'
+
+
+def run_lreg(environment, property, timeout):
+    try:
+        result = commands.run(['lreg', '-getp', lreg_key(environment), property], timeout)
+    except FileNotFoundError:
+        return ''
+    return result.stdout.rstrip('\n')
+
+
+LREG_KEY_LINE = re.compile(r'\s*([A-Za-z_][\w.]*)\s*=\s*(.*?)\s*')
+
+
+def parse_lreg_key(output):
+    """Parse the Name = value lines lreg -p prints for every property of a key.
+
+    Returns None unless every non-blank line has that format, so a listing that looks any different is not trusted.
+    """
+    properties = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        match = LREG_KEY_LINE.fullmatch(line)
+        if match is None:
+            return None
+        properties[match.group(1)] = match.group(2)
+    return properties
+
+
+def read_lreg_key(environment, timeout):
+    # every property of \cernerha\<environment>\ from one lreg, None when the key could not be read or parsed
+    try:
+        result = commands.run(['lreg', '-p', lreg_key(environment)], timeout)
+    except FileNotFoundError:
+        return None
+    return parse_lreg_key(result.stdout) if result.returncode == 0 else None
+
+
+def get_lreg_properties(environment, properties, timeout=PROBE_TIMEOUTS['lreg'], refresh=False):
+    """Look up several properties under \\cernerha\\<environment>\\ at once.
+
+    The key is read once with lreg -p and the properties are picked out of it, without a shell.
+    Every property the listing did not return, all of them when the key cannot be listed or the
+    listing is not in the expected format, falls back to its own lreg -getp. Values are
+    remembered for the life of the process unless refresh is set.
+
+    Returns:
+        dict: property -> value, '' when the property is not set
+    """
+    wanted = [property for property in properties if refresh or (environment, property) not in _lreg_cache]
+    if wanted:
+        values = read_lreg_key(environment, timeout) or {}
+        missing = [property for property in wanted if property not in values]
+        for property in wanted:
+            if property in values:
+                _lreg_cache[environment, property] = values[property]
+        if missing:
+            with ThreadPoolExecutor(max_workers=len(missing)) as pool:
+                for property, value in zip(missing, pool.map(lambda property: run_lreg(environment, property, timeout), missing)):
+                    _lreg_cache[environment, property] = value
+    return {property: _lreg_cache[environment, property] for property in properties}
+
+
+def get_lreg_property(environment, property, timeout=PROBE_TIMEOUTS['lreg']):
+    return get_lreg_properties(environment, (property,), timeout)[property]
+
+
+def get_registry_facts(environment, refresh=False):
+    # the registry can only be read while reg_server is up
+    if not get_process_id('reg_server'):
+        return dict.fromkeys(LREG_PROPERTIES.values())
+    properties = get_lreg_properties(environment, LREG_PROPERTIES, refresh=refresh)
+    return {fact: properties[property] for property, fact in LREG_PROPERTIES.items()}
+
+
+def render_facts(facts):
+    return ''.join(f'<{name}>{value or ""}</{name}>' for name, value in facts.items())
+
+
+def normalize_facts(facts):
+    # the values exactly as they are printed, so None, 0 and '' all compare equal
+    return {name: str(value or '') for name, value in facts.items()}
+
+
+def diff_facts(facts, state_file=FACTS_STATE_FILE):
+    """Return the facts that changed since the last run with the same state file.
+
+    The result always ends with facts_sha256, the hash of the complete fact set, so
+    a run where nothing changed emits only that hash as a cheap "unchanged" marker.
+    """
+    current = normalize_facts(facts)
+    try:
+        with open(state_file) as f:
+            previous = json.load(f)
+    except (OSError, ValueError):
+        previous = {}
+    changed = {name: value for name, value in current.items() if previous.get(name) != value}
+    changed['facts_sha256'] = hashlib.sha256(json.dumps(current, separators=(',', ':')).encode()).hexdigest()
+    try:
+        tmp_file = f'{state_file}.{os.getpid()}'
+        with open(tmp_file, 'w') as f:
+            json.dump(current, f)
+        os.replace(tmp_file, state_file)
+    except OSError:
+        # without saved state the next run simply reports every fact again
+        pass
+    return changed
+
+
+def encode_facts(facts, encoding='xml'):
+    """Serialize facts as the XML the script always printed, compact JSON, or length-prefixed binary.
+
+    The binary form is, per fact, a big-endian u16 name length, the name, a u32 value
+    length and the value, all UTF-8.
+    """
+    if encoding == 'xml':
+        return (render_facts(facts) + '\n').encode()
+    if encoding == 'json':
+        return (json.dumps(normalize_facts(facts), separators=(',', ':')) + '\n').encode()
+    payload = bytearray()
+    for name, value in normalize_facts(facts).items():
+        name, value = name.encode(), value.encode()
+        payload += BINARY_NAME.pack(len(name)) + name + BINARY_VALUE.pack(len(value)) + value
+    return bytes(payload)
+
+
+def decode_facts(payload, encoding='xml'):
+    if encoding == 'xml':
+        return {element.tag: element.text or '' for element in ET.fromstring(b'<facts>' + payload + b'</facts>')}
+    if encoding == 'json':
+        return json.loads(payload)
+    facts = {}
+    offset = 0
+    while offset < len(payload):
+        (length,) = BINARY_NAME.unpack_from(payload, offset)
+        offset += BINARY_NAME.size
+        name = payload[offset:offset + length].decode()
+        offset += length
+        (length,) = BINARY_VALUE.unpack_from(payload, offset)
+        offset += BINARY_VALUE.size
+        facts[name] = payload[offset:offset + length].decode()
+        offset += length
+    return facts
+
+
+def benchmark_probes(processes=5000, queue_managers=500, rounds=20):
+    """Time pgrep -f against the /proc scan on a fixture tree, and the old dspmq line regex against parse_dspmq."""
+    import tempfile
+
+    def timed(label, probe):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            result = probe()
+        print(f'{label:<36} {(time.perf_counter() - start) / rounds * 1000:>8.3f} ms  result={result}')
+        return result
+
+    with tempfile.TemporaryDirectory() as proc_root:
+        build_fake_proc(proc_root, processes)
+        write_fake_process(proc_root, 1000 + processes, 'reg_server', ['/cerner/bin/reg_server', '-d'])
+        timed('pgrep -f reg_server (live /proc)', lambda: bool(sp.run(['pgrep', '-f', 'reg_server'], stdout=sp.PIPE).stdout.split()))
+        timed('find_process (live /proc)', lambda: find_process('reg_server') is not None)
+        timed(f'find_process, {processes} fixture pids', lambda: find_process('reg_server', proc_root) is not None)
+        timed(f'find_process miss, {processes} pids', lambda: find_process('no_such_daemon', proc_root) is not None)
+
+    environment = 'env007'
+    output = '\n'.join(f'QMNAME(CERN.NODE{i % 16:02d}.ENV{i % 40:03d}){" " * 30}STATUS(Running)' for i in range(queue_managers))
+
+    def lookbehind_scan():
+        nodes = []
+        for line in iter(output.splitlines()):
+            if environment.lower() in line.lower():
+                nodes.append(re.search('(?<=CERN\\.)(.*?)(?=\\.)', line).group())
+        return ",".join(sorted(nodes)).lower()
+
+    def records_scan():
+        return ",".join(sorted(queue_manager.node for queue_manager in parse_dspmq(output, environment)
+                               if environment in queue_manager.name.lower() and queue_manager.node)).lower()
+
+    rounds *= 50
+    expected = timed(f'dspmq lookbehind, {queue_managers} qmgrs', lookbehind_scan)
+    assert timed(f'parse_dspmq, {queue_managers} qmgrs', records_scan) == expected
+
+
+def benchmark_encodings(rounds=20000):
+    """Compare payload size and collector-side parse time of each encoding, full and as a diff."""
+    nodes = ','.join(f'node{i:02d}.example.com' for i in range(16))
+    facts = {'fqdn': 'node01.example.com', 'atg_version': 42, 'cluster_name': 'p1_cluster', 'cluster_nodes': nodes,
+             'cluster_node_count': 16, 'core_fsi_node': 'node01', 'ha_interface_home_node': 'node02',
+             'ha_single_inst_list': 'node03,node04', 'mq_cluster': nodes}
+    digest = hashlib.sha256(b'').hexdigest()
+    for label, payload_facts in (('full', facts), ('one change', {'mq_cluster': nodes, 'facts_sha256': digest}),
+                                 ('unchanged', {'facts_sha256': digest})):
+        for encoding in ('xml', 'json', 'binary'):
+            payload = encode_facts(payload_facts, encoding)
+            start = time.perf_counter()
+            for _ in range(rounds):
+                decode_facts(payload, encoding)
+            parse_time = (time.perf_counter() - start) / rounds
+            print(f'{label:<11} {encoding:<7} {len(payload):>6} bytes {parse_time * 1e6:>8.2f} us/parse')
+
+
+class ProbeTimings:
+    """Runs fact probes and records how long each one took."""
+
+    def __init__(self):
+        self.durations = {}
+        self.timed_out = set()
+
+    def run(self, name, func, *args):
+        # a probe that runs past its timeout yields None, which prints as an empty fact
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        except sp.TimeoutExpired:
+            self.timed_out.add(name)
+            return None
+        finally:
+            self.durations[name] = time.perf_counter() - start
+
+    def report(self, wall_time, critical_path, file=sys.stderr):
+        for name, duration in sorted(self.durations.items(), key=itemgetter(1), reverse=True):
+            print(f'{name:<32} {duration * 1000:>9.1f} ms{" (timed out)" if name in self.timed_out else ""}', file=file)
+        print(f'{"critical path":<32} {critical_path * 1000:>9.1f} ms', file=file)
+        print(f'{"wall time":<32} {wall_time * 1000:>9.1f} ms', file=file)
+
+
+class FileWatcher:
+    """Reports which of a set of files changed, through inotify on their directories.
+
+    Files whose directory cannot be watched, or every file when inotify is not
+    available, are polled by (inode, mtime, size) instead.
+    """
+
+    def __init__(self, paths, poll_interval=5):
+        self.poll_interval = poll_interval
+        self.watches = {}
+        self.polled = {}
+        self.fd = None
+        paths = {os.path.abspath(path) for path in paths}
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd >= 0:
+            self.fd = fd
+            mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+            for directory in {os.path.dirname(path) for path in paths}:
+                wd = libc.inotify_add_watch(fd, directory.encode(), mask)
+                if wd >= 0:
+                    self.watches[wd] = (directory, {path for path in paths if os.path.dirname(path) == directory})
+        watched = set().union(*(files for _, files in self.watches.values()))
+        self.polled = {path: self.stat_key(path) for path in paths - watched}
+
+    @staticmethod
+    def stat_key(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns, st.st_size
+
+    def wait(self, timeout):
+        """Block up to timeout seconds and return the set of files that changed."""
+        if self.polled:
+            timeout = self.poll_interval if timeout is None else min(timeout, self.poll_interval)
+        changed = set()
+        if self.fd is not None:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if readable:
+                changed |= self.read_events()
+        else:
+            time.sleep(timeout)
+        for path, key in self.polled.items():
+            current = self.stat_key(path)
+            if current != key:
+                self.polled[path] = current
+                changed.add(path)
+        return changed
+
+    def read_events(self):
+        changed = set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return changed
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were lost, assume everything changed
+                return set().union(*(files for _, files in self.watches.values()))
+            if wd in self.watches:
+                directory, files = self.watches[wd]
+                path = os.path.join(directory, name)
+                if path in files:
+                    changed.add(path)
+        return changed
+
+
+class FactDaemon:
+    """Keeps the fact set in memory and serves it on a Unix socket in the same XML the script prints.
+
+    File-based facts are refreshed when their file changes, command-based facts when
+    their TTL runs out, each independently of the others. Every refresh re-renders
+    the reply once, so a poller only costs a socket write. Replies wait until every
+    command-based fact was refreshed once, a failed refresh keeps the last value and
+    is logged and kept in failures.
+    """
+
+    def __init__(self, environment, socket_path=SOCKET_PATH, ttls=FACT_TTLS,
+                 cluster_config_file=CLUSTER_CONFIG_FILE, atg_file=ATG_FILE, socket_group=None):
+        self.environment = environment
+        self.socket_path = socket_path
+        self.socket_group = socket_group
+        self.ttls = dict(ttls)
+        self.cluster_config_file = os.path.abspath(cluster_config_file)
+        self.atg_file = os.path.abspath(atg_file)
+        self.facts = dict.fromkeys(FACT_NAMES)
+        self.clustered = False
+        self.payload = b''
+        self.lock = threading.Lock()
+        self.commands = {'fqdn': lambda: {'fqdn': get_fqdn(refresh=True)},
+                         'registry': lambda: get_registry_facts(environment, refresh=True),
+                         'mq_cluster': lambda: {'mq_cluster': get_mq_cluster(environment, refresh=True)}}
+        self.running = set()
+        self.next_refresh = dict.fromkeys(self.commands, 0)
+        # commands not refreshed yet, ready is set once the first round finished
+        self.pending = set(self.commands)
+        self.ready = threading.Event()
+        # fact source -> (time.time(), error) of its last failed refresh, cleared when it succeeds again
+        self.failures = {}
+
+    def update(self, facts, clustered=None):
+        with self.lock:
+            self.facts.update(facts)
+            if clustered is not None:
+                self.clustered = clustered
+            # a node outside the environment's cluster prints nothing, same as the script
+            self.payload = (render_facts(self.facts) + '\n').encode() if self.clustered else b''
+
+    def refresh_cib(self):
+        cluster_config = read_cluster_config(self.cluster_config_file, self.environment) or {'is_cluster': False}
+        self.update({name: cluster_config.get(name) for name in ('cluster_name', 'cluster_nodes', 'cluster_node_count')},
+                    clustered=cluster_config['is_cluster'])
+
+    def refresh_atg(self):
+        self.update({'atg_version': get_atg_version(self.atg_file)})
+
+    def refresh(self, name, func, *args):
+        # a failed refresh keeps the last good value, the next change or TTL tries again
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error('Refreshing %s failed: %s', name, e if str(e) else type(e).__name__)
+            with self.lock:
+                self.failures[name] = (time.time(), str(e) or type(e).__name__)
+        else:
+            with self.lock:
+                self.failures.pop(name, None)
+
+    def refresh_command(self, name):
+        try:
+            self.refresh(name, lambda: self.update(self.commands[name]()))
+        finally:
+            self.running.discard(name)
+            self.pending.discard(name)
+            if not self.pending:
+                self.ready.set()
+
+    def refresh_loop(self, pool, watcher):
+        while True:
+            now = time.monotonic()
+            for name, due in self.next_refresh.items():
+                if due <= now and name not in self.running:
+                    self.running.add(name)
+                    self.next_refresh[name] = now + self.ttls[name]
+                    pool.submit(self.refresh_command, name)
+            changed = watcher.wait(max(0, min(self.next_refresh.values()) - time.monotonic()))
+            if self.cluster_config_file in changed:
+                self.refresh('cib', self.refresh_cib)
+            if self.atg_file in changed:
+                self.refresh('atg', self.refresh_atg)
+
+    def bind(self, handler):
+        """Create the server on socket_path, replacing a stale socket, with the socket readable by its owner only.
+
+        The umask is process wide, so this runs before any refresh thread starts; the caller opens the socket up to
+        SOCKET_MODE once its group is set.
+        """
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        umask = os.umask(0o177)
+        try:
+            return socketserver.ThreadingUnixStreamServer(self.socket_path, handler)
+        finally:
+            os.umask(umask)
+
+    def serve_forever(self):
+        daemon = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                # every command has a deadline, so the first round of refreshes ends
+                daemon.ready.wait()
+                self.request.sendall(daemon.payload)
+
+        with self.bind(Handler) as server:
+            if self.socket_group is not None:
+                shutil.chown(self.socket_path, group=self.socket_group)
+            os.chmod(self.socket_path, SOCKET_MODE)
+
+            self.refresh('cib', self.refresh_cib)
+            self.refresh('atg', self.refresh_atg)
+            watcher = FileWatcher((self.cluster_config_file, self.atg_file))
+            pool = ThreadPoolExecutor(max_workers=len(self.commands))
+            threading.Thread(target=self.refresh_loop, args=(pool, watcher), daemon=True).start()
+            server.serve_forever()
+
+
+def query(socket_path=SOCKET_PATH):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        chunks = []
+        for chunk in iter(lambda: client.recv(65536), b''):
+            chunks.append(chunk)
+    return b''.join(chunks).decode()
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Print the cluster facts of this node as XML")
+    parser.add_argument('--timings', action='store_true', help="report per-probe latency, the critical path and every command run on stderr")
+    parser.add_argument('--format', choices=ENCODINGS, default='xml', help="encoding of the printed facts")
+    parser.add_argument('--changed-only', action='store_true',
+                        help="print only facts that changed since the last run plus a facts_sha256 of the full set")
+    parser.add_argument('--state-file', default=FACTS_STATE_FILE, help="where --changed-only keeps the last emitted facts")
+    parser.add_argument('--benchmark', nargs='?', const='encodings', choices=('encodings', 'probes'),
+                        help="compare payload size and parse time of each encoding, or the process and dspmq probes, and exit")
+    parser.add_argument('--daemon', action='store_true', help="stay resident and serve the facts on --socket")
+    parser.add_argument('--query', action='store_true', help="print the facts served by a running daemon")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="Unix socket used by --daemon and --query")
+    parser.add_argument('--socket-group', help="group allowed to --query the daemon, the socket is mode 0660")
+    args = parser.parse_args()
+
+    if args.query:
+        print(query(args.socket), end='')
+        return
+
+    if args.benchmark == 'encodings':
+        benchmark_encodings()
+        return
+    if args.benchmark == 'probes':
+        benchmark_probes()
+        return
+
     if get_os_release() < 7:
         sys.exit()
 
-    # set our configuration files
-    cluster_config_file = '/var/lib/pacemaker/cib/cib.xml'
-    atg_file = '/usr/local/cluster/cerner.functions'
+    cluster_config_file = CLUSTER_CONFIG_FILE
+    atg_file = ATG_FILE
 
     # abort if there environment is not set or if the environment is not clustered
     if not os.getenv('environment'):
@@ -105,6 +725,10 @@ def main():
     else:
         environment = os.getenv('environment')
 
+    if args.daemon:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        FactDaemon(environment, args.socket, socket_group=args.socket_group).serve_forever()
+
     #initialize variables
     fqdn = None
     atg_version = None
@@ -116,33 +740,44 @@ def main():
     ha_single_inst_list = None
     mq_cluster = None
 
-    if not is_cluster(cluster_config_file, environment):
+    timings = ProbeTimings()
+    started = time.perf_counter()
+    cluster_config = timings.run('cib.xml', read_cluster_config, cluster_config_file, environment)
+    if not (cluster_config and cluster_config['is_cluster']):
         sys.exit()
+    cluster_name, cluster_nodes, cluster_node_count = itemgetter('cluster_name', 'cluster_nodes', 'cluster_node_count')(cluster_config)
 
-    fqdn = get_fqdn()
+    # the external probes are independent of each other, only lreg waits on the reg_server check
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        fqdn_probe = pool.submit(timings.run, 'hostname --fqdn', get_fqdn)
+        reg_server_probe = pool.submit(timings.run, 'reg_server', get_process_id, 'reg_server')
+        mq_cluster_probe = pool.submit(timings.run, 'dspmq', get_mq_cluster, environment)
 
-    if is_cluster(cluster_config_file, environment):
-        cluster_config = parse_cluster_config(cluster_config_file)
-        cluster_name, cluster_nodes, cluster_node_count = itemgetter('cluster_name', 'cluster_nodes', 'cluster_node_count')(cluster_config)
+        atg_version = timings.run('cerner.functions', get_atg_version, atg_file)
 
-    atg_version = get_atg_version(atg_file)
+        if reg_server_probe.result():
+            properties = timings.run('lreg', get_lreg_properties, environment, LREG_PROPERTIES) or {}
+            core_fsi_node, ha_interface_home_node, ha_single_inst_list = map(properties.get, LREG_PROPERTIES)
 
-    if get_process_id('reg_server'):
-        core_fsi_node = get_lreg_property(environment, 'CoreFSINode')
-        ha_interface_home_node = get_lreg_property(environment, 'HAInterfaceHomeNode')
-        ha_single_inst_list = get_lreg_property(environment, 'HASingleInstList')
+        fqdn = fqdn_probe.result()
+        mq_cluster = mq_cluster_probe.result()
+    wall_time = time.perf_counter() - started
 
-    mq_cluster = get_mq_cluster(environment)
+    if args.timings:
+        durations = timings.durations
+        lreg_time = durations.get('lreg', 0)
+        critical_path = durations['cib.xml'] + max(durations['hostname --fqdn'], durations['dspmq'],
+                                                   durations['reg_server'] + lreg_time, durations['cerner.functions'])
+        timings.report(wall_time, critical_path)
+        commands.report()
 
-    print(f'<fqdn>{fqdn or ""}</fqdn>\
-<atg_version>{atg_version or ""}</atg_version>\
-<cluster_name>{cluster_name or ""}</cluster_name>\
-<cluster_nodes>{cluster_nodes or ""}</cluster_nodes>\
-<cluster_node_count>{cluster_node_count or ""}</cluster_node_count>\
-<core_fsi_node>{core_fsi_node or ""}</core_fsi_node>\
-<ha_interface_home_node>{ha_interface_home_node or ""}</ha_interface_home_node>\
-<ha_single_inst_list>{ha_single_inst_list or ""}</ha_single_inst_list>\
-<mq_cluster>{mq_cluster or ""}</mq_cluster>')
+    facts = {'fqdn': fqdn, 'atg_version': atg_version, 'cluster_name': cluster_name,
+             'cluster_nodes': cluster_nodes, 'cluster_node_count': cluster_node_count,
+             'core_fsi_node': core_fsi_node, 'ha_interface_home_node': ha_interface_home_node,
+             'ha_single_inst_list': ha_single_inst_list, 'mq_cluster': mq_cluster}
+    if args.changed_only:
+        facts = diff_facts(facts, args.state_file)
+    sys.stdout.buffer.write(encode_facts(facts, args.format))
 
 
 if __name__ == "__main__":
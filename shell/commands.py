@@ -0,0 +1,263 @@
+"""
+Runs external commands for the scripts in this directory.
+
+Commands are spawned without a shell and get their deadline enforced in-process: at the timeout
+the command's process group is sent SIGTERM and, KILL_AFTER seconds later, SIGKILL, as the
+timeout -k 4 wrapper did, and subprocess.TimeoutExpired is raised. A call interrupted by Ctrl-C
+or another exception stops its command the same way before the exception goes on. A call made
+with reuse=True returns the result of an identical earlier call of the same run instead of
+spawning again, and identical calls made at the same time from several threads wait on one
+process. stream() yields the output of a command line by line as it is written, under the same
+deadline, and is never reused.
+
+Every call is recorded with its argv, duration, exit code and output size. Calls slower than
+SLOW_CALL are logged at info level, and the whole trace is appended as JSON lines to the file
+named by $COMMAND_TRACE when the script exits.
+"""
+import atexit
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from operator import attrgetter
+
+PIPE = subprocess.PIPE
+STDOUT = subprocess.STDOUT
+DEVNULL = subprocess.DEVNULL
+
+# seconds a command gets between SIGTERM at its deadline and SIGKILL
+KILL_AFTER = 4
+# seconds after which a call is logged as slow
+SLOW_CALL = 1.0
+# environment variable naming the file the trace is appended to at exit
+TRACE_ENV = 'COMMAND_TRACE'
+
+logger = logging.getLogger('commands')
+
+Result = namedtuple('Result', 'argv returncode stdout stderr')
+# one traced call, start is the wall clock time and returncode is None when the command could not be started
+Call = namedtuple('Call', 'argv start duration returncode stdout_size stderr_size timed_out reused')
+
+
+class CommandRunner:
+    """Runs commands, remembers their results for reuse and keeps the trace of every call."""
+
+    def __init__(self, kill_after=KILL_AFTER, slow=SLOW_CALL):
+        self.kill_after = kill_after
+        self.slow = slow
+        self.lock = threading.Lock()
+        self.results = {}
+        self.calls = []
+
+    def run(self, argv, timeout=None, check=False, stdout=PIPE, stderr=DEVNULL, text=True, cwd=None, reuse=False):
+        """
+        Run argv and return a Result, like subprocess.run without a shell.
+
+        stdout and stderr take PIPE, DEVNULL, STDOUT or None to inherit, and are None in the Result unless piped.
+        Raises subprocess.TimeoutExpired once a command that ran past timeout has been stopped,
+        subprocess.CalledProcessError for a non-zero exit when check is set, and FileNotFoundError when the command
+        does not exist. With reuse set, an identical call earlier in the run is answered from its result; calls that
+        failed to start or timed out are not remembered.
+        """
+        argv = [os.fspath(arg) for arg in argv]
+        key = (tuple(argv), stdout, stderr, text, cwd)
+        with self.lock:
+            pending = self.results.get(key) if reuse else None
+            owner = pending is None
+            if owner:
+                pending = self.results[key] = Future()
+        if owner:
+            try:
+                result = self.execute(argv, timeout, stdout, stderr, text, cwd)
+            except BaseException as e:
+                with self.lock:
+                    if self.results.get(key) is pending:
+                        del self.results[key]
+                pending.set_exception(e)
+                raise
+            pending.set_result(result)
+        else:
+            start = time.perf_counter()
+            try:
+                result = pending.result()
+            finally:
+                self.record(argv, time.time(), time.perf_counter() - start, pending, reused=True)
+        if check and result.returncode != 0:
+            raise subprocess.CalledProcessError(result.returncode, argv, result.stdout, result.stderr)
+        return result
+
+    def execute(self, argv, timeout, stdout, stderr, text, cwd):
+        started = time.time()
+        start = time.perf_counter()
+        outcome = Future()
+        try:
+            # a session of its own, so a timeout reaches everything the command started
+            with subprocess.Popen(argv, stdin=DEVNULL, stdout=stdout, stderr=stderr, text=text, cwd=cwd,
+                                  start_new_session=True) as process:
+                # the deadline is a timer, communicate(timeout=...) would wait in sleeps of up to 50 ms
+                expired = threading.Event()
+                timer = None
+                if timeout is not None:
+                    timer = threading.Timer(timeout, self.stop, (process, expired))
+                    timer.start()
+                try:
+                    output, errors = process.communicate()
+                except BaseException:
+                    # interrupted, the command is in a session of its own and would outlive us
+                    self.stop(process)
+                    raise
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                if expired.is_set():
+                    error = subprocess.TimeoutExpired(argv, timeout, output, errors)
+                    outcome.set_exception(error)
+                    raise error
+                result = Result(argv, process.returncode, output, errors)
+                outcome.set_result(result)
+                return result
+        except BaseException as e:
+            # KeyboardInterrupt and the like too, record() waits for the outcome
+            if not outcome.done():
+                outcome.set_exception(e)
+            raise
+        finally:
+            self.record(argv, started, time.perf_counter() - start, outcome)
+
+    def stream(self, argv, timeout=None, check=False, stderr=DEVNULL, text=True, cwd=None):
+        """
+        Run argv and yield its output line by line as the command writes it, nothing is buffered.
+
+        stderr takes DEVNULL, STDOUT or None to inherit. Once the output ends, raises like run() does: TimeoutExpired
+        when the command was stopped at its deadline and CalledProcessError for a non-zero exit when check is set.
+        Closing the generator before the output ends stops the command.
+        """
+        argv = [os.fspath(arg) for arg in argv]
+        started = time.time()
+        start = time.perf_counter()
+        outcome = Future()
+        size = 0
+        try:
+            with subprocess.Popen(argv, stdin=DEVNULL, stdout=PIPE, stderr=stderr, text=text, cwd=cwd,
+                                  start_new_session=True) as process:
+                expired = threading.Event()
+                timer = None
+                if timeout is not None:
+                    timer = threading.Timer(timeout, self.stop, (process, expired))
+                    timer.start()
+                try:
+                    for line in process.stdout:
+                        size += len(line)
+                        yield line
+                    process.wait()
+                except BaseException:
+                    # interrupted, or the caller stopped reading
+                    self.stop(process)
+                    raise
+                finally:
+                    if timer is not None:
+                        timer.cancel()
+                if expired.is_set():
+                    error = subprocess.TimeoutExpired(argv, timeout)
+                    outcome.set_exception(error)
+                    raise error
+                outcome.set_result(Result(argv, process.returncode, None, None))
+        except BaseException as e:
+            if not outcome.done():
+                outcome.set_exception(e)
+            raise
+        finally:
+            self.record(argv, started, time.perf_counter() - start, outcome, stdout_size=size)
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, argv)
+
+    def stop(self, process, expired=None):
+        # SIGTERM the whole process group at the deadline, then SIGKILL whatever is left after kill_after seconds
+        if expired is not None:
+            expired.set()
+        for signum in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, signum)
+            except ProcessLookupError:
+                return
+            try:
+                process.wait(self.kill_after)
+                return
+            except subprocess.TimeoutExpired:
+                continue
+
+    def record(self, argv, started, duration, outcome, reused=False, stdout_size=None):
+        # stdout_size is given for streamed calls, whose output is not kept
+        error = outcome.exception()
+        result = outcome.result() if error is None else None
+        timed_out = isinstance(error, subprocess.TimeoutExpired)
+        if result is None and timed_out:
+            result = Result(argv, None, error.output, error.stderr)
+        if stdout_size is None:
+            stdout_size = len(result.stdout or '') if result else 0
+        call = Call(argv, started, duration, result and result.returncode,
+                    stdout_size, len(result.stderr or '') if result else 0, timed_out, reused)
+        with self.lock:
+            self.calls.append(call)
+        if duration > self.slow:
+            logger.info('Slow command %s took %.3f s%s', ' '.join(argv), duration, ' and timed out' if timed_out else '')
+        else:
+            logger.debug('Ran %s in %.3f s, exit code %s%s', ' '.join(argv), duration, call.returncode,
+                         ' and timed out' if timed_out else ' (reused)' if reused else '')
+
+    def reset(self):
+        """Forget the results kept for reuse and the trace, starting a new run."""
+        with self.lock:
+            self.results.clear()
+            self.calls.clear()
+
+    def trace(self):
+        with self.lock:
+            return list(self.calls)
+
+    def write_trace(self, path):
+        with open(path, 'a') as f:
+            for call in self.trace():
+                f.write(json.dumps(call._asdict()) + '\n')
+
+    def report(self, file=sys.stderr):
+        # the calls slowest first, then how many processes the run spawned
+        calls = self.trace()
+        for call in sorted(calls, key=attrgetter('duration'), reverse=True):
+            status = ('timed out' if call.timed_out else 'reused' if call.reused else
+                      'not run' if call.returncode is None else f'exit {call.returncode}')
+            print(f'{" ".join(call.argv)[:48]:<48} {call.duration * 1000:>9.1f} ms {status:<10} {call.stdout_size:>8} bytes', file=file)
+        print(f'{"commands spawned":<48} {sum(not call.reused for call in calls):>9}', file=file)
+
+
+runner = CommandRunner()
+
+
+def run(argv, timeout=None, check=False, stdout=PIPE, stderr=DEVNULL, text=True, cwd=None, reuse=False):
+    return runner.run(argv, timeout, check, stdout, stderr, text, cwd, reuse)
+
+
+def stream(argv, timeout=None, check=False, stderr=DEVNULL, text=True, cwd=None):
+    return runner.stream(argv, timeout, check, stderr, text, cwd)
+
+
+def reset():
+    runner.reset()
+
+
+def trace():
+    return runner.trace()
+
+
+def report(file=sys.stderr):
+    runner.report(file)
+
+
+if os.environ.get(TRACE_ENV):
+    atexit.register(runner.write_trace, os.environ[TRACE_ENV])
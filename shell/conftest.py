@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import commands
+
+
+class StubBin:
+    """A directory at the front of PATH for stand-in commands, each logs its arguments to <name>.calls next to itself."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, name, body):
+        # a stand-in command that logs its arguments and runs body, returns the path of its log
+        path = self.path / name
+        path.write_text(f'#!/bin/sh\nprintf "%s\\n" "$*" >> "{self.path}/{name}.calls"\n{body}\n')
+        path.chmod(0o755)
+        return self.path / f'{name}.calls'
+
+    def calls(self, name):
+        # the arguments of every run of name so far
+        log = self.path / f'{name}.calls'
+        return log.read_text().splitlines() if log.exists() else []
+
+
+@pytest.fixture
+def stub_bin(tmp_path, monkeypatch):
+    path = tmp_path / 'bin'
+    path.mkdir()
+    monkeypatch.setenv('PATH', f'{path}{os.pathsep}{os.environ["PATH"]}')
+    commands.reset()
+    return StubBin(path)
@@ -1,25 +1,200 @@
 #!/usr/bin/env python3
+"""
+Keeps the dentry and inode caches in check without dropping the page cache.
+
+Runs resident, sampling /proc/sys/fs/dentry-state, /proc/meminfo, /proc/slabinfo and the memory
+pressure stall information every interval. A reclaim writes 2 to /proc/sys/vm/drop_caches, which
+frees only unused dentries and inodes, and is triggered when:
+    - the dentry count passes --high, re-arming only once it fell below --low again
+    - the count grows faster than --growth-rate per second while above --low
+    - memory pressure passes --pressure while reclaimable slab is above --slab-percent of memory
+Reclaims are at least --cooldown seconds apart, and each one is logged with the counts before and
+after and how long it took. --once checks a single time, as the cron job this replaces did.
+"""
+import argparse
+import logging
 import os
+import time
+from collections import namedtuple
 
-def main():
-    # Get the current size of the dentry cache
-    dentry_cache_size = os.popen("cat /proc/sys/fs/dentry-state | awk '{print $1}'").read()
+from procfs import PROC_ROOT
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('dentry_cleanup')
+
+# thresholds on the dentry count, the old script dropped all caches above HIGH_WATERMARK
+HIGH_WATERMARK = 30000000
+LOW_WATERMARK = 20000000
+# dentries per second, smoothed over a few samples, that count as runaway growth
+GROWTH_RATE = 50000
+GROWTH_SMOOTHING = 0.3
+# memory pressure (PSI "some" avg10, percent) and the share of memory in reclaimable slab that trigger a reclaim
+PRESSURE_LIMIT = 10.0
+SLAB_PERCENT = 20.0
+COOLDOWN = 300
+INTERVAL = 10
+# drop_caches mode that frees reclaimable slab objects, dentries and inodes, but leaves the page cache alone
+DROP_SLAB = '2'
+# slab caches holding dentries and inodes, the filesystem specific inode caches end in _inode_cache or _inode
+SLAB_CACHES = ('dentry', 'inode_cache')
+SLAB_SUFFIXES = ('_inode_cache', '_inode')
+
+Sample = namedtuple('Sample', 'time dentries unused negative mem_total mem_available slab_reclaimable cache_slab_bytes pressure')
+
+
+def read_dentry_state(proc_root=PROC_ROOT):
+    # nr_dentry nr_unused age_limit want_pages nr_negative dummy, nr_negative is 0 before kernel 5.0
+    with open(f'{proc_root}/sys/fs/dentry-state') as f:
+        fields = [int(field) for field in f.read().split()]
+    return fields[0], fields[1], fields[4] if len(fields) > 4 else 0
 
+
+def read_meminfo(proc_root=PROC_ROOT, keys=('MemTotal', 'MemAvailable', 'SReclaimable')):
+    # values in kB
+    values = dict.fromkeys(keys, 0)
+    with open(f'{proc_root}/meminfo') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in values:
+                values[key] = int(value.split()[0])
+    return values
+
+
+def read_cache_slab_bytes(proc_root=PROC_ROOT):
+    """Bytes held by the dentry and inode slab caches, or None when /proc/slabinfo cannot be read (it needs root)."""
+    total = 0
     try:
-        # Convert the size of the dentry cache to an integer
-        dentry_cache_size = int(dentry_cache_size)
-    except ValueError:
-        # If the conversion fails, print an error message and exit
-        print("Failed to convert dentry cache size to integer")
-        exit()
-
-    # If the size of the dentry cache exceeds 30000000, drop it
-    if dentry_cache_size > 30000000:
-        # Call the sync command to flush unwritten data to disk
-        os.system("sync")
-
-        # Drop the dentry cache
-        os.system("echo 3 > /proc/sys/vm/drop_caches")
+        with open(f'{proc_root}/slabinfo') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 3 and (fields[0] in SLAB_CACHES or fields[0].endswith(SLAB_SUFFIXES)):
+                    # name active_objs num_objs objsize ...
+                    total += int(fields[2]) * int(fields[3])
+    except (FileNotFoundError, PermissionError):
+        return None
+    return total
+
+
+def read_pressure(proc_root=PROC_ROOT):
+    """The "some" avg10 of memory pressure in percent, or None on kernels without PSI such as RHEL 7."""
+    try:
+        with open(f'{proc_root}/pressure/memory') as f:
+            for line in f:
+                if line.startswith('some'):
+                    return float(line.split()[1].partition('=')[2])
+    except OSError:
+        return None
+    return None
+
+
+def read_sample(proc_root=PROC_ROOT, clock=time.monotonic):
+    dentries, unused, negative = read_dentry_state(proc_root)
+    meminfo = read_meminfo(proc_root)
+    return Sample(clock(), dentries, unused, negative, meminfo['MemTotal'], meminfo['MemAvailable'],
+                  meminfo['SReclaimable'], read_cache_slab_bytes(proc_root), read_pressure(proc_root))
+
+
+class DentryReclaimer:
+    """Decides from successive samples when to drop the dentry and inode caches, and drops them."""
+
+    def __init__(self, high=HIGH_WATERMARK, low=LOW_WATERMARK, growth_rate=GROWTH_RATE, pressure=PRESSURE_LIMIT,
+                 slab_percent=SLAB_PERCENT, cooldown=COOLDOWN, dry_run=False, proc_root=PROC_ROOT, clock=time.monotonic):
+        self.high = high
+        self.low = low
+        self.growth_rate = growth_rate
+        self.pressure = pressure
+        self.slab_percent = slab_percent
+        self.cooldown = cooldown
+        self.dry_run = dry_run
+        self.proc_root = proc_root
+        self.clock = clock
+        self.armed = True
+        self.rate = 0.0
+        self.previous = None
+        self.last_reclaim = None
+
+    def observe(self, sample):
+        """Feed one sample, returning the reason to reclaim now or None."""
+        if self.previous is not None and sample.time > self.previous.time:
+            rate = (sample.dentries - self.previous.dentries) / (sample.time - self.previous.time)
+            self.rate += GROWTH_SMOOTHING * (rate - self.rate)
+        self.previous = sample
+        if sample.dentries < self.low:
+            self.armed = True
+        if self.last_reclaim is not None and sample.time - self.last_reclaim < self.cooldown:
+            return None
+        if sample.dentries > self.high and self.armed:
+            return f'{sample.dentries} dentries is above {self.high}'
+        if sample.dentries > self.low and self.rate > self.growth_rate:
+            return f'dentries growing by {self.rate:.0f}/s'
+        if (sample.pressure is not None and sample.pressure > self.pressure and sample.dentries > self.low
+                and sample.slab_reclaimable * 100 > self.slab_percent * sample.mem_total):
+            return f'memory pressure {sample.pressure:.1f}% with {sample.slab_reclaimable} kB reclaimable slab'
+        return None
+
+    def reclaim(self, reason):
+        """Drop the dentry and inode caches and log what it freed, returning the sample taken afterwards."""
+        before = self.previous
+        start = time.perf_counter()
+        if not self.dry_run:
+            # dirty inodes cannot be dropped, write them out first
+            os.sync()
+            with open(f'{self.proc_root}/sys/vm/drop_caches', 'w') as f:
+                f.write(DROP_SLAB)
+        elapsed = time.perf_counter() - start
+        after = read_sample(self.proc_root, self.clock)
+        logger.info('%s dentry and inode caches (%s) in %.3f s: dentries %d -> %d, unused %d -> %d, negative %d -> %d, '
+                    'reclaimable slab %d -> %d kB, dentry and inode slab %s -> %s bytes',
+                    'Would drop' if self.dry_run else 'Dropped', reason, elapsed, before.dentries, after.dentries,
+                    before.unused, after.unused, before.negative, after.negative, before.slab_reclaimable,
+                    after.slab_reclaimable, before.cache_slab_bytes, after.cache_slab_bytes)
+        self.last_reclaim = after.time
+        self.armed = after.dentries < self.low
+        # the drop is not growth, start the rate over from the new count
+        self.previous = after
+        self.rate = 0.0
+        return after
+
+    def check(self):
+        reason = self.observe(read_sample(self.proc_root, self.clock))
+        if reason is not None:
+            self.reclaim(reason)
+        return reason
+
+    def run(self, interval=INTERVAL):
+        while True:
+            try:
+                self.check()
+            except (OSError, ValueError, IndexError) as e:
+                logger.error('Failed to check the dentry cache: %s', e)
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drop the dentry and inode caches when they grow too large, leaving the page cache alone")
+    parser.add_argument('--high', type=int, default=HIGH_WATERMARK, help="dentry count that triggers a reclaim")
+    parser.add_argument('--low', type=int, default=LOW_WATERMARK, help="dentry count the cache must fall below before --high triggers again")
+    parser.add_argument('--growth-rate', type=float, default=GROWTH_RATE, help="dentries per second of growth that trigger a reclaim above --low")
+    parser.add_argument('--pressure', type=float, default=PRESSURE_LIMIT, help="memory pressure (PSI some avg10, percent) that triggers a reclaim above --low")
+    parser.add_argument('--slab-percent', type=float, default=SLAB_PERCENT, help="share of memory in reclaimable slab needed for a pressure triggered reclaim")
+    parser.add_argument('--cooldown', type=float, default=COOLDOWN, help="minimum seconds between reclaims")
+    parser.add_argument('--interval', type=float, default=INTERVAL, help="seconds between samples")
+    parser.add_argument('--once', action='store_true', help="check once and exit instead of running resident")
+    parser.add_argument('--dry-run', action='store_true', help="log the reclaims that would happen without dropping anything")
+    parser.add_argument('--proc-root', default=PROC_ROOT, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    reclaimer = DentryReclaimer(args.high, args.low, args.growth_rate, args.pressure, args.slab_percent, args.cooldown,
+                                args.dry_run, args.proc_root)
+    if args.once:
+        try:
+            reclaimer.check()
+        except (OSError, ValueError, IndexError) as e:
+            logger.error('Failed to check the dentry cache: %s', e)
+            exit(1)
+        return
+    reclaimer.run(args.interval)
+
 
 if __name__ == "__main__":
     main()
@@ -1,51 +1,531 @@
 #!/usr/bin/env python3
-import psutil
-import time
+import argparse
+import asyncio
+import json
+import math
+import os
+import re
+import signal
 import statistics
+import sys
+import tempfile
+import time
+from array import array
+
+import numpy as np
+
+from procfs import ProcSampler, build_fake_proc
+
+# variances this small relative to the mean square are float noise from the running sums, not spread
+VARIANCE_EPSILON = 1e-12
+STDEV_EPSILON = math.sqrt(VARIANCE_EPSILON)
+
+# picked up by the node_exporter textfile collector, {name} is the process group
+TEXTFILE = '/var/lib/node_exporter/textfile_collector/gaussian_process_monitor_{name}.prom'
+
+# layout of the persistent history file used by MetricEngine(path=...)
+RING_MAGIC = b'GPMRING1'
+RING_HEADER = np.dtype([('magic', 'S8'), ('window', '<i8'), ('capacity', '<i8'), ('metrics', 'S256')])
+RING_HEADER_SIZE = 4096
+STATE_FILE = '/var/tmp/gaussian_process_monitor.{name}.ring'
+
+# records an in-memory MetricEngine starts with, it doubles them as series arrive up to max_series
+INITIAL_SERIES = 64
+
+# per-process signals scored by MetricEngine; the io and context switch counters are scored as per-tick deltas
+METRICS = ('cpu_percent', 'rss', 'read_bytes', 'write_bytes', 'ctx_switches', 'num_threads')
 
-class Stack:
-    def __init__(self, max_size=120):
-        self.stack = []
+
+class RollingWindow:
+    """Fixed-size ring buffer of samples with O(1) push and z-score.
+
+    Keeps a running sum and sum of squares next to the samples, and re-derives
+    both exactly once per revolution of the ring so rounding drift cannot build up.
+    """
+    __slots__ = ('pid', 'max_size', '_values', '_index', '_count', '_sum', '_sumsq')
+
+    def __init__(self, max_size=120, pid=None):
+        self.pid = pid
         self.max_size = max_size
+        self._values = array('d', bytes(8 * max_size))
+        self._index = 0
+        self._count = 0
+        self._sum = 0.0
+        self._sumsq = 0.0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def stack(self):
+        # samples oldest first, matching the list the old Stack kept
+        if self._count < self.max_size:
+            return self._values[:self._count].tolist()
+        return (self._values[self._index:] + self._values[:self._index]).tolist()
+
+    @property
+    def last(self):
+        return self._values[self._index - 1]
 
     def push(self, item):
-        self.stack.append(item)
-        if len(self.stack) > self.max_size:
-            self.stack.pop(0)
+        item = float(item)
+        index = self._index
+        if self._count < self.max_size:
+            self._count += 1
+            self._sum += item
+            self._sumsq += item * item
+        else:
+            old = self._values[index]
+            self._sum += item - old
+            self._sumsq += item * item - old * old
+        self._values[index] = item
+        index += 1
+        if index == self.max_size:
+            index = 0
+            self._sum = math.fsum(self._values)
+            self._sumsq = math.fsum(value * value for value in self._values)
+        self._index = index
+
+    def mean(self):
+        return self._sum / self._count if self._count else 0.0
 
-    def check_alert(self):
-        if len(self.stack) >= self.max_size:
-            z = self.calculate_zscore(self.stack[-1])
-            if z >= 2:
-                print("ALERT: PID: {}, Z-score is greater than or equal to 2 standard deviations from the mean".format(self.pid))
+    def stdev(self):
+        n = self._count
+        if n < 2:
+            return 0.0
+        variance = (self._sumsq - self._sum * self._sum / n) / (n - 1)
+        if variance <= VARIANCE_EPSILON * (self._sumsq / n):
+            return 0.0
+        return math.sqrt(variance)
 
     def calculate_zscore(self, value):
-        mean = statistics.mean(self.stack)
-        standard_deviation = statistics.stdev(self.stack)
+        standard_deviation = self.stdev()
         if standard_deviation == 0:
             return 0
-        z = (value - mean) / standard_deviation
-        return z
+        return (value - self.mean()) / standard_deviation
+
+    def check_alert(self, threshold=2):
+        if self._count >= self.max_size:
+            z = self.calculate_zscore(self.last)
+            if z >= threshold:
+                print("ALERT: PID: {}, Z-score is greater than or equal to {} standard deviations from the mean".format(self.pid, threshold))
+                return True
+        return False
+
+
+def record_dtype(metrics, window):
+    # one fixed-size record per series; a count of 0 marks a free slot so a zero-filled file or array starts empty
+    return np.dtype([('pid', '<i8'), ('starttime', '<i8'), ('cursor', '<i8'), ('count', '<i8'),
+                     ('values', '<f8', (metrics, window))])
+
+
+def open_ring_file(path, metrics, window, max_series):
+    """Map the fixed-record history file at path, recreating it if it was written with another layout."""
+    dtype = record_dtype(len(metrics), window)
+    expected = (RING_MAGIC, window, max_series, ','.join(metrics).encode())
+    size = RING_HEADER_SIZE + dtype.itemsize * max_series
+    try:
+        header = np.fromfile(path, dtype=RING_HEADER, count=1)
+        reusable = len(header) == 1 and header[0].tolist() == expected and os.path.getsize(path) == size
+    except FileNotFoundError:
+        reusable = False
+    if not reusable:
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(np.array([expected], dtype=RING_HEADER).tobytes())
+            # sparse, only the records that get used take up disk
+            f.truncate(size)
+        os.replace(tmp_path, path)
+    return np.memmap(path, dtype=dtype, mode='r+', offset=RING_HEADER_SIZE, shape=(max_series,))
+
+
+class MetricEngine:
+    """Rolling windows for many processes and metrics held in one series x metrics x window matrix.
+
+    A series is keyed by (pid, starttime) and owns a fixed-size record with its own
+    ring cursor, so a process that skips a tick keeps the same history it would have
+    had as a RollingWindow. update() writes one sample per series and scores every
+    series and metric in a single batched pass. Records of exited processes are
+    recycled through retain(), and at most max_series records exist. In memory the
+    records grow on demand, so a host tracking a few dozen processes holds only a few
+    dozen windows.
+
+    With a path the records live in a memory-mapped file. Samples are written in
+    place, so nothing is serialized per tick, and a restarted monitor reattaches to
+    the windows of processes that are still running instead of refilling them.
+    """
+
+    def __init__(self, window=120, metrics=METRICS, threshold=2, max_series=4096, path=None):
+        self.window = window
+        self.metrics = tuple(metrics)
+        self.threshold = threshold
+        self.max_series = max_series
+        self.dropped = 0
+        if path:
+            records = open_ring_file(path, self.metrics, window, max_series)
+        else:
+            records = np.zeros(min(INITIAL_SERIES, max_series), dtype=record_dtype(len(self.metrics), window))
+        self._bind(records)
+        used = np.flatnonzero(self._count > 0)
+        self._rows = dict(zip(zip(self._pid[used].tolist(), self._starttime[used].tolist()), used.tolist()))
+        in_use = set(self._rows.values())
+        self._free = [row for row in range(len(records) - 1, -1, -1) if row not in in_use]
+
+    def _bind(self, records):
+        self._records = records
+        self._pid = records['pid']
+        self._starttime = records['starttime']
+        self._cursor = records['cursor']
+        self._count = records['count']
+        self._values = records['values']
+
+    def _grow(self):
+        # double the in-memory records, a memory-mapped file is created at max_series and never grows
+        size = len(self._records)
+        if isinstance(self._records, np.memmap) or size >= self.max_series:
+            return False
+        records = np.zeros(min(2 * size, self.max_series), dtype=self._records.dtype)
+        records[:size] = self._records
+        self._bind(records)
+        self._free[:0] = range(len(records) - 1, size - 1, -1)
+        return True
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def keys(self):
+        return list(self._rows)
+
+    def _row(self, key):
+        row = self._rows.get(key)
+        if row is None:
+            if not self._free and not self._grow():
+                return None
+            row = self._free.pop()
+            self._rows[key] = row
+            self._pid[row], self._starttime[row] = key
+        return row
+
+    def flush(self):
+        if isinstance(self._records, np.memmap):
+            self._records.flush()
+
+    def retain(self, live):
+        """Forget every series whose key is not in live, e.g. processes that exited or whose PID was reused."""
+        for key in [key for key in self._rows if key not in live]:
+            row = self._rows.pop(key)
+            self._cursor[row] = 0
+            self._count[row] = 0
+            self._free.append(row)
+
+    def series(self, key, metric='cpu_percent'):
+        row = self._rows[key]
+        count = min(int(self._count[row]), self.window)
+        cursor = int(self._cursor[row])
+        values = self._values[row, self.metrics.index(metric)]
+        if count < self.window:
+            return values[:count].tolist()
+        return np.roll(values, -cursor).tolist()
+
+    def update(self, samples):
+        """Push one sample per series and score them.
+
+        Args:
+            samples (dict): key -> sequence of values in the order of self.metrics
+
+        Returns:
+            Scores: current values, window mean, stdev and z-score for every tracked key in samples
+        """
+        keys = []
+        rows = []
+        for key in samples:
+            row = self._row(key)
+            if row is None:
+                self.dropped += 1
+                continue
+            keys.append(key)
+            rows.append(row)
+        rows = np.array(rows, dtype=np.intp)
+        values = np.array([samples[key] for key in keys], dtype=float).reshape(len(keys), len(self.metrics))
+        cursors = self._cursor[rows]
+        # a fresh row may hold the history of an evicted series until its window fills up again
+        self._values[rows, :, cursors] = values
+        self._cursor[rows] = (cursors + 1) % self.window
+        self._count[rows] += 1
+
+        full = self._count[rows] >= self.window
+        mean = np.full(values.shape, np.nan)
+        standard_deviation = np.full(values.shape, np.nan)
+        zscore = np.full(values.shape, np.nan)
+        if full.any():
+            window = self._values[rows[full]]
+            mean[full] = window.mean(axis=2)
+            standard_deviation[full] = window.std(axis=2, ddof=1)
+            spread = standard_deviation[full] > STDEV_EPSILON * np.abs(mean[full])
+            zscore[full] = np.divide(values[full] - mean[full], standard_deviation[full],
+                                     out=np.zeros_like(mean[full]), where=spread)
+        return Scores(keys, self.metrics, values, mean, standard_deviation, zscore, self.threshold)
+
+
+class Scores:
+    __slots__ = ('keys', 'metrics', 'values', 'mean', 'stdev', 'zscore', 'threshold')
+
+    def __init__(self, keys, metrics, values, mean, stdev, zscore, threshold):
+        self.keys = keys
+        self.metrics = metrics
+        self.values = values
+        self.mean = mean
+        self.stdev = stdev
+        self.zscore = zscore
+        self.threshold = threshold
+
+    def alerts(self):
+        """Yield (key, metric, z) for every full window whose newest sample is at or over the threshold."""
+        with np.errstate(invalid='ignore'):
+            rows, columns = np.nonzero(self.zscore >= self.threshold)
+        for row, column in zip(rows.tolist(), columns.tolist()):
+            yield self.keys[row], self.metrics[column], float(self.zscore[row, column])
+
+    def to_prometheus(self, prefix='process_monitor', labels=''):
+        """Render the current value, and mean, stdev and z-score of full windows, in the Prometheus text format."""
+        lines = []
+        for name, matrix, help_text in (('value', self.values, 'Latest sample'),
+                                        ('mean', self.mean, 'Mean of the rolling window'),
+                                        ('stdev', self.stdev, 'Sample standard deviation of the rolling window'),
+                                        ('zscore', self.zscore, 'Z-score of the latest sample against the rolling window')):
+            metric = '{}_{}'.format(prefix, name)
+            lines.append('# HELP {} {} per monitored process and signal.'.format(metric, help_text))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for row, (pid, starttime) in enumerate(self.keys):
+                for column, signal_name in enumerate(self.metrics):
+                    value = matrix[row, column]
+                    if value == value:
+                        lines.append('{}{{{}pid="{}",starttime="{}",signal="{}"}} {!r}'.format(
+                            metric, labels, pid, starttime, signal_name, float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def write_atomic(path, text):
+    # write next to the target and rename over it so readers such as the node_exporter textfile collector never see a partial file
+    directory, name = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + name + '.', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ProcessGroup:
+    """A set of processes matched on their command line, scored on its own interval, window and threshold."""
+
+    def __init__(self, name, match, interval=30, window=120, threshold=2, regex=False, max_series=4096,
+                 textfile=TEXTFILE, state_file=STATE_FILE):
+        self.name = name
+        self.interval = interval
+        self.matcher = re.compile(match).search if regex else (lambda cmdline: match in cmdline)
+        self.textfile = textfile.format(name=name) if textfile else None
+        self.state_file = state_file.format(name=name) if state_file else None
+        # the collector directory is often missing on a new host, create it once here rather than fail every tick
+        for path in (self.textfile, self.state_file):
+            if path:
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.engine = MetricEngine(window=window, threshold=threshold, max_series=max_series, path=self.state_file)
+        self.dropped = 0
+
+    def score(self, samples):
+        engine = self.engine
+        engine.retain(samples)
+        scores = engine.update(samples)
+        for (pid, _), metric, z in scores.alerts():
+            print("ALERT: group: {}, PID: {}, {} Z-score is greater than or equal to {} standard deviations from the mean".format(
+                self.name, pid, metric, engine.threshold))
+        if engine.dropped > self.dropped:
+            print("WARNING: group {} is tracking the maximum of {} processes, {} samples were not scored".format(
+                self.name, engine.max_series, engine.dropped - self.dropped))
+            self.dropped = engine.dropped
+        if self.textfile:
+            write_atomic(self.textfile, scores.to_prometheus(labels='group="{}",'.format(self.name)))
+        engine.flush()
+
+
+def load_groups(path, textfile=TEXTFILE, state_file=STATE_FILE):
+    """Build the ProcessGroups listed in a JSON config file.
+
+    The file holds {"groups": [{"name": ..., "match": ..., ...}]} where every other key is
+    a ProcessGroup argument, e.g. interval, window, threshold, regex or max_series.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    return [ProcessGroup(**{'textfile': textfile, 'state_file': state_file, **group}) for group in config['groups']]
+
+
+async def run_groups(groups, sampler):
+    """Tick every group on its own interval; the groups due together share one /proc scan.
+
+    Scans and scoring run in worker threads, so a slow /proc read only holds up the
+    groups in that tick. A group whose previous tick is still running skips its turn.
+    """
+    loop = asyncio.get_running_loop()
+    # SIGTERM ends the loop like Ctrl-C does, so monitor_processes can sync the history files
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    busy = set()
+    tasks = set()
+    wake = asyncio.Event()
+
+    async def tick(due):
+        try:
+            samples = await asyncio.to_thread(sampler.sample, [group.name for group in due])
+            await asyncio.to_thread(lambda: [group.score(samples[group.name]) for group in due])
+        except Exception as e:
+            print("ERROR: tick for groups {} failed: {}".format(', '.join(group.name for group in due), e))
+        finally:
+            busy.difference_update(group.name for group in due)
+            wake.set()
+
+    restored = [group for group in groups if len(group.engine)]
+    for group in restored:
+        print("Restored history for {} processes of group {} from {}".format(len(group.engine), group.name, group.state_file))
+    if restored:
+        # reattached to saved windows, take a first reading now so the next tick pushes real deltas instead of zeros
+        await asyncio.to_thread(sampler.sample, [group.name for group in restored])
+    now = loop.time()
+    next_due = {group.name: now + group.interval if group in restored else now for group in groups}
 
-def monitor_processes():
-    all_stacks = {}
     while True:
+        now = loop.time()
+        due = [group for group in groups if next_due[group.name] <= now and group.name not in busy]
+        for group in due:
+            next_due[group.name] += group.interval
+            if next_due[group.name] <= now:
+                # fell behind, drop the missed ticks rather than firing them back to back
+                next_due[group.name] = now + group.interval
+        if due:
+            busy.update(group.name for group in due)
+            task = asyncio.create_task(tick(due))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        waiting = [next_due[group.name] for group in groups if group.name not in busy]
+        timeout = max(0.0, min(waiting) - loop.time()) if waiting else None
+        wake.clear()
+        try:
+            await asyncio.wait_for(wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+def monitor_processes(groups):
+    sampler = ProcSampler({group.name: group.matcher for group in groups})
+    try:
+        asyncio.run(run_groups(groups, sampler))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        for group in groups:
+            group.engine.flush()
+
+
+def benchmark_zscore(pids=500, window=120, ticks=240):
+    """Compare per-PID-per-tick cost of the list/statistics approach, RollingWindow and MetricEngine."""
+    import random
+    rng = random.Random(0)
+    samples = [[round(rng.uniform(0, 100), 1) for _ in range(pids)] for _ in range(ticks)]
+
+    def list_tick(stacks, values):
+        alerts = 0
+        for stack, value in zip(stacks, values):
+            stack.append(value)
+            if len(stack) > window:
+                stack.pop(0)
+            if len(stack) >= window:
+                standard_deviation = statistics.stdev(stack)
+                if standard_deviation and (stack[-1] - statistics.mean(stack)) / standard_deviation >= 2:
+                    alerts += 1
+        return alerts
+
+    def ring_tick(windows, values):
+        alerts = 0
+        for rolling, value in zip(windows, values):
+            rolling.push(value)
+            if len(rolling) >= window and rolling.calculate_zscore(value) >= 2:
+                alerts += 1
+        return alerts
+
+    def engine_tick(engine, values):
+        samples = {(pid, 0): (value,) * len(engine.metrics) for pid, value in enumerate(values)}
+        return sum(1 for _, metric, _ in engine.update(samples).alerts() if metric == engine.metrics[0])
+
+    results = {}
+    for name, tick, series in (('list+statistics', list_tick, [[] for _ in range(pids)]),
+                               ('RollingWindow', ring_tick, [RollingWindow(window) for _ in range(pids)]),
+                               ('MetricEngine x1', engine_tick, MetricEngine(window, metrics=METRICS[:1])),
+                               ('MetricEngine x{}'.format(len(METRICS)), engine_tick, MetricEngine(window))):
+        alerts = 0
+        start = time.perf_counter()
+        for values in samples:
+            alerts += tick(series, values)
+        elapsed = time.perf_counter() - start
+        results[name] = alerts
+        print("{:<18} {:>9.2f} us/pid/tick  {:>8.3f} ms/tick  alerts={}".format(
+            name, elapsed / (pids * ticks) * 1e6, elapsed / ticks * 1e3, alerts))
+    return results
+
+
+def benchmark_sampler(processes=5000, matched=200, ticks=5):
+    """Time one sampling tick of the old psutil.process_iter path against ProcSampler on a synthetic /proc tree."""
+    import psutil
+
+    def psutil_tick():
+        samples = {}
         for proc in psutil.process_iter():
             try:
                 cmdline = ' '.join(proc.cmdline())
                 if 'security_passthrough' in cmdline:
-                    pid = proc.pid
-                    cpu_percent = proc.cpu_percent()
-                    if pid not in all_stacks:
-                        all_stacks[pid] = Stack()
-                        all_stacks[pid].pid = pid
-                    stack = all_stacks[pid]
-                    stack.push(cpu_percent)
-                    stack.check_alert()
+                    samples[proc.pid] = proc.cpu_percent()
             except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
                 pass
-        print("All Stacks: ", [[stack.pid, stack.stack] for stack in all_stacks.values()])
-        time.sleep(30)
+        return samples
+
+    with tempfile.TemporaryDirectory() as proc_root:
+        build_fake_proc(proc_root, processes, matched)
+        psutil.PROCFS_PATH = proc_root
+        sampler = ProcSampler({'security_passthrough': lambda cmdline: 'security_passthrough' in cmdline}, proc_root=proc_root)
+        for name, tick in (('psutil.process_iter', psutil_tick), ('ProcSampler', lambda: sampler.sample()['security_passthrough'])):
+            timings = []
+            for _ in range(ticks):
+                start = time.perf_counter()
+                found = len(tick())
+                timings.append(time.perf_counter() - start)
+            print("{:<20} first tick {:>8.2f} ms  steady tick {:>8.2f} ms  matched={}".format(
+                name, timings[0] * 1e3, statistics.median(timings[1:]) * 1e3, found))
+
 
 if __name__ == "__main__":
-    monitor_processes()
+    parser = argparse.ArgumentParser(description="Alert on processes whose CPU, memory, io or thread usage drifts from their own rolling mean")
+    parser.add_argument('--benchmark', nargs='?', const='zscore', choices=('zscore', 'sampler'),
+                        help="time the rolling z-score per PID per tick, or a sampling tick on a synthetic /proc, and exit")
+    parser.add_argument('--pids', type=int, default=500, help="number of matching PIDs to simulate with --benchmark")
+    parser.add_argument('--config', help="JSON file listing the process groups to monitor, see load_groups()")
+    parser.add_argument('--textfile', default=TEXTFILE, help="Prometheus textfile rewritten every tick, {name} is the group, empty to disable")
+    parser.add_argument('--max-series', type=int, default=4096, help="most processes to keep rolling windows for without --config")
+    parser.add_argument('--state-file', default=STATE_FILE, help="memory-mapped history file kept across restarts, {name} is the group, empty to keep history in memory only")
+    args = parser.parse_args()
+    if args.benchmark == 'zscore':
+        benchmark_zscore(pids=args.pids)
+    elif args.benchmark == 'sampler':
+        benchmark_sampler(matched=args.pids)
+    else:
+        try:
+            if args.config:
+                groups = load_groups(args.config, textfile=args.textfile, state_file=args.state_file)
+            else:
+                groups = [ProcessGroup('security_passthrough', 'security_passthrough', max_series=args.max_series,
+                                       textfile=args.textfile, state_file=args.state_file)]
+        except OSError as e:
+            print("ERROR: cannot set up the textfile or state file directory: {}".format(e))
+            sys.exit(1)
+        monitor_processes(groups)
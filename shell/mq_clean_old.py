@@ -3,8 +3,8 @@
 This script is a utility for managing IBM MQ installations on a machine post MQ upgrade.
 Author: Joe Huck
 """
+import argparse
 import platform
-import re
 import os
 import sys
 import glob
@@ -12,6 +12,9 @@ import fcntl
 import shutil
 import subprocess
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import commands
 
 # Set the logging level (e.g. DEBUG, INFO, WARNING, ERROR)
 logging.basicConfig(level=logging.INFO)
@@ -28,137 +31,207 @@ handler.setFormatter(formatter)
 logger = logging.getLogger(__name__)
 logger.addHandler(handler)
 
-class MQInstallation:
+# seconds dspmqinst and dspmqver may run before they are stopped
+MQ_COMMAND_TIMEOUT = 30
+# the lock file that keeps two runs of this script apart
+LOCK_FILE = os.path.join("/tmp", "lock.txt")
+
+
+class InstallationRecord:
     """
-    This class represents an IBM MQ installation on a machine. It provides methods to get information about the installation, such as its version and installation path.
+    One installation from the dspmqinst output: its name, installation path, version and whether it is the primary installation.
     """
-    def __init__(self, installation):
-        self.installation = installation
+    __slots__ = ('name', 'path', 'version', 'primary')
 
-    def get_dspmqver_version(self):
-        # Run the dspmqver command and return the version of MQ that is installed on the machine
-        process = subprocess.Popen(["dspmqver", "-b", "-f", "2"], stdout=subprocess.PIPE)
-        output, _ = process.communicate()
-        dspmqver_version = output.decode().strip()
-        return dspmqver_version
+    def __init__(self, name, path=None, version=None, primary=None):
+        self.name = name
+        self.path = path
+        self.version = version
+        self.primary = primary
+
+    def __repr__(self):
+        return f"InstallationRecord({self.name!r}, {self.path!r}, {self.version!r}, {self.primary!r})"
 
-    def get_install_path(self):
-        # Run the dspmqinst command with the -n option to get information about the installation
-        process = subprocess.Popen(["dspmqinst", "-n", self.installation], stdout=subprocess.PIPE)
-        output, error = process.communicate()
+
+class InstallationRegistry:
+    """
+    Every MQ installation on the machine, read from a single run of dspmqinst. Lookups are answered from the parsed records,
+    so asking about the primary installation or any other one does not run dspmqinst -n again.
+    """
+    # the dspmqinst fields kept on each record
+    FIELDS = {'InstPath': 'path', 'Version': 'version', 'Primary': 'primary'}
+
+    def __init__(self, records):
+        self.records = {record.name: record for record in records}
+        self._dspmqver_version = None
+
+    @classmethod
+    def load(cls, reuse=True):
+        # Run the dspmqinst command once to get every installation with all of its details
+        try:
+            result = commands.run(["dspmqinst"], MQ_COMMAND_TIMEOUT, reuse=reuse)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error(f"ERROR: Failed to get a list of MQ installations. The dspmqinst command could not be run: {e}")
+            return None
 
         # Check the return code of the dspmqinst command
-        if process.returncode != 0:
-            logger.error(f"Failed to get information about the MQ installation {self.installation}. The dspmqinst command returned a non-zero exit code.")
+        if result.returncode != 0:
+            logger.error("ERROR: Failed to get a list of MQ installations. The dspmqinst command returned a non-zero exit code.")
             return None
 
-        # Split the output into a list of lines
-        lines = output.decode().strip().split('\n')
-
-        # Iterate over the list of lines
-        for line in lines:
-            # Check if the line starts with "InstallPath"
-            if line.startswith("InstPath"):
-                # Split the line into words
-                words = line.split()
-                # The installation path is the second word
-                install_path = words[1]
-                # Return the installation path
-                return install_path
-
-        # If no installation path was found, return None
-        return None
+        return cls(cls.parse(result.stdout))
 
-    def get_dspmqinst_version(self):
-        # Run the dspmqinst command with the -n option to get information about the installation
-        process = subprocess.Popen(["dspmqinst", "-n", self.installation], stdout=subprocess.PIPE)
-        output, error = process.communicate()
+    @classmethod
+    def parse(cls, output):
+        # Each installation is a stanza of "Key: value" lines that starts with InstName
+        records = []
+        for line in output.splitlines():
+            key, _, value = line.partition(':')
+            key = key.strip()
+            if key == 'InstName':
+                records.append(InstallationRecord(value.strip()))
+            elif records and key in cls.FIELDS:
+                setattr(records[-1], cls.FIELDS[key], value.strip() or None)
+        return records
 
-        # Check the return code of the dspmqinst command
-        if process.returncode != 0:
-            logger.error(f"Failed to get information about the MQ installation {self.installation}. The dspmqinst command returned a non-zero exit code.")
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, name):
+        return self.records.get(name)
+
+    @property
+    def primary(self):
+        return next((record for record in self if record.primary == 'Yes'), None)
+
+    def dspmqver_version(self):
+        # dspmqver reports what the primary installation actually runs, it is asked once and remembered
+        if self._dspmqver_version is None:
+            try:
+                output = commands.run(["dspmqver", "-b", "-f", "2"], MQ_COMMAND_TIMEOUT, reuse=True).stdout
+            except (OSError, subprocess.TimeoutExpired) as e:
+                logger.error(f"ERROR: Failed to run dspmqver: {e}")
+                return None
+            self._dspmqver_version = output.strip()
+        return self._dspmqver_version
+
+
+_registry = None
+
+
+def get_registry(refresh=False):
+    """
+    Return the installation registry of this machine, running dspmqinst only the first time or when refresh is set.
+    """
+    global _registry
+    if _registry is None or refresh:
+        _registry = InstallationRegistry.load(reuse=not refresh)
+    return _registry
+
+
+class MQInstallation:
+    """
+    This class represents an IBM MQ installation on a machine. It provides methods to get information about the installation, such as its version and installation path.
+    """
+    def __init__(self, installation, registry=None):
+        self.installation = installation
+        self.registry = registry
+
+    def get_record(self):
+        registry = self.registry if self.registry is not None else get_registry()
+        if registry is None:
             return None
+        record = registry.get(self.installation)
+        if record is None:
+            logger.error(f"Failed to get information about the MQ installation {self.installation}. It is not listed by dspmqinst.")
+        return record
 
-        # Split the output into a list of lines
-        lines = output.decode().strip().split('\n')
-
-        # Iterate over the list of lines
-        for line in lines:
-            # Check if the line starts with "Version"
-            if line.startswith("Version"):
-                # Split the line into words
-                words = line.split()
-                # The version is the second word
-                dspmqinst_version = words[1]
-                # Return the data path
-                return dspmqinst_version
-
-        # If no data path was found, return None
-        return None
+    def get_dspmqver_version(self):
+        # Return the version of MQ that dspmqver reports as installed on the machine
+        registry = self.registry if self.registry is not None else get_registry()
+        return registry.dspmqver_version() if registry is not None else None
+
+    def get_install_path(self):
+        # Return the installation path dspmqinst lists for this installation, or None when it was not found
+        record = self.get_record()
+        return record.path if record is not None else None
 
+    def get_dspmqinst_version(self):
+        # Return the version dspmqinst lists for this installation, or None when it was not found
+        record = self.get_record()
+        return record.version if record is not None else None
 
-def get_installations():
-    # Run the dspmqinst command to get a list of all MQ installations
-    process = subprocess.Popen(["dspmqinst"], stdout=subprocess.PIPE)
-    output, error = process.communicate()
 
-    # Check the return code of the dspmqinst command
-    if process.returncode != 0:
-        logger.error("ERROR: Failed to get a list of MQ installations. The dspmqinst command returned a non-zero exit code.")
+def get_installations(refresh=False):
+    # Get every MQ installation from the registry, keyed by name with its Primary value ('Yes' or 'No')
+    registry = get_registry(refresh)
+    if registry is None:
         return None
+    return {record.name: record.primary for record in registry if record.primary is not None}
+    
 
-    pattern = re.compile(r"^InstName:\s+(.+)$", re.MULTILINE)
-    matches = pattern.findall(output.decode().strip())
+class RPMPackage:
+    """
+    One installed package as reported by rpm --queryformat, str() gives the name-version-release.arch that rpm -qa prints.
+    """
+    __slots__ = ('name', 'version', 'release', 'arch', 'install_time')
 
-    installations = {}
-    for installation in matches:
-        # Run the dspmqinst -n command to get information about the current installation
-        process = subprocess.Popen(["dspmqinst", "-n", installation], stdout=subprocess.PIPE)
-        output, error = process.communicate()
+    def __init__(self, name, version, release, arch, install_time):
+        self.name = name
+        self.version = version
+        self.release = release
+        self.arch = arch
+        self.install_time = install_time
 
-        # Check the return code of the dspmqinst -n command
-        if process.returncode != 0:
-            logger.error(f"ERROR: Failed to get information about MQ installation '{installation}'. The dspmqinst -n command returned a non-zero exit code.")
-            continue
+    def __str__(self):
+        return f"{self.name}-{self.version}-{self.release}.{self.arch}"
 
-        # Check for lines starting with "Primary" in the output
-        for line in output.decode().strip().split("\n"):
-            if line.startswith("Primary"):
-                # Split the line into words
-                words = line.split()
-                # The version is the second word
-                primary_value = words[1]
-                # Add the installation and its primary value to the dictionary
-                installations[installation] = primary_value
-                break
-
-    return installations
-    
+    def __repr__(self):
+        return f"RPMPackage({self.name!r}, {self.version!r}, {self.release!r}, {self.arch!r}, {self.install_time!r})"
 
-def check_installed_mq_packages(rpm_suffix):
-    # Run the rpm command with the -qa option to get a list of all installed packages
-    process = subprocess.Popen(["timeout", "-k", "4", "8s", "rpm", "-qa"], stdout=subprocess.PIPE)
-    output, error = process.communicate()
 
-    # Check the return code of the rpm command 
-    if process.returncode != 0:
-        logger.error("ERROR: Unable to communicate with the RPM database. The rpm command returned a non-zero exit code.")
-        return []
+# seconds rpm may take to list the packages before it is stopped
+RPM_QUERY_TIMEOUT = 8
+# the fields query_packages asks rpm for, one tab separated line per package
+RPM_QUERY_FORMAT = r"%{NAME}\t%{VERSION}\t%{RELEASE}\t%{ARCH}\t%{INSTALLTIME}\n"
 
-    # Split the output into a list of package names
-    packages = output.decode().strip().split('\n')
 
-    # Filter the list of packages to include only those that contain the string "MQSeries"
-    mq_packages = [package for package in packages if "MQSeries" in package]
+def query_packages(pattern, timeout=RPM_QUERY_TIMEOUT):
+    """
+    Yield an RPMPackage for every installed package whose name matches the glob pattern, as rpm prints them.
+
+    rpm does the name filtering itself, so only matching packages are formatted and nothing is buffered. Raises
+    subprocess.CalledProcessError once the output is read when rpm failed, and subprocess.TimeoutExpired when it was
+    stopped after timeout seconds.
+    """
+    command = ["rpm", "-qa", pattern, "--queryformat", RPM_QUERY_FORMAT]
+    for line in commands.stream(command, timeout, check=True):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) == 5:
+            name, version, release, arch, install_time = fields
+            yield RPMPackage(name, version, release, arch, int(install_time) if install_time.isdigit() else None)
 
-    # Initialize a list to store invalid MQ packages
-    invalid_packages = []
 
-    # Iterate over the list of MQ packages and check if each package name contains the RPM suffix
-    for package in mq_packages:
-        if rpm_suffix not in package:
+def check_installed_mq_packages(rpm_suffix):
+    """
+    Return the installed MQSeries packages that do not carry the RPM suffix of the primary installation, or None when
+    the RPM database could not be read, so a failed query is not mistaken for a clean machine.
+    """
+    invalid_packages = []
+    try:
+        for package in query_packages("*MQSeries*"):
             # If the package does not contain the RPM suffix, add it to the list of invalid packages
-            invalid_packages.append(package)
+            if rpm_suffix not in str(package):
+                invalid_packages.append(package)
+    except subprocess.CalledProcessError:
+        logger.error("ERROR: Unable to communicate with the RPM database. The rpm command returned a non-zero exit code.")
+        return None
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error(f"ERROR: Unable to communicate with the RPM database. The rpm command could not be run: {e}")
+        return None
 
     # Return the list of invalid packages
     return invalid_packages
@@ -167,6 +240,10 @@ def check_installed_mq_packages(rpm_suffix):
 #     # Get the list of invalid MQ packages
 #     invalid_packages = check_installed_mq_packages(rpm_suffix)
 
+#     # Stop if the RPM database could not be read
+#     if invalid_packages is None:
+#         return False
+
 #     # Check if there are any invalid packages
 #     if not invalid_packages:
 #         logger.info("No invalid MQ packages found.")
@@ -210,25 +287,136 @@ def check_installed_mq_packages(rpm_suffix):
 #             else:
 #                 logger.info(f"Successfully deleted installation {installation}.")
 
-# def delete_mq_directories(primary_install_path):
-#     # Get a list of all directories starting with "/opt/mq"
-#     directories = glob.glob("/opt/mq*")
+# directories left behind by MQ installations, and how many trees are deleted at once
+MQ_DIRECTORY_PATTERN = "/opt/mq*"
+RECLAIM_WORKERS = 4
+
+
+class TreeUsage:
+    """
+    What deleting one directory tree frees: its files, directories and the bytes they occupy on disk.
+    """
+    __slots__ = ('path', 'installation', 'files', 'directories', 'bytes', 'errors')
+
+    def __init__(self, path, installation=None):
+        self.path = path
+        self.installation = installation
+        self.files = 0
+        self.directories = 0
+        self.bytes = 0
+        self.errors = []
+
+    def __repr__(self):
+        return f"TreeUsage({self.path!r}, files={self.files}, directories={self.directories}, bytes={self.bytes})"
+
+
+def reclaim_tree(path, installation=None, dry_run=True):
+    """
+    Count, and unless dry_run is set delete, everything under path including path itself.
+
+    The tree is walked with os.scandir on directory file descriptors and every stat, unlink and rmdir is relative to
+    the descriptor of its parent, so nothing is looked up by full path twice and symlinks are never followed. A file with
+    several hard links in the tree has its blocks counted once. Errors are recorded on the returned TreeUsage and the rest
+    of the tree is still processed.
+    """
+    usage = TreeUsage(path, installation)
+    # (st_dev, st_ino) of the files with more than one link whose blocks were already counted
+    linked = set()
+    flags = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW
+    try:
+        fd = os.open(path, flags)
+    except OSError as e:
+        usage.errors.append(f"{path}: {e.strerror}")
+        return usage
+
+    def walk(dir_fd, dir_path):
+        with os.scandir(dir_fd) as it:
+            entries = list(it)
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    child_fd = os.open(entry.name, flags, dir_fd=dir_fd)
+                    try:
+                        walk(child_fd, f"{dir_path}/{entry.name}")
+                    finally:
+                        os.close(child_fd)
+                    usage.directories += 1
+                    if not dry_run:
+                        os.rmdir(entry.name, dir_fd=dir_fd)
+                else:
+                    usage.files += 1
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_nlink == 1 or (st.st_dev, st.st_ino) not in linked:
+                        usage.bytes += st.st_blocks * 512
+                        if st.st_nlink > 1:
+                            linked.add((st.st_dev, st.st_ino))
+                    if not dry_run:
+                        os.unlink(entry.name, dir_fd=dir_fd)
+            except OSError as e:
+                usage.errors.append(f"{dir_path}/{entry.name}: {e.strerror}")
+
+    try:
+        walk(fd, path)
+    finally:
+        os.close(fd)
+    usage.directories += 1
+    if not dry_run and not usage.errors:
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            usage.errors.append(f"{path}: {e.strerror}")
+    return usage
 
-#     # Check if the primary installation path is in the list of directories
-#     if primary_install_path in directories:
-#         # If it is, remove it from the list
-#         directories.remove(primary_install_path)
 
-#     # Iterate over the list of directories
-#     for directory in directories:
-#         # Check if the directory exists
-#         if os.path.exists(directory):
-#             # If it does, delete it
-#             shutil.rmtree(directory)
+def find_mq_directories(primary_install_path, pattern=MQ_DIRECTORY_PATTERN):
+    """
+    Return the directories matching pattern that are safe to delete: never the primary installation path, a directory
+    containing it or one inside it, and never a symlink, whatever it points to.
+    """
+    if not primary_install_path:
+        raise ValueError("The primary installation path is required to decide which MQ directories are unused")
+    primary = os.path.realpath(primary_install_path)
+    directories = []
+    for directory in sorted(glob.glob(pattern)):
+        if os.path.islink(directory) or not os.path.isdir(directory):
+            continue
+        real = os.path.realpath(directory)
+        if os.path.commonpath([real, primary]) in (real, primary):
+            continue
+        directories.append(directory)
+    return directories
+
+
+def delete_mq_directories(primary_install_path, dry_run=True, workers=RECLAIM_WORKERS, pattern=MQ_DIRECTORY_PATTERN, registry=None):
+    """
+    Delete every directory matching /opt/mq* except the primary installation, several trees at once.
+
+    With dry_run set nothing is deleted and the returned TreeUsage records say what would be freed.
+    Each record is labelled with the installation whose InstPath it is, when dspmqinst still lists one.
+    """
+    directories = find_mq_directories(primary_install_path, pattern)
+    if not directories:
+        return []
+    if registry is None:
+        registry = get_registry()
+    owners = {os.path.realpath(record.path): record.name for record in registry or () if record.path}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(directories)))) as pool:
+        usages = list(pool.map(lambda directory: reclaim_tree(directory, owners.get(os.path.realpath(directory)), dry_run),
+                               directories))
+    for usage in usages:
+        action = "Would free" if dry_run else "Freed"
+        logger.info(f"{action} {usage.bytes} bytes in {usage.files} files and {usage.directories} directories under "
+                    f"{usage.path} ({usage.installation or 'no installation'})")
+        for error in usage.errors:
+            logger.error(f"ERROR: Failed to delete {error}")
+    return usages
 
 def main():
-    # Construct the full path to the lock file
-    lock_file_path = os.path.join("/tmp", "lock.txt")
+    parser = argparse.ArgumentParser(description="Report MQ packages and directories left behind by MQ versions other than the primary installation")
+    parser.add_argument('--dry-run', action='store_true', help="walk the unused /opt/mq* directories and report what deleting them would free")
+    args = parser.parse_args()
+
+    lock_file_path = LOCK_FILE
 
     # Check if the lock file exists
     if os.path.exists(lock_file_path):
@@ -258,6 +446,8 @@ def main():
 
             # Get the dictionary of all MQ installations
             installations = get_installations()
+            if installations is None:
+                sys.exit(1)
 
             # Set the primary_installation variable to the key where the value is 'Yes'
             primary_installation_name = next((key for key, value in installations.items() if value == 'Yes'), None)
@@ -268,7 +458,7 @@ def main():
     
 
             # Check if the versions match
-            if primary_dspmqver_version != primary_dspmqinst_version:
+            if primary_dspmqver_version is None or primary_dspmqver_version != primary_dspmqinst_version:
                 logger.error("ERROR: The version of MQ reported by dspmqver does not match the version of the primary MQ installation in dspmqinst")
                 sys.exit(1)
 
@@ -287,17 +477,30 @@ def main():
             major_version = float(major_version)
             # Check if the major version is greater than or equal to 9
             if major_version < 9:
-                logger.error(f"ERROR:The MQ installation {installation} has a version ({version}) that is less than 9.0. Exiting.")
-            sys.exit(1)
+                logger.error(f"ERROR:The MQ installation {primary_installation_name} has a version ({primary_dspmqver_version}) that is less than 9.0. Exiting.")
+                sys.exit(1)
 
-            check_installed_mq_packages(rpm_suffix)
+            invalid_packages = check_installed_mq_packages(rpm_suffix)
+            if invalid_packages is None:
+                sys.exit(1)
+            for package in invalid_packages:
+                logger.info(f"Invalid MQ package: {package}")
 
             # remove_invalid_mq_packages(rpm_suffix)
 
             # delete_unused_installations(installations)
 
+            if args.dry_run:
+                # Report what deleting all directories matching /opt/mq* except for the primary installation would free
+                try:
+                    delete_mq_directories(primary_install_path, dry_run=True, pattern=MQ_DIRECTORY_PATTERN)
+                except ValueError as e:
+                    # dspmqinst listed the primary installation without an InstPath
+                    logger.error(f"ERROR: {e}. The primary installation {primary_installation_name} has no InstPath.")
+                    sys.exit(1)
+
             # Delete all directories matching /opt/mq* except for those owned by the primary installation 
-            # delete_mq_directories(primary_install_path)
+            # delete_mq_directories(primary_install_path, dry_run=False)
 
     finally:
         # Remove the lock file if it exists
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Readers for /proc that replace per-tick psutil and ps scans in the monitoring scripts.
+Every function takes a proc_root so the same code can be pointed at a fixture tree.
+"""
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+PROC_ROOT = '/proc'
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# errors that mean the process went away or is not ours to read, skip it and move on
+PROCESS_GONE = (FileNotFoundError, ProcessLookupError, PermissionError)
+
+
+class ProcStat:
+    __slots__ = ('pid', 'comm', 'state', 'utime', 'stime', 'num_threads', 'starttime', 'rss')
+
+    def __init__(self, pid, line):
+        # comm is wrapped in parentheses and may itself contain spaces or ')'
+        head, _, tail = line.rpartition(')')
+        fields = tail.split()
+        self.pid = pid
+        self.comm = head.partition('(')[2]
+        self.state = fields[0]
+        self.utime = int(fields[11])
+        self.stime = int(fields[12])
+        self.num_threads = int(fields[17])
+        self.starttime = int(fields[19])
+        self.rss = int(fields[21]) * PAGE_SIZE
+
+
+def pid_path(pid, name, proc_root=PROC_ROOT):
+    return f'{proc_root}/{pid}/{name}'
+
+
+def read_stat(pid, proc_root=PROC_ROOT):
+    with open(pid_path(pid, 'stat', proc_root)) as f:
+        return ProcStat(pid, f.read())
+
+
+def read_cmdline(pid, proc_root=PROC_ROOT):
+    # arguments are NUL separated with a trailing NUL, join them the way psutil callers did with ' '.join
+    with open(pid_path(pid, 'cmdline', proc_root), 'rb') as f:
+        raw = f.read()
+    return raw.rstrip(b'\0').replace(b'\0', b' ').decode(errors='replace')
+
+
+def find_process(pattern, proc_root=PROC_ROOT):
+    """Return the first PID whose command line matches the regex pattern, like `pgrep -f`, or None.
+
+    Stops at the first match. Processes without a command line, such as kernel
+    threads, are matched on their name as pgrep does, and this process never matches.
+    """
+    search = re.compile(pattern).search
+    own_pid = os.getpid()
+    with os.scandir(proc_root) as entries:
+        for entry in entries:
+            if not entry.name.isdigit():
+                continue
+            pid = int(entry.name)
+            if pid == own_pid:
+                continue
+            try:
+                cmdline = read_cmdline(pid, proc_root)
+                if not cmdline:
+                    with open(pid_path(pid, 'comm', proc_root)) as f:
+                        cmdline = f.read().rstrip('\n')
+            except PROCESS_GONE:
+                continue
+            if search(cmdline):
+                return pid
+    return None
+
+
+def find_processes_by_name(names, proc_root=PROC_ROOT):
+    """Return {pid: name} for every process whose comm or executable basename is exactly one of names.
+
+    Unlike a substring search of ps output, an argument or path that merely contains
+    a name does not match, and neither does this process.
+    """
+    names = frozenset(names)
+    own_pid = os.getpid()
+    found = {}
+    with os.scandir(proc_root) as entries:
+        for entry in entries:
+            if not entry.name.isdigit() or int(entry.name) == own_pid:
+                continue
+            pid = int(entry.name)
+            try:
+                with open(pid_path(pid, 'comm', proc_root)) as f:
+                    comm = f.read().rstrip('\n')
+                if comm in names:
+                    found[pid] = comm
+                    continue
+                exe = os.path.basename(os.readlink(pid_path(pid, 'exe', proc_root)))
+            except OSError:
+                # the process went away, or it is a kernel thread without an exe
+                continue
+            if exe in names:
+                found[pid] = exe
+    return found
+
+
+def find_open_file(path, proc_root=PROC_ROOT, workers=8):
+    """Return (pid, target) for the first open file descriptor on path or anything under it, or None.
+
+    /proc/<pid>/fd of all processes is read on a pool of workers threads, and the
+    search stops as soon as one worker finds a match. Only readlink is needed per
+    descriptor, unlike lsof, which also stats every open file.
+    """
+    prefix = path.rstrip('/') + '/'
+    own_pid = os.getpid()
+    with os.scandir(proc_root) as entries:
+        pids = [int(entry.name) for entry in entries if entry.name.isdigit() and int(entry.name) != own_pid]
+    found = threading.Event()
+    result = []
+
+    def scan(chunk):
+        for pid in chunk:
+            if found.is_set():
+                return
+            fd_dir = pid_path(pid, 'fd', proc_root)
+            try:
+                with os.scandir(fd_dir) as fds:
+                    for fd in fds:
+                        try:
+                            target = os.readlink(f'{fd_dir}/{fd.name}')
+                        except PROCESS_GONE:
+                            continue
+                        if target == path or target.startswith(prefix):
+                            result.append((pid, target))
+                            found.set()
+                            return
+            except PROCESS_GONE:
+                continue
+
+    # small chunks, so a match stops the other workers after a few more processes at most
+    chunk_size = max(1, min(64, len(pids) // (workers * 4)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for _ in pool.map(scan, (pids[i:i + chunk_size] for i in range(0, len(pids), chunk_size))):
+            if found.is_set():
+                break
+    return result[0] if result else None
+
+
+def read_keyed(pid, name, keys, proc_root=PROC_ROOT):
+    """Read the integer values of a few 'key: value' lines from /proc/<pid>/status or /proc/<pid>/io."""
+    values = dict.fromkeys(keys, 0)
+    with open(pid_path(pid, name, proc_root)) as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            if key in values:
+                values[key] = int(value.split()[0])
+    return values
+
+
+class ProcSampler:
+    """Samples the processes of one or more groups, each matched on its command line, without psutil.
+
+    The match decision for each PID is cached with the /proc/<pid> inode and the
+    process starttime. The inode comes for free from the directory scan, so only
+    PIDs that are new, or whose directory was recreated for a reused PID, get
+    their cmdline read again. Matched PIDs then have stat, status and io read once
+    per call no matter how many groups they belong to, and a changed starttime
+    drops the PID's cached state.
+
+    Counter deltas are tracked per group, so groups sampled on different intervals
+    can share one sampler. Calls for disjoint sets of groups may run in parallel
+    threads; a group must not be sampled by two threads at once.
+    """
+
+    def __init__(self, matchers, proc_root=PROC_ROOT, clock=time.monotonic):
+        """
+        Args:
+            matchers (dict): group name -> callable taking the ' '-joined cmdline and returning True on a match
+        """
+        self.matchers = dict(matchers)
+        self.proc_root = proc_root
+        self.clock = clock
+        self._seen = {}
+        self._last = {name: {} for name in self.matchers}
+
+    def scan(self):
+        """Return {pid: names of matching groups}, reading cmdline only for PIDs not seen before."""
+        previous = self._seen
+        seen = {}
+        matched = {}
+        with os.scandir(self.proc_root) as entries:
+            for entry in entries:
+                if not entry.name.isdigit():
+                    continue
+                pid = int(entry.name)
+                try:
+                    inode = entry.inode()
+                    cached = previous.get(pid)
+                    if cached is None or cached[0] != inode:
+                        starttime = read_stat(pid, self.proc_root).starttime
+                        cmdline = read_cmdline(pid, self.proc_root)
+                        cached = (inode, starttime, tuple(name for name, match in self.matchers.items() if match(cmdline)))
+                except PROCESS_GONE:
+                    continue
+                seen[pid] = cached
+                if cached[2]:
+                    matched[pid] = cached[2]
+        self._seen = seen
+        return matched
+
+    def sample(self, names=None):
+        """Return {group name: {(pid, starttime): (cpu_percent, rss, read_bytes, write_bytes, ctx_switches, num_threads)}}.
+
+        cpu_percent is computed from the utime + stime delta like psutil's cpu_percent(), and
+        the io and context switch counters are deltas since the group's previous sample of that
+        process. The first sample of a process in a group reports 0 for all of them.
+        """
+        names = tuple(self.matchers) if names is None else tuple(names)
+        wanted = frozenset(names)
+        now = self.clock()
+        samples = {name: {} for name in names}
+        last = {name: {} for name in names}
+        for pid, groups in self.scan().items():
+            groups = [name for name in groups if name in wanted]
+            if not groups:
+                continue
+            try:
+                stat = read_stat(pid, self.proc_root)
+                status = read_keyed(pid, 'status', ('voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches'), self.proc_root)
+                try:
+                    io = read_keyed(pid, 'io', ('read_bytes', 'write_bytes'), self.proc_root)
+                except PermissionError:
+                    io = {'read_bytes': 0, 'write_bytes': 0}
+            except PROCESS_GONE:
+                continue
+            cached = self._seen.get(pid)
+            if cached is None or stat.starttime != cached[1]:
+                # the PID was reused between the scan and now, look at it fresh next tick
+                self._seen.pop(pid, None)
+                continue
+            key = (pid, stat.starttime)
+            counters = (stat.utime + stat.stime, io['read_bytes'], io['write_bytes'],
+                        status['voluntary_ctxt_switches'] + status['nonvoluntary_ctxt_switches'])
+            for name in groups:
+                previous = self._last[name].get(key)
+                last[name][key] = (now, counters)
+                if previous is None:
+                    cpu_percent, read_bytes, write_bytes, ctx_switches = 0.0, 0, 0, 0
+                else:
+                    elapsed = now - previous[0]
+                    before = previous[1]
+                    cpu_percent = (counters[0] - before[0]) / CLOCK_TICKS / elapsed * 100 if elapsed > 0 else 0.0
+                    read_bytes = counters[1] - before[1]
+                    write_bytes = counters[2] - before[2]
+                    ctx_switches = counters[3] - before[3]
+                samples[name][key] = (round(cpu_percent, 1), stat.rss, read_bytes, write_bytes, ctx_switches, stat.num_threads)
+        self._last.update(last)
+        return samples
+
+
+def build_fake_proc(proc_root, processes, matched=0, pattern='security_passthrough', first_pid=1000):
+    """Write a synthetic /proc tree with enough of stat, cmdline, status and io for psutil and ProcSampler.
+
+    The first `matched` processes get `pattern` in their command line.
+    """
+    os.makedirs(proc_root, exist_ok=True)
+    with open(os.path.join(proc_root, 'stat'), 'w') as f:
+        f.write('cpu  100 0 100 1000 0 0 0 0 0 0\nbtime {}\n'.format(int(time.time()) - 86400))
+    for i in range(processes):
+        pid = first_pid + i
+        write_fake_process(proc_root, pid, 'java' if i < matched else 'worker',
+                           ['/usr/bin/java', '-Dname={}'.format(pattern if i < matched else 'other'), str(pid)])
+
+
+def write_fake_process(proc_root, pid, comm, argv, starttime=12345, utime=0, stime=0, threads=4, uid=0, exe=None, fds=()):
+    path = os.path.join(proc_root, str(pid))
+    os.makedirs(path, exist_ok=True)
+    fields = ['0'] * 49
+    fields[0] = 'S'
+    fields[1:4] = ['1', str(pid), str(pid)]
+    fields[11], fields[12], fields[17], fields[19], fields[21] = str(utime), str(stime), str(threads), str(starttime), '2048'
+    with open(os.path.join(path, 'stat'), 'w') as f:
+        f.write('{} ({}) {}\n'.format(pid, comm, ' '.join(fields)))
+    with open(os.path.join(path, 'cmdline'), 'wb') as f:
+        f.write(b'\0'.join(arg.encode() for arg in argv) + b'\0')
+    with open(os.path.join(path, 'comm'), 'w') as f:
+        f.write(comm + '\n')
+    with open(os.path.join(path, 'status'), 'w') as f:
+        f.write('Name:\t{}\nState:\tS (sleeping)\nUid:\t{uid}\t{uid}\t{uid}\t{uid}\nThreads:\t{}\n'
+                'voluntary_ctxt_switches:\t10\nnonvoluntary_ctxt_switches:\t2\n'.format(comm, threads, uid=uid))
+    with open(os.path.join(path, 'io'), 'w') as f:
+        f.write('rchar: 0\nwchar: 0\nread_bytes: 4096\nwrite_bytes: 0\n')
+    if exe is not None:
+        os.symlink(exe, os.path.join(path, 'exe'))
+    # open files are symlinks named by descriptor number, like the real fd directory
+    os.makedirs(os.path.join(path, 'fd'), exist_ok=True)
+    for fd, target in enumerate(fds):
+        os.symlink(target, os.path.join(path, 'fd', str(fd)))
+    return path
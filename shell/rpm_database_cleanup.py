@@ -9,89 +9,431 @@ import platform
 import os
 import sys
 import fcntl
+import ctypes
+import errno
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import shutil
 import subprocess
+import tarfile
+import time
 import datetime 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-def check_rpm():
-    # Run the timeout command with a timeout of 8 seconds and the rpm command
-    process = subprocess.Popen(["timeout", "-k", "4", "8s", "rpm", "-qa"], stdout=subprocess.PIPE)
+import commands
+from procfs import PROC_ROOT, find_open_file, find_processes_by_name
+
+# Set the logging level (e.g. DEBUG, INFO, WARNING, ERROR) and the log format
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# the RPM database and the content addressed backup store under /var/preserve
+RPM_DB_DIR = "/var/lib/rpm"
+BACKUP_STORE = "/var/preserve/rpmdb"
+# snapshots kept by the retention policy, older ones and the objects only they use are pruned
+RETAIN_SNAPSHOTS = 7
+# Berkeley DB environment files are recreated by rpm and removed before a rebuild, they are not backed up
+TRANSIENT_PREFIX = "__db"
+HASH_CHUNK_SIZE = 1024 * 1024
+# objects are compressed in blocks on every core, each block becoming one member of a gzip stream
+COMPRESS_BLOCK_SIZE = 4 * 1024 * 1024
+COMPRESS_LEVEL = 6
+COMPRESS_WORKERS = os.cpu_count() or 1
+# renameat2() flag that swaps two paths in one step
+RENAME_EXCHANGE = 2
+# the health check: capabilities whose providing packages the probe reads, coreutils is also provided by
+# coreutils-single, timeouts in seconds and the last healthy verdict
+HEALTH_SAMPLE_PACKAGES = ("rpm", "bash", "glibc", "coreutils")
+HEALTH_PROBE_TIMEOUT = 4
+HEALTH_VERIFY_TIMEOUT = 8
+HEALTH_STATE_FILE = "/var/tmp/rpm_database_cleanup.health.json"
+RPMDB_VERIFY = "/usr/lib/rpm/rpmdb_verify"
+# process names, matched exactly against comm or the executable, that must not be running during a rebuild
+PACKAGE_MANAGERS = ("rpm", "yum", "dnf", "up2date")
+
+def run_tier(command, timeout):
+    # Run one health check command with a deadline, discarding its output, and return True when it succeeded
     try:
-        # Wait for the process to complete
-        output, _ = process.communicate()
-    except subprocess.TimeoutExpired:
-        # If the process times out, kill it and return False
-        process.kill()
+        result = commands.run(command, timeout, stdout=commands.DEVNULL, reuse=True)
+    except (FileNotFoundError, subprocess.TimeoutExpired):
         return False
+    return result.returncode == 0
 
-    # Check the exit code of the process
-    if process.returncode == 0:
-        # If the exit code is zero, run the rpmdb_verify command
-        result = subprocess.run(["/usr/lib/rpm/rpmdb_verify", "/var/lib/rpm/Packages"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        if result.returncode == 0:
-            # If the command returns a zero exit code, return True
-            return True
-        else:
-            # If the command returns a non-zero exit code, return False
-            return False
-    else:
-        # If the exit code is non-zero, return False
+
+def probe_rpm():
+    # Cheap tier: open the database and read the headers of the packages providing what every system has
+    return run_tier(["rpm", "-q", "--whatprovides"] + list(HEALTH_SAMPLE_PACKAGES), HEALTH_PROBE_TIMEOUT)
+
+
+def verify_rpm(db_dir=RPM_DB_DIR):
+    # Full tier: read every header with rpm -qa, then check the Berkeley DB structure with rpmdb_verify
+    if not run_tier(["rpm", "-qa"], HEALTH_VERIFY_TIMEOUT):
         return False
+    packages = os.path.join(db_dir, "Packages")
+    if not os.path.exists(RPMDB_VERIFY) or not os.path.exists(packages):
+        # sqlite and ndb databases have no Packages file and no rpmdb_verify, rpm -qa alone decides
+        return True
+    return run_tier([RPMDB_VERIFY, packages], HEALTH_VERIFY_TIMEOUT)
+
+
+def db_fingerprint(db_dir=RPM_DB_DIR):
+    # (inode, size, mtime) of every database file, the transient Berkeley DB environment files left out
+    with os.scandir(db_dir) as entries:
+        return {entry.name: stat_fingerprint(entry.stat(follow_symlinks=False)) for entry in entries
+                if not entry.name.startswith(TRANSIENT_PREFIX) and entry.is_file(follow_symlinks=False)}
 
-def backup_rpm_database():
-    # Change to the /var/lib directory
-    os.chdir("/var/lib")
-    # Create the name for the backup file using the current date and time
-    backup_file_name = "rpmdb-" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + ".tar.gz"
-    # Create the full path to the backup file
-    backup_file_path = os.path.join("/var/preserve", backup_file_name)
-    # Run the tar command to create a gzip archive of the rpm directory
-    subprocess.run(["tar", "-zcvf", backup_file_path, "rpm"])
-
-def restore_rpm_database(backup_file_path):
+
+def check_rpm_tiers(db_dir=RPM_DB_DIR, state_file=HEALTH_STATE_FILE):
+    """
+    Decide whether the RPM database is healthy and return (healthy, [(tier, passed, seconds), ...]).
+
+    The probe tier always runs. The full verify runs only when the probe fails or the database files changed since
+    the last healthy verdict recorded in state_file, otherwise it is reported with passed None. A healthy full verify
+    is recorded for the next run.
+    """
+    timings = []
+
+    def timed(tier, check, *args):
+        start = time.perf_counter()
+        passed = check(*args)
+        timings.append((tier, passed, time.perf_counter() - start))
+        return passed
+
+    probed = timed("probe", probe_rpm)
+    try:
+        fingerprint = db_fingerprint(db_dir)
+    except OSError:
+        fingerprint = None
     try:
-        # Extract the contents of the backup file to the RPM database directory
-        subprocess.run(["tar", "-zxvf", backup_file_path, "-C", "/var/lib"])
+        with open(state_file) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        cached = None
+    if probed and fingerprint is not None and cached is not None and cached.get("fingerprint") == fingerprint:
+        timings.append(("verify", None, 0.0))
+        return True, timings
 
-        # Reset the SELinux attributes on the restored RPM database files
-        subprocess.run(["restorecon", "-v", "/var/lib/rpm/*"])
+    healthy = timed("verify", verify_rpm, db_dir)
+    if healthy and fingerprint is not None:
+        verdict = {"fingerprint": fingerprint, "checked": datetime.datetime.now().isoformat()}
+        try:
+            write_atomic(state_file, lambda f: f.write(json.dumps(verdict).encode()))
+        except OSError as e:
+            logging.error("Could not record the RPM health verdict in %s: %s", state_file, e)
+    elif not healthy and os.path.exists(state_file):
+        os.remove(state_file)
+    return healthy, timings
+
+
+def check_rpm(db_dir=RPM_DB_DIR, state_file=HEALTH_STATE_FILE):
+    # Run the tiered health check, log how long each tier took and return True when the database is healthy
+    healthy, timings = check_rpm_tiers(db_dir, state_file)
+    for tier, passed, seconds in timings:
+        if passed is None:
+            logging.info("RPM health %s: skipped, the database is unchanged since the last healthy verify", tier)
+        else:
+            logging.info("RPM health %s: %s in %.3f s", tier, "passed" if passed else "failed", seconds)
+    return healthy
+
+def stat_fingerprint(st):
+    # what is compared to decide a file did not change since the last snapshot without reading it
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def object_path(store, sha256):
+    return os.path.join(store, "objects", sha256[:2], sha256[2:] + ".gz")
+
+
+def write_atomic(path, write):
+    # write to a temporary file next to path and rename it into place, so a crash never leaves half a file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def list_snapshots(store=BACKUP_STORE):
+    # snapshot manifests, oldest first, their names sort by the time they were taken
+    snapshot_dir = os.path.join(store, "snapshots")
+    if not os.path.isdir(snapshot_dir):
+        return []
+    return sorted(os.path.join(snapshot_dir, name) for name in os.listdir(snapshot_dir) if name.endswith(".json"))
+
+
+def load_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compress_stream(src, dst, workers=COMPRESS_WORKERS, level=COMPRESS_LEVEL, block_size=COMPRESS_BLOCK_SIZE):
+    """
+    Gzip src into dst as a multi-member stream, compressing up to workers blocks at once, and return the sha256 of
+    the uncompressed data. Any gzip reader, including gzip -d and zcat, reads the members back as one file.
+    """
+    digest = hashlib.sha256()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for block in iter(lambda: src.read(block_size), b""):
+            digest.update(block)
+            # zlib and hashlib release the GIL, so the blocks really are compressed in parallel
+            pending.append(pool.submit(gzip.compress, block, level, mtime=0))
+            if len(pending) > 2 * workers:
+                dst.write(pending.popleft().result())
+        while pending:
+            dst.write(pending.popleft().result())
+    return digest.hexdigest()
+
+
+def store_file(store, source):
+    """
+    Compress source into the store and return (sha256, stored). Objects are named by the sha256 of their content,
+    which is computed while compressing, and content already in the store is never written twice.
+    """
+    tmp_path = os.path.join(store, "objects", f"incoming.{os.getpid()}")
+    os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+    try:
+        with open(source, "rb") as src, open(tmp_path, "wb") as dst:
+            sha256 = compress_stream(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        path = object_path(store, sha256)
+        if os.path.exists(path):
+            return sha256, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.rename(tmp_path, path)
+        return sha256, True
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def backup_rpm_database(db_dir=RPM_DB_DIR, store=BACKUP_STORE, retain=RETAIN_SNAPSHOTS):
+    """
+    Take a snapshot of the RPM database into the backup store and return the path of its manifest.
+
+    Files whose inode, size and mtime match the latest snapshot are not read again, and when nothing changed no new
+    snapshot is written and the latest manifest is returned. Changed files are compressed on all cores and stored
+    under their sha256, so content already in the store takes no extra space. Returns None when the backup failed.
+    """
+    snapshots = list_snapshots(store)
+    previous = load_manifest(snapshots[-1])["files"] if snapshots else {}
+    files = {}
+    stored = 0
+    try:
+        with os.scandir(db_dir) as entries:
+            for entry in sorted(entries, key=lambda entry: entry.name):
+                if entry.name.startswith(TRANSIENT_PREFIX) or not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                fingerprint = stat_fingerprint(st)
+                known = previous.get(entry.name)
+                if known is not None and known["stat"] == fingerprint and os.path.exists(object_path(store, known["sha256"])):
+                    files[entry.name] = known
+                    continue
+                sha256, new = store_file(store, entry.path)
+                stored += new
+                files[entry.name] = {"sha256": sha256, "size": st.st_size, "mode": st.st_mode & 0o7777,
+                                     "uid": st.st_uid, "gid": st.st_gid, "stat": fingerprint}
+    except OSError as e:
+        logging.error("An error occurred while backing up the RPM database: %s", e)
+        return None
+
+    if snapshots and files == previous:
+        logging.info("The RPM database has not changed since %s, no backup taken", snapshots[-1])
+        return snapshots[-1]
+
+    name = "rpmdb-" + datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f") + ".json"
+    manifest_path = os.path.join(store, "snapshots", name)
+    manifest = {"created": datetime.datetime.now().isoformat(), "source": db_dir, "files": files}
+    write_atomic(manifest_path, lambda f: f.write(json.dumps(manifest, indent=1, sort_keys=True).encode()))
+    logging.info("Backed up the RPM database to %s, %d of %d files stored", manifest_path, stored, len(files))
+    prune_snapshots(store, retain)
+    return manifest_path
+
+
+def prune_snapshots(store=BACKUP_STORE, retain=RETAIN_SNAPSHOTS):
+    """
+    Delete all but the newest retain snapshots, then every object no remaining snapshot refers to.
+    """
+    snapshots = list_snapshots(store)
+    for path in snapshots[:-retain]:
+        os.remove(path)
+    referenced = set()
+    for path in list_snapshots(store):
+        referenced.update(object_path(store, entry["sha256"]) for entry in load_manifest(path)["files"].values())
+    object_dir = os.path.join(store, "objects")
+    if not os.path.isdir(object_dir):
+        return
+    with os.scandir(object_dir) as prefixes:
+        for prefix in prefixes:
+            with os.scandir(prefix.path) as objects:
+                for entry in objects:
+                    if entry.path not in referenced and entry.name.endswith(".gz"):
+                        os.remove(entry.path)
+
+def extract_object(path, target, sha256, size, mode):
+    # Decompress one stored object into target, checking its sha256 and size as the data is written
+    digest = hashlib.sha256()
+    written = 0
+    with gzip.open(path, "rb") as src, open(target, "wb") as dst:
+        for chunk in iter(lambda: src.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            written += len(chunk)
+            dst.write(chunk)
+        dst.flush()
+        os.fsync(dst.fileno())
+    if digest.hexdigest() != sha256 or written != size:
+        raise ValueError(f"{target} does not match its checksum in the backup")
+    os.chmod(target, mode)
+
+
+def stage_snapshot(manifest_path, staging_dir, workers=COMPRESS_WORKERS):
+    # Extract every file of a snapshot into staging_dir, several files at once, and verify each of them
+    store = os.path.dirname(os.path.dirname(manifest_path))
+    files = load_manifest(manifest_path)["files"]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(extract_object, object_path(store, entry["sha256"]), os.path.join(staging_dir, name),
+                               entry["sha256"], entry["size"], entry["mode"]) for name, entry in files.items()]
+        for future in futures:
+            future.result()
+    for name, entry in files.items():
+        if "uid" in entry:
+            os.chown(os.path.join(staging_dir, name), entry["uid"], entry["gid"])
+
+
+def stage_tar(backup_file_path, staging_dir):
+    # Stream the rpm/ directory of a tar backup into staging_dir, gzip checks the CRC of the data as it is read
+    with tarfile.open(backup_file_path, "r|*") as archive:
+        for member in archive:
+            directory, _, name = member.name.partition("/")
+            if directory != "rpm" or not member.isfile() or not name or "/" in name:
+                continue
+            target = os.path.join(staging_dir, name)
+            with archive.extractfile(member) as src, open(target, "wb") as dst:
+                shutil.copyfileobj(src, dst, HASH_CHUNK_SIZE)
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.chmod(target, member.mode & 0o7777)
+            os.chown(target, member.uid, member.gid)
+
+
+def exchange_directories(staging_dir, db_dir):
+    """
+    Put staging_dir in place of db_dir and leave the previous database at staging_dir.
+
+    Uses renameat2(RENAME_EXCHANGE) so there is no moment without a database. Kernels and C libraries
+    without it, such as RHEL 7, get two renames in a row instead.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    renameat2 = getattr(libc, "renameat2", None)
+    if renameat2 is not None:
+        at_fdcwd = -100
+        if renameat2(at_fdcwd, os.fsencode(staging_dir), at_fdcwd, os.fsencode(db_dir), RENAME_EXCHANGE) == 0:
+            return
+        error = ctypes.get_errno()
+        if error not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(error, os.strerror(error), db_dir)
+    previous_dir = staging_dir + ".previous"
+    os.rename(db_dir, previous_dir)
+    os.rename(staging_dir, db_dir)
+    os.rename(previous_dir, staging_dir)
+
+
+def restore_rpm_database(backup_file_path, db_dir=RPM_DB_DIR):
+    """
+    Restore the RPM database from a snapshot manifest or a tar backup and return the directory holding the replaced
+    database, or None when the restore failed.
+
+    The backup is extracted into a staging directory next to db_dir and verified there, then swapped in, so the live
+    database is never half written. The replaced database is kept at <db_dir>.pre-restore-<time>.
+    """
+    stamp = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S-%f")
+    staging_dir = f"{db_dir}.pre-restore-{stamp}"
+    try:
+        os.mkdir(staging_dir)
+    except OSError as e:
+        # another restore owns the directory, it is not ours to clean up
+        logging.error("An error occurred while restoring the RPM database: %s", e)
+        return None
+    try:
+        shutil.copymode(db_dir, staging_dir)
+        if backup_file_path.endswith(".json"):
+            # Restore a snapshot manifest from the content addressed backup store
+            stage_snapshot(backup_file_path, staging_dir)
+        else:
+            # Extract the contents of a tar backup file
+            stage_tar(backup_file_path, staging_dir)
+        exchange_directories(staging_dir, db_dir)
     except Exception as e:
-        # If an exception is raised, log an error message
+        # If an exception is raised, log an error message and leave the live database alone
         logging.error("An error occurred while restoring the RPM database: %s", e)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        return None
+
+    try:
+        # Reset the SELinux attributes on the restored RPM database files
+        commands.run(["restorecon", "-R", db_dir], stdout=commands.DEVNULL)
+    except FileNotFoundError:
+        pass
+    logging.info("Restored the RPM database from %s, the previous database is in %s", backup_file_path, staging_dir)
+    return staging_dir
+
+def rebuild_preflight(db_dir=RPM_DB_DIR, proc_root=PROC_ROOT):
+    """
+    Return why the RPM database cannot be rebuilt right now, or None when it can.
+
+    A rebuild must wait while a package manager runs or any process holds a file under db_dir open. Both are checked
+    in /proc rather than with ps and lsof.
+    """
+    # Check if any RPM or package management commands are running
+    running = find_processes_by_name(PACKAGE_MANAGERS, proc_root)
+    if running:
+        pid, name = next(iter(running.items()))
+        return f"an RPM or package management command is running: {name} (pid {pid})"
+
+    # Check if any files in the RPM database directory are open
+    open_file = find_open_file(db_dir, proc_root)
+    if open_file:
+        return f"some RPM database files are open: {open_file[1]} (pid {open_file[0]})"
+    return None
 
 def rebuild_rpm_database():
     try:
-        # Check if any RPM or package management commands are running
-        result = subprocess.run(["ps", "aux"], stdout=subprocess.PIPE)
-        output = result.stdout.decode()
-        if "rpm" in output or "yum" in output or "up2date" in output:
-            # If any RPM or package management commands are running, log an error message and return
-            logging.error("Cannot rebuild RPM database because an RPM or package management command is running")
-            return
-        
-        # Check if any files in the RPM database directory are open
-        result = subprocess.run(["lsof", "+d", "/var/lib/rpm"], stdout=subprocess.PIPE)
-        output = result.stdout.decode()
-        if output:
-            # If any files are open, log an error message and return
-            logging.error("Cannot rebuild RPM database because some RPM database files are open")
+        blocker = rebuild_preflight()
+        if blocker:
+            # If a package manager is running or the database is open, log an error message and return
+            logging.error("Cannot rebuild RPM database because %s", blocker)
             return
 
         # Remove the working RPM database files
-        subprocess.run(["rm", "-f", "/var/lib/rpm/__db*"])
+        for path in glob.glob(os.path.join(RPM_DB_DIR, TRANSIENT_PREFIX + "*")):
+            os.remove(path)
 
         # Validate that there are no corrupt packages
-        os.chdir("/var/lib/rpm")
-        result = subprocess.run(["/usr/lib/rpm/rpmdb_verify", "Packages"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        result = commands.run([RPMDB_VERIFY, "Packages"], stdout=commands.DEVNULL, cwd=RPM_DB_DIR)
         if result.returncode != 0:
             # If the rpmdb_verify command returns a non-zero exit code, log an error message and return
             logging.error("Cannot rebuild RPM database because there are corrupt packages")
             return
 
         # Rebuild the RPM database files
-        subprocess.run(["rpm", "-vv", "--rebuilddb"])
+        commands.run(["rpm", "-vv", "--rebuilddb"], stdout=None, stderr=None)
 
         # Reset the SELinux attributes on the new RPM database files
-        subprocess.run(["restorecon", "-v", "/var/lib/rpm/*"])
+        commands.run(["restorecon", "-v"] + glob.glob(os.path.join(RPM_DB_DIR, "*")), stdout=None, stderr=None)
+    except Exception as e:
+        # If an exception is raised, log an error message
+        logging.error("An error occurred while rebuilding the RPM database: %s", e)
 
 def main():
     # Construct the full path to the lock file
@@ -119,7 +461,9 @@ def main():
                 # If check_rpm() returns False, exit the program with an error code
                 sys.exit(1)
 
-            backup_rpm_database()
+            # Do not rebuild without a backup to restore from
+            if backup_rpm_database() is None:
+                sys.exit(1)
             rebuild_rpm_database()
 
     finally:
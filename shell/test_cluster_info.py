@@ -0,0 +1,95 @@
+import os
+import socketserver
+import stat
+
+import pytest
+
+import cluster_info
+
+
+@pytest.fixture
+def stubs(stub_bin, monkeypatch):
+    monkeypatch.setattr(cluster_info, '_lreg_cache', {})
+    return stub_bin
+
+
+def test_lreg_properties_read_the_key_once(stubs):
+    calls = stubs.write('lreg', 'printf "CoreFSINode = node01\\nHAInterfaceHomeNode = node02\\nHASingleInstList =\\n'
+                                          'Other = x\\n"')
+    properties = cluster_info.get_lreg_properties('prod1', cluster_info.LREG_PROPERTIES)
+    assert properties == {'CoreFSINode': 'node01', 'HAInterfaceHomeNode': 'node02', 'HASingleInstList': ''}
+    assert calls.read_text().splitlines() == ['-p \\cernerha\\prod1\\']
+
+
+def test_lreg_properties_are_memoized_until_refresh(stubs):
+    calls = stubs.write('lreg', 'printf "CoreFSINode = node01\\n"')
+    for refresh in (False, False, True):
+        cluster_info.get_lreg_properties('prod1', ('CoreFSINode',), refresh=refresh)
+    assert len(calls.read_text().splitlines()) == 2
+
+
+def test_lreg_properties_fall_back_to_one_lookup_per_property(stubs):
+    calls = stubs.write('lreg', 'case "$1" in -p) exit 1;; *) printf "%s\\n" "value-of-$3";; esac')
+    properties = cluster_info.get_lreg_properties('prod1', ('CoreFSINode', 'HASingleInstList'))
+    assert properties == {'CoreFSINode': 'value-of-CoreFSINode', 'HASingleInstList': 'value-of-HASingleInstList'}
+    assert sorted(calls.read_text().splitlines()) == ['-getp \\cernerha\\prod1\\ CoreFSINode', '-getp \\cernerha\\prod1\\ HASingleInstList',
+                                                      '-p \\cernerha\\prod1\\']
+
+
+DSPMQ_OUTPUT = '''QMNAME(CERN.NODE01.PROD1)                                 STATUS(Running)
+QMNAME(CERN.NODE02.PROD1)                                 STATUS(Running as standby)
+QMNAME(cern.node03.prod1)                                 STATUS(Ended normally)
+QMNAME(CERN.NODE04.CERT1)                                 STATUS(Running)
+QMNAME(STANDALONE)                                        STATUS(Running)
+AMQ8146E: IBM MQ queue manager not available. prod1'''
+
+
+def test_parse_dspmq_reads_every_queue_manager():
+    queue_managers = cluster_info.parse_dspmq(DSPMQ_OUTPUT)
+    assert [(queue_manager.name, queue_manager.status) for queue_manager in queue_managers] == [
+        ('CERN.NODE01.PROD1', 'Running'), ('CERN.NODE02.PROD1', 'Running as standby'), ('cern.node03.prod1', 'Ended normally'),
+        ('CERN.NODE04.CERT1', 'Running'), ('STANDALONE', 'Running')]
+    assert [queue_manager.node for queue_manager in queue_managers] == ['NODE01', 'NODE02', None, 'NODE04', None]
+
+
+def test_parse_dspmq_with_an_environment_parses_only_its_lines():
+    # matched ignoring case, and a message line that mentions the environment is not a queue manager
+    assert cluster_info.parse_dspmq(DSPMQ_OUTPUT, 'PROD1') == cluster_info.parse_dspmq(DSPMQ_OUTPUT)[:3]
+    assert cluster_info.parse_dspmq(DSPMQ_OUTPUT, 'cert1') == [('CERN.NODE04.CERT1', 'Running')]
+    assert cluster_info.parse_dspmq(DSPMQ_OUTPUT, 'prod2') == []
+    assert cluster_info.parse_dspmq('', 'prod1') == []
+
+
+def test_get_mq_cluster_lists_the_nodes_of_the_environment(stubs):
+    (stubs.path / 'dspmq.out').write_text(DSPMQ_OUTPUT + '\n')
+    stubs.write('dspmq', f'cat "{stubs.path}/dspmq.out"')
+    assert cluster_info.get_mq_cluster('Prod1') == 'node01,node02'
+
+
+def test_lreg_properties_missing_from_the_listing_are_read_one_by_one(stubs):
+    calls = stubs.write('lreg', 'case "$1" in -p) printf "CoreFSINode = node01\\n";; *) printf "%s\\n" "value-of-$3";; esac')
+    properties = cluster_info.get_lreg_properties('prod1', ('CoreFSINode', 'HASingleInstList'))
+    assert properties == {'CoreFSINode': 'node01', 'HASingleInstList': 'value-of-HASingleInstList'}
+    assert calls.read_text().splitlines() == ['-p \\cernerha\\prod1\\', '-getp \\cernerha\\prod1\\ HASingleInstList']
+
+
+def test_lreg_listing_in_another_format_is_not_trusted(stubs):
+    calls = stubs.write('lreg', 'case "$1" in -p) printf "[cernerha\\\\prod1]\\nCoreFSINode = node01\\n";; '
+                                          '*) printf "%s\\n" "value-of-$3";; esac')
+    properties = cluster_info.get_lreg_properties('prod1', ('CoreFSINode',))
+    assert properties == {'CoreFSINode': 'value-of-CoreFSINode'}
+    assert len(calls.read_text().splitlines()) == 2
+
+
+def test_fact_daemon_binds_its_socket_closed_to_other_users(tmp_path):
+    socket_path = tmp_path / 'cluster_info.sock'
+    socket_path.write_text('stale')
+    daemon = cluster_info.FactDaemon('prod1', socket_path=str(socket_path))
+    umask = os.umask(0o022)
+    try:
+        with daemon.bind(socketserver.BaseRequestHandler):
+            assert stat.S_ISSOCK(socket_path.stat().st_mode)
+            assert stat.S_IMODE(socket_path.stat().st_mode) == 0o600
+        assert os.umask(umask) == 0o022
+    finally:
+        os.umask(umask)
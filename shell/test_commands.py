@@ -0,0 +1,95 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+
+import pytest
+
+import commands
+
+
+@pytest.fixture(autouse=True)
+def fresh_trace():
+    commands.reset()
+
+
+def interrupt_after(seconds):
+    # SIGINT to the main thread as Ctrl-C would, _thread.interrupt_main() waits for the blocking read to return
+    timer = threading.Timer(seconds, signal.pthread_kill, (threading.main_thread().ident, signal.SIGINT))
+    timer.start()
+    return timer
+
+
+def test_interrupted_command_is_stopped_and_recorded(tmp_path):
+    pid_file = tmp_path / 'pid'
+    start = time.perf_counter()
+    interrupt_after(0.3)
+    with pytest.raises(KeyboardInterrupt):
+        commands.run(['sh', '-c', f'echo $$ > {pid_file}; exec sleep 10'], reuse=True)
+    assert time.perf_counter() - start < 5
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+    (call,) = commands.trace()
+    assert (call.returncode, call.timed_out, call.reused) == (None, False, False)
+    # nothing is left waiting on the interrupted call, an identical one runs again
+    interrupt_after(0.3)
+    with pytest.raises(KeyboardInterrupt):
+        commands.run(['sh', '-c', f'echo $$ > {pid_file}; exec sleep 10'], reuse=True)
+    assert [call.reused for call in commands.trace()] == [False, False]
+
+
+def test_timeout_stops_the_command():
+    start = time.perf_counter()
+    with pytest.raises(subprocess.TimeoutExpired):
+        commands.run(['sh', '-c', 'echo started; exec sleep 10'], timeout=0.3)
+    assert time.perf_counter() - start < 5
+    (call,) = commands.trace()
+    assert call.timed_out and call.stdout_size == len('started\n')
+
+
+def test_reuse_answers_an_identical_call_from_the_first(tmp_path):
+    runs = tmp_path / 'runs'
+    argv = ['sh', '-c', f'echo run >> {runs}; echo output']
+    results = [commands.run(argv, reuse=True) for _ in range(2)]
+    assert results[0] == results[1] == commands.Result(argv, 0, 'output\n', None)
+    assert runs.read_text() == 'run\n'
+    assert [call.reused for call in commands.trace()] == [False, True]
+
+
+def test_check_and_missing_commands():
+    with pytest.raises(subprocess.CalledProcessError):
+        commands.run(['sh', '-c', 'exit 3'], check=True)
+    with pytest.raises(FileNotFoundError):
+        commands.run(['no-such-command-here'])
+    assert [call.returncode for call in commands.trace()] == [3, None]
+
+
+def test_stream_yields_lines_as_the_command_writes_them():
+    start = time.perf_counter()
+    lines = commands.stream(['sh', '-c', 'echo first; sleep 10; echo second'], timeout=0.5)
+    assert next(lines) == 'first\n'
+    assert time.perf_counter() - start < 0.5
+    with pytest.raises(subprocess.TimeoutExpired):
+        list(lines)
+    (call,) = commands.trace()
+    assert call.timed_out and call.stdout_size == len('first\n')
+
+
+def test_stream_checks_the_exit_code_once_the_output_ends():
+    lines = commands.stream(['sh', '-c', 'echo a; echo b; exit 2'], check=True)
+    assert [next(lines), next(lines)] == ['a\n', 'b\n']
+    with pytest.raises(subprocess.CalledProcessError):
+        next(lines)
+    assert list(commands.stream(['sh', '-c', 'echo a; exit 2'])) == ['a\n']
+    assert [call.returncode for call in commands.trace()] == [2, 2]
+
+
+def test_closing_a_stream_stops_the_command(tmp_path):
+    pid_file = tmp_path / 'pid'
+    lines = commands.stream(['sh', '-c', f'echo $$ > {pid_file}; echo first; exec sleep 10'])
+    assert next(lines) == 'first\n'
+    lines.close()
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+    assert len(commands.trace()) == 1
@@ -0,0 +1,123 @@
+import logging
+
+import pytest
+
+from dentry_cleanup import DentryReclaimer
+
+MEM_TOTAL = 16 * 1024 * 1024
+
+
+class FakeHost:
+    """A /proc tree holding just what DentryReclaimer reads and writes, and the clock it samples on."""
+
+    def __init__(self, root):
+        self.root = root
+        self.now = 1000.0
+        for directory in ('sys/fs', 'sys/vm', 'pressure'):
+            (root / directory).mkdir(parents=True)
+        (root / 'slabinfo').write_text('slabinfo - version: 2.1\ndentry 900 1000 192 21 1\next4_inode_cache 90 100 1024 8 2\n')
+        self.set(0)
+
+    def __call__(self):
+        return self.now
+
+    def set(self, dentries, pressure=None, slab_percent=5):
+        (self.root / 'sys/fs/dentry-state').write_text(f'{dentries} {dentries // 2} 45 0 {dentries // 4} 0\n')
+        slab = MEM_TOTAL * slab_percent // 100
+        (self.root / 'meminfo').write_text(f'MemTotal: {MEM_TOTAL} kB\nMemFree: 1024 kB\nMemAvailable: {MEM_TOTAL // 2} kB\n'
+                                           f'SReclaimable: {slab} kB\n')
+        psi = self.root / 'pressure/memory'
+        if pressure is None:
+            psi.unlink(missing_ok=True)
+        else:
+            psi.write_text(f'some avg10={pressure:.2f} avg60=0.00 avg300=0.00 total=1\n'
+                           'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+
+    def drops(self):
+        # what was written to drop_caches since the last call
+        path = self.root / 'sys/vm/drop_caches'
+        written = path.read_text() if path.exists() else ''
+        path.unlink(missing_ok=True)
+        return written
+
+
+@pytest.fixture
+def host(tmp_path):
+    return FakeHost(tmp_path / 'proc')
+
+
+def reclaimer(host, **options):
+    # the growth and pressure triggers stay out of the way unless a test sets them
+    settings = dict(high=100, low=50, growth_rate=1e9, pressure=10.0, slab_percent=20.0, cooldown=0)
+    settings.update(options)
+    return DentryReclaimer(proc_root=str(host.root), clock=host, **settings)
+
+
+def run(host, reclaimer, dentries, seconds=10, **state):
+    host.now += seconds
+    host.set(dentries, **state)
+    reason = reclaimer.check()
+    return reason, host.drops()
+
+
+def test_high_watermark_fires_once_per_crossing(host):
+    dentry = reclaimer(host)
+    reason, drops = run(host, dentry, 120)
+    assert reason == '120 dentries is above 100' and drops == '2'
+    # the drop did not bring the count below the low watermark, so staying above high does not fire again
+    assert run(host, dentry, 130) == (None, '')
+    assert run(host, dentry, 80) == (None, '')
+    assert run(host, dentry, 40) == (None, '')
+    assert run(host, dentry, 120) == ('120 dentries is above 100', '2')
+
+
+def test_reclaim_that_gets_below_low_rearms_at_once(host):
+    dentry = reclaimer(host)
+    run(host, dentry, 120)
+    host.set(30)
+    dentry.reclaim('test')
+    assert dentry.armed
+    assert run(host, dentry, 120)[0] == '120 dentries is above 100'
+
+
+def test_cooldown_keeps_reclaims_apart(host):
+    dentry = reclaimer(host, cooldown=300)
+    assert run(host, dentry, 120)[1] == '2'
+    assert run(host, dentry, 40) == (None, '')
+    assert run(host, dentry, 120) == (None, '')
+    assert run(host, dentry, 120, seconds=279) == (None, '')
+    assert run(host, dentry, 120, seconds=1)[1] == '2'
+
+
+def test_growth_fires_above_the_low_watermark_only(host):
+    dentry = reclaimer(host, high=10 ** 9, growth_rate=10)
+    # fast growth below the low watermark is left alone
+    assert run(host, dentry, 0) == (None, '')
+    assert run(host, dentry, 40, seconds=1) == (None, '')
+    assert dentry.rate == pytest.approx(12)
+    reason, drops = run(host, dentry, 80, seconds=1)
+    assert reason == 'dentries growing by 20/s' and drops == '2'
+    # the reclaim starts the rate over, so steady growth after it has to build up again
+    assert dentry.rate == 0
+    assert run(host, dentry, 90, seconds=1) == (None, '')
+
+
+def test_pressure_fires_only_with_enough_reclaimable_slab(host):
+    dentry = reclaimer(host)
+    # no PSI on the kernel, high pressure with little slab, and pressure below the limit
+    assert run(host, dentry, 80) == (None, '')
+    assert run(host, dentry, 80, pressure=50.0, slab_percent=5) == (None, '')
+    assert run(host, dentry, 80, pressure=5.0, slab_percent=30) == (None, '')
+    # and below the low watermark pressure is not the dentry cache's doing
+    assert run(host, dentry, 40, pressure=50.0, slab_percent=30) == (None, '')
+    reason, drops = run(host, dentry, 80, pressure=50.0, slab_percent=30)
+    assert reason.startswith('memory pressure 50.0% with ') and drops == '2'
+
+
+def test_dry_run_logs_without_dropping(host, caplog):
+    caplog.set_level(logging.INFO)
+    dentry = reclaimer(host, dry_run=True)
+    assert run(host, dentry, 120) == ('120 dentries is above 100', '')
+    message = caplog.records[-1].getMessage()
+    assert message.startswith('Would drop dentry and inode caches (120 dentries is above 100) in ')
+    assert 'dentries 120 -> 120' in message and 'dentry and inode slab 294400 -> 294400 bytes' in message
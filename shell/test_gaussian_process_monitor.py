@@ -0,0 +1,262 @@
+import asyncio
+import os
+import random
+import shutil
+import statistics
+
+import numpy as np
+import pytest
+
+from gaussian_process_monitor import INITIAL_SERIES, MetricEngine, ProcessGroup, RollingWindow, run_groups
+from procfs import CLOCK_TICKS, PAGE_SIZE, ProcSampler, build_fake_proc, write_fake_process
+
+
+class Stack:
+    # the list-backed window RollingWindow replaced, check_alert returns what it used to print
+    def __init__(self, max_size=120):
+        self.stack = []
+        self.max_size = max_size
+
+    def push(self, item):
+        self.stack.append(item)
+        if len(self.stack) > self.max_size:
+            self.stack.pop(0)
+
+    def check_alert(self):
+        return len(self.stack) >= self.max_size and self.calculate_zscore(self.stack[-1]) >= 2
+
+    def calculate_zscore(self, value):
+        standard_deviation = statistics.stdev(self.stack)
+        if standard_deviation == 0:
+            return 0
+        return (value - statistics.mean(self.stack)) / standard_deviation
+
+
+def cpu_samples(count, seed=0):
+    # mostly steady CPU use with a spike now and then, and a flat stretch where the stdev is 0
+    rng = random.Random(seed)
+    samples = [round(rng.uniform(0, 100) if rng.random() < 0.05 else rng.gauss(20, 2), 1) for _ in range(count)]
+    samples[100:160] = [12.5] * 60
+    return samples
+
+
+def test_rolling_window_alerts_like_the_old_stack(capsys):
+    window, stack = RollingWindow(20, pid=4242), Stack(20)
+    alerts = []
+    for value in cpu_samples(500):
+        window.push(value)
+        stack.push(value)
+        assert window.stack == stack.stack
+        if len(stack.stack) > 1:
+            assert window.calculate_zscore(value) == pytest.approx(stack.calculate_zscore(value), abs=1e-9)
+        alerted = window.check_alert()
+        assert alerted == stack.check_alert()
+        alerts.append(alerted)
+    assert 0 < sum(alerts) < len(alerts)
+    assert capsys.readouterr().out.count('ALERT: PID: 4242,') == sum(alerts)
+
+
+def test_rolling_window_waits_for_a_full_window():
+    window = RollingWindow(3)
+    for value in (1.0, 1.0):
+        window.push(value)
+    window.push(100.0)
+    assert len(window) == 3 and window.check_alert(threshold=1)
+    window = RollingWindow(4)
+    for value in (1.0, 1.0, 100.0):
+        window.push(value)
+    assert not window.check_alert(threshold=1)
+
+
+def test_metric_engine_scores_every_series_like_a_rolling_window():
+    engine = MetricEngine(window=20, metrics=('cpu_percent', 'rss'), threshold=2)
+    windows = {}
+    alerts = 0
+    streams = {(pid, 1): cpu_samples(200, seed=pid) for pid in (100, 101, 102)}
+    for tick in range(200):
+        # pid 102 skips every third tick and keeps its own history
+        samples = {key: (values[tick], values[tick] * 1024) for key, values in streams.items()
+                   if key[0] != 102 or tick % 3}
+        scores = engine.update(samples)
+        expected = set()
+        for row, key in enumerate(scores.keys):
+            window = windows.setdefault(key, RollingWindow(20))
+            window.push(samples[key][0])
+            if len(window) < 20:
+                assert np.isnan(scores.zscore[row]).all()
+                continue
+            assert scores.mean[row, 0] == pytest.approx(window.mean())
+            assert scores.zscore[row, 0] == pytest.approx(window.calculate_zscore(window.last), abs=1e-9)
+            if window.calculate_zscore(window.last) >= 2:
+                expected.update({(key, 'cpu_percent'), (key, 'rss')})
+        assert {(key, metric) for key, metric, z in scores.alerts()} == expected
+        alerts += len(expected)
+    assert alerts
+    assert engine.series((102, 1)) == windows[(102, 1)].stack
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def sampler(tmp_path):
+    # 1000 and 1001 run security_passthrough, 1002 to 1004 do not
+    root = str(tmp_path / 'proc')
+    build_fake_proc(root, 5, matched=2)
+    clock = Clock()
+    return ProcSampler({'passthrough': lambda cmdline: 'security_passthrough' in cmdline}, proc_root=root, clock=clock), clock
+
+
+def reuse_pid(proc_root, pid, comm, argv, starttime):
+    # a new /proc/<pid> directory, written aside first so it cannot get the inode of the one it replaces
+    staging = os.path.join(proc_root, 'new')
+    os.makedirs(staging)
+    write_fake_process(staging, pid, comm, argv, starttime=starttime)
+    shutil.rmtree(os.path.join(proc_root, str(pid)))
+    os.rename(os.path.join(staging, str(pid)), os.path.join(proc_root, str(pid)))
+    os.rmdir(staging)
+
+
+def test_proc_sampler_reports_counter_deltas(sampler):
+    sampler, clock = sampler
+    first = sampler.sample()['passthrough']
+    assert sorted(first) == [(1000, 12345), (1001, 12345)]
+    assert first[(1000, 12345)] == (0.0, 2048 * PAGE_SIZE, 0, 0, 0, 4)
+    write_fake_process(sampler.proc_root, 1000, 'java', ['/usr/bin/java', '-Dname=security_passthrough'],
+                       utime=CLOCK_TICKS * 3, stime=CLOCK_TICKS, threads=6)
+    clock.now += 10
+    assert sampler.sample()['passthrough'][(1000, 12345)] == (40.0, 2048 * PAGE_SIZE, 0, 0, 0, 6)
+
+
+def test_proc_sampler_rereads_a_reused_pid(sampler):
+    sampler, clock = sampler
+    sampler.sample()
+    # 1001 exits and its PID goes to an unrelated process, 1002 exits and a matching process gets its PID
+    reuse_pid(sampler.proc_root, 1001, 'bash', ['bash'], starttime=50000)
+    reuse_pid(sampler.proc_root, 1002, 'java', ['/usr/bin/java', '-Dname=security_passthrough'], starttime=50001)
+    clock.now += 10
+    samples = sampler.sample()['passthrough']
+    assert sorted(samples) == [(1000, 12345), (1002, 50001)]
+    # the new process starts with fresh counters
+    assert samples[(1002, 50001)][0] == 0.0
+
+
+def test_proc_sampler_drops_a_pid_whose_starttime_changed_in_place(sampler):
+    sampler, clock = sampler
+    sampler.sample()
+    # the same directory inode, but stat now belongs to another process
+    write_fake_process(sampler.proc_root, 1001, 'java', ['/usr/bin/java', '-Dname=security_passthrough'], starttime=60000)
+    assert sorted(sampler.sample()['passthrough']) == [(1000, 12345)]
+    assert sorted(sampler.sample()['passthrough']) == [(1000, 12345), (1001, 60000)]
+
+
+def test_metric_engine_recycles_the_rows_of_exited_processes():
+    engine = MetricEngine(window=3, metrics=('cpu_percent',), max_series=2)
+    for value in (1.0, 2.0, 3.0):
+        engine.update({(100, 1): (value,), (101, 1): (value,)})
+    # 101 exits and its PID is reused by a process with another starttime
+    engine.retain({(100, 1), (101, 2)})
+    assert engine.keys == [(100, 1)]
+    scores = engine.update({(100, 1): (4.0,), (101, 2): (9.0,)})
+    assert engine.dropped == 0 and len(engine) == 2
+    assert engine.series((101, 2)) == [9.0]
+    # the reused row scores nothing until the new process fills its own window
+    assert np.isnan(scores.zscore[1]).all()
+
+
+def test_metric_engine_drops_samples_past_max_series():
+    engine = MetricEngine(window=3, metrics=('cpu_percent',), max_series=3)
+    scores = engine.update({(pid, 1): (1.0,) for pid in range(5)})
+    assert len(engine) == 3 and engine.dropped == 2
+    assert scores.keys == [(0, 1), (1, 1), (2, 1)]
+
+
+def test_metric_engine_grows_its_records_up_to_max_series():
+    engine = MetricEngine(window=3, metrics=('cpu_percent',), max_series=INITIAL_SERIES + 10)
+    for value in (1.0, 2.0):
+        engine.update({(pid, 1): (pid + value,) for pid in range(INITIAL_SERIES + 20)})
+    assert len(engine) == INITIAL_SERIES + 10 and engine.dropped == 20
+    assert engine.series((0, 1)) == [1.0, 2.0]
+    assert engine.series((INITIAL_SERIES + 9, 1)) == [INITIAL_SERIES + 10.0, INITIAL_SERIES + 11.0]
+
+
+def test_scores_render_full_windows_in_the_prometheus_text_format():
+    engine = MetricEngine(window=2, metrics=('cpu_percent', 'rss'))
+    engine.update({(100, 7): (1.0, 10.0), (101, 8): (5.0, 50.0)})
+    text = engine.update({(100, 7): (3.0, 10.0)}).to_prometheus(labels='group="was",')
+    assert text.endswith('\n')
+    lines = text.splitlines()
+    assert '# TYPE process_monitor_zscore gauge' in lines
+    assert 'process_monitor_value{group="was",pid="100",starttime="7",signal="cpu_percent"} 3.0' in lines
+    assert 'process_monitor_mean{group="was",pid="100",starttime="7",signal="cpu_percent"} 2.0' in lines
+    assert 'process_monitor_stdev{group="was",pid="100",starttime="7",signal="rss"} 0.0' in lines
+    assert not any('pid="101"' in line for line in lines)
+
+
+def test_metric_engine_reattaches_to_its_ring_file_after_a_restart(tmp_path):
+    path = str(tmp_path / 'monitor.ring')
+    engine = MetricEngine(window=4, metrics=('cpu_percent', 'rss'), max_series=8, path=path)
+    for value in range(6):
+        engine.update({(100, 1): (float(value), 1.0), (101, 1): (10.0 * value, 2.0)})
+    engine.retain({(100, 1)})
+    engine.flush()
+    del engine
+
+    engine = MetricEngine(window=4, metrics=('cpu_percent', 'rss'), max_series=8, path=path)
+    assert engine.keys == [(100, 1)]
+    assert engine.series((100, 1)) == [2.0, 3.0, 4.0, 5.0]
+    # the window is already full, so the first tick after the restart is scored
+    scores = engine.update({(100, 1): (6.0, 1.0), (102, 1): (1.0, 1.0)})
+    assert scores.mean[0, 0] == 4.5
+    assert engine.series((100, 1)) == [3.0, 4.0, 5.0, 6.0]
+
+
+def test_ring_file_with_another_layout_is_recreated(tmp_path):
+    path = str(tmp_path / 'monitor.ring')
+    engine = MetricEngine(window=4, metrics=('cpu_percent',), max_series=8, path=path)
+    engine.update({(100, 1): (1.0,)})
+    engine.flush()
+    del engine
+    assert len(MetricEngine(window=5, metrics=('cpu_percent',), max_series=8, path=path)) == 0
+
+
+def test_run_groups_writes_the_textfile_of_every_group(tmp_path):
+    root = str(tmp_path / 'proc')
+    build_fake_proc(root, 5, matched=2)
+    write_fake_process(root, 2000, 'java', ['/usr/bin/java', '-Dname=batch_loader'])
+    textfile = str(tmp_path / 'collector' / 'monitor_{name}.prom')
+    groups = [ProcessGroup('passthrough', 'security_passthrough', interval=60, window=3, textfile=textfile, state_file=None),
+              ProcessGroup('batch', 'batch_loader', interval=60, window=3, textfile=textfile, state_file=None)]
+    sampler = ProcSampler({group.name: group.matcher for group in groups}, proc_root=root)
+    scans = []
+    sample = sampler.sample
+
+    def record(names):
+        scans.append(sorted(names))
+        return sample(names)
+    sampler.sample = record
+
+    async def monitor():
+        task = asyncio.create_task(run_groups(groups, sampler))
+        for _ in range(200):
+            if all(os.path.exists(group.textfile) for group in groups):
+                break
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(monitor())
+    # both groups were due at start and shared one scan
+    assert scans == [['batch', 'passthrough']]
+    with open(groups[0].textfile) as f:
+        lines = f.read().splitlines()
+    assert 'process_monitor_value{group="passthrough",pid="1000",starttime="12345",signal="num_threads"} 4.0' in lines
+    assert not any('pid="2000"' in line for line in lines)
+    with open(groups[1].textfile) as f:
+        assert 'group="batch",pid="2000"' in f.read()
@@ -0,0 +1,124 @@
+import logging
+import os
+import sys
+
+import pytest
+
+import mq_clean_old
+
+
+def write_mq(stubs, version, packages=(('MQSeriesRuntime', '9.3.0', '0', 'x86_64'),), path='/opt/mqm'):
+    # one primary installation at version, as dspmqinst and dspmqver report it, and rpm listing packages
+    inst_path = f'InstPath: {path}\\n' if path else ''
+    stubs.write('dspmqinst', f'printf "InstName: Installation1\\n{inst_path}Version: {version}\\n'
+                            f'Primary: Yes\\nState: Available\\n"')
+    stubs.write('dspmqver', f'echo {version}')
+    lines = ''.join('\\t'.join(fields + ('1700000000',)) + '\\n' for fields in packages)
+    stubs.write('rpm', f'printf "{lines}"')
+
+
+@pytest.fixture
+def mq_host(stub_bin, tmp_path, monkeypatch, caplog):
+    monkeypatch.setenv('environment', 'prod1')
+    monkeypatch.setattr(mq_clean_old, 'LOCK_FILE', str(tmp_path / 'lock.txt'))
+    monkeypatch.setattr(mq_clean_old, 'MQ_DIRECTORY_PATTERN', str(tmp_path / 'opt' / 'mq*'))
+    monkeypatch.setattr(mq_clean_old, '_registry', None)
+    monkeypatch.setattr(sys, 'argv', ['mq_clean_old.py'])
+    caplog.set_level(logging.INFO, logger=mq_clean_old.__name__)
+    return stub_bin
+
+
+def test_main_lists_the_packages_of_other_versions(mq_host, caplog):
+    write_mq(mq_host, '9.3.0.0', (('MQSeriesRuntime', '9.3.0', '0', 'x86_64'), ('MQSeriesServer', '9.1.0', '0', 'x86_64')))
+    mq_clean_old.main()
+    assert 'RPM Suffix: mq93' in caplog.messages
+    assert 'Invalid MQ package: MQSeriesServer-9.1.0-0.x86_64' in caplog.messages
+    assert not os.path.exists(mq_clean_old.LOCK_FILE)
+
+
+def test_main_stops_below_version_9(mq_host, caplog):
+    write_mq(mq_host, '8.0.0.4')
+    with pytest.raises(SystemExit) as exit_info:
+        mq_clean_old.main()
+    assert exit_info.value.code == 1
+    assert ('ERROR:The MQ installation Installation1 has a version (8.0.0.4) that is less than 9.0. Exiting.'
+            in caplog.messages)
+    assert not mq_host.calls('rpm')
+
+
+def test_main_stops_when_dspmqinst_fails(mq_host):
+    mq_host.write('dspmqinst', 'exit 1')
+    with pytest.raises(SystemExit) as exit_info:
+        mq_clean_old.main()
+    assert exit_info.value.code == 1
+
+
+def test_main_refuses_to_run_while_locked(mq_host):
+    open(mq_clean_old.LOCK_FILE, 'w').close()
+    with pytest.raises(SystemExit):
+        mq_clean_old.main()
+    assert not mq_host.calls('dspmqinst')
+
+
+def write_tree(root):
+    # a file, a second link to it and a symlink, under a subdirectory, and the bytes they occupy
+    (root / 'lib').mkdir(parents=True)
+    (root / 'lib' / 'libmqm.so').write_bytes(b'x' * 65536)
+    os.link(root / 'lib' / 'libmqm.so', root / 'lib' / 'libmqm.so.1')
+    (root / 'lib' / 'current').symlink_to('libmqm.so')
+    return (os.stat(root / 'lib' / 'libmqm.so').st_blocks + os.lstat(root / 'lib' / 'current').st_blocks) * 512
+
+
+def test_reclaim_tree_counts_hard_linked_files_once(tmp_path):
+    size = write_tree(tmp_path / 'mq91')
+    usage = mq_clean_old.reclaim_tree(str(tmp_path / 'mq91'))
+    assert (usage.files, usage.directories, usage.errors) == (3, 2, [])
+    assert usage.bytes == size
+    assert (tmp_path / 'mq91' / 'lib' / 'libmqm.so').exists()
+
+    usage = mq_clean_old.reclaim_tree(str(tmp_path / 'mq91'), dry_run=False)
+    assert usage.errors == []
+    assert not (tmp_path / 'mq91').exists()
+
+
+def test_main_reports_what_deleting_old_mq_directories_would_free(mq_host, caplog, monkeypatch):
+    write_mq(mq_host, '9.3.0.0')
+    opt = mq_host.path.parent / 'opt'
+    size = write_tree(opt / 'mq91')
+    monkeypatch.setattr(sys, 'argv', ['mq_clean_old.py', '--dry-run'])
+    mq_clean_old.main()
+    assert any(message.startswith(f'Would free {size} bytes in 3 files and 2 directories under {opt}/mq91')
+               for message in caplog.messages)
+    assert (opt / 'mq91' / 'lib' / 'libmqm.so').exists()
+
+
+def test_main_walks_the_mq_directories_only_for_a_dry_run(mq_host, caplog, monkeypatch):
+    write_mq(mq_host, '9.3.0.0')
+    write_tree(mq_host.path.parent / 'opt' / 'mq91')
+    walked = []
+    monkeypatch.setattr(mq_clean_old, 'reclaim_tree', lambda *args: walked.append(args))
+    mq_clean_old.main()
+    assert walked == []
+    assert not any(message.startswith('Would free') for message in caplog.messages)
+
+
+def test_main_dry_run_stops_without_a_primary_install_path(mq_host, caplog, monkeypatch):
+    write_mq(mq_host, '9.3.0.0', path=None)
+    monkeypatch.setattr(sys, 'argv', ['mq_clean_old.py', '--dry-run'])
+    with pytest.raises(SystemExit) as exit_info:
+        mq_clean_old.main()
+    assert exit_info.value.code == 1
+    assert any('The primary installation Installation1 has no InstPath.' in message for message in caplog.messages)
+    assert not os.path.exists(mq_clean_old.LOCK_FILE)
+
+
+def test_check_installed_mq_packages_queries_rpm_every_time(mq_host):
+    write_mq(mq_host, '9.3.0.0', (('MQSeriesRuntime', '9.3.0', '0', 'x86_64'), ('MQSeriesServer', '9.1.0', '0', 'x86_64')))
+    for _ in range(2):
+        assert [str(package) for package in mq_clean_old.check_installed_mq_packages('9.3')] == ['MQSeriesServer-9.1.0-0.x86_64']
+    assert len(mq_host.calls('rpm')) == 2
+
+
+def test_check_installed_mq_packages_reports_a_failed_query(mq_host):
+    mq_host.write('rpm', 'printf "MQSeriesServer\\t9.1.0\\t0\\tx86_64\\t1700000000\\n"; exit 1')
+    assert mq_clean_old.check_installed_mq_packages('9.3') is None
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from procfs import build_fake_proc, find_open_file, find_process, find_processes_by_name, write_fake_process
+
+
+@pytest.fixture
+def proc_root(tmp_path):
+    root = str(tmp_path / 'proc')
+    build_fake_proc(root, 50)
+    write_fake_process(root, 2000, 'reg_server', ['/cerner/bin/reg_server', '-d'])
+    # a kernel thread has an empty command line and is matched on its name
+    write_fake_process(root, 2001, 'kworker/0:1', [])
+    with open(os.path.join(root, '2001', 'cmdline'), 'wb'):
+        pass
+    write_fake_process(root, 2002, 'python3', ['/usr/bin/python3', '/usr/bin/yum', 'update'], exe='/usr/bin/python3.6')
+    write_fake_process(root, 2003, 'rpm', ['rpm', '-qa'], exe='/usr/bin/rpm')
+    write_fake_process(root, 2004, 'less', ['less', '/var/log/rpm.log'], exe='/usr/bin/less',
+                       fds=['/dev/null', '/var/lib/rpm/Packages'])
+    # yum as it runs on a real host, named yum with the python interpreter as its executable
+    write_fake_process(root, 2005, 'yum', ['/usr/bin/python3', '/usr/bin/yum', 'install', 'rpm'], exe='/usr/bin/python3')
+    return root
+
+
+def test_find_process_matches_the_command_line(proc_root):
+    assert find_process('reg_server', proc_root) == 2000
+    assert find_process(r'bin/reg_\w+ -d$', proc_root) == 2000
+
+
+def test_find_process_matches_kernel_threads_on_their_name(proc_root):
+    assert find_process('kworker', proc_root) == 2001
+
+
+def test_find_process_misses(proc_root):
+    assert find_process('no_such_daemon', proc_root) is None
+
+
+def test_find_process_skips_vanished_processes(proc_root):
+    # the directory exists but the process exited before its files were read
+    os.makedirs(os.path.join(proc_root, '3000'))
+    assert find_process('reg_server', proc_root) == 2000
+
+
+def test_find_processes_by_name_matches_comm_or_exe_exactly(proc_root):
+    # yum is found by its name although its executable is python3, and an argument or path that only contains
+    # "rpm" does not count
+    assert find_processes_by_name(('rpm', 'yum', 'dnf'), proc_root) == {2003: 'rpm', 2005: 'yum'}
+    assert find_processes_by_name(('python3.6',), proc_root) == {2002: 'python3.6'}
+    assert find_processes_by_name(('up2date',), proc_root) == {}
+
+
+def test_find_open_file_matches_the_path_and_below(proc_root):
+    assert find_open_file('/var/lib/rpm', proc_root) == (2004, '/var/lib/rpm/Packages')
+    assert find_open_file('/var/lib/rpm/Packages', proc_root) == (2004, '/var/lib/rpm/Packages')
+    # a sibling that shares the prefix is not under the directory
+    assert find_open_file('/var/lib/rp', proc_root) is None
@@ -0,0 +1,264 @@
+import glob
+import gzip
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import tarfile
+
+import pytest
+
+import rpm_database_cleanup
+from procfs import build_fake_proc, write_fake_process
+
+DB_DIR = '/var/lib/rpm'
+
+
+@pytest.fixture
+def proc_root(tmp_path):
+    root = str(tmp_path / 'proc')
+    build_fake_proc(root, 20)
+    # a process that only mentions rpm in its arguments and holds files next to, not in, the database
+    write_fake_process(root, 2000, 'less', ['less', '/var/log/rpm.log'], exe='/usr/bin/less',
+                       fds=['/var/log/rpm.log', '/var/lib/rpm.bak/Packages'])
+    return root
+
+
+def test_rebuild_preflight_passes_on_a_quiet_host(proc_root):
+    assert rpm_database_cleanup.rebuild_preflight(DB_DIR, proc_root) is None
+
+
+@pytest.mark.parametrize('comm, exe', [('rpm', '/usr/bin/rpm'), ('yum', '/usr/bin/python3'), ('python3', '/usr/bin/dnf')])
+def test_rebuild_preflight_waits_for_package_managers(proc_root, comm, exe):
+    write_fake_process(proc_root, 3000, comm, [exe], exe=exe)
+    assert 'package management command is running' in rpm_database_cleanup.rebuild_preflight(DB_DIR, proc_root)
+
+
+def test_rebuild_preflight_waits_for_open_database_files(proc_root):
+    write_fake_process(proc_root, 3000, 'java', ['java'], exe='/usr/bin/java', fds=['/dev/null', os.path.join(DB_DIR, '__db.001')])
+    assert rpm_database_cleanup.rebuild_preflight(DB_DIR, proc_root) == \
+        'some RPM database files are open: /var/lib/rpm/__db.001 (pid 3000)'
+
+
+@pytest.fixture
+def rpm_host(stub_bin, tmp_path, monkeypatch):
+    # a database directory, a stub rpm whose probe exits with the status in probe.status and a stub rpmdb_verify
+    db_dir = tmp_path / 'rpm'
+    db_dir.mkdir()
+    (db_dir / 'Packages').write_bytes(b'headers')
+    (db_dir / '__db.001').write_bytes(b'environment')
+    (stub_bin.path / 'probe.status').write_text('0')
+    stub_bin.write('rpm', f'case "$2" in --whatprovides) exit $(cat "{stub_bin.path}/probe.status");; esac')
+    stub_bin.write('rpmdb_verify', 'exit 0')
+    monkeypatch.setattr(rpm_database_cleanup, 'RPMDB_VERIFY', str(stub_bin.path / 'rpmdb_verify'))
+    return stub_bin, str(db_dir), str(tmp_path / 'health.json')
+
+
+def check(rpm_host):
+    stubs, db_dir, state_file = rpm_host
+    rpm_database_cleanup.commands.reset()
+    healthy, timings = rpm_database_cleanup.check_rpm_tiers(db_dir, state_file)
+    return healthy, [(tier, passed) for tier, passed, seconds in timings]
+
+
+def test_health_check_probes_what_the_sample_packages_provide(rpm_host):
+    stubs, db_dir, state_file = rpm_host
+    check(rpm_host)
+    assert stubs.calls('rpm')[0] == '-q --whatprovides rpm bash glibc coreutils'
+
+
+def test_health_check_verifies_once_then_trusts_the_cached_verdict(rpm_host):
+    stubs, db_dir, state_file = rpm_host
+    assert check(rpm_host) == (True, [('probe', True), ('verify', True)])
+    assert stubs.calls('rpmdb_verify') == [os.path.join(db_dir, 'Packages')]
+    assert check(rpm_host) == (True, [('probe', True), ('verify', None)])
+    # the Berkeley DB environment files do not count as a change
+    with open(os.path.join(db_dir, '__db.001'), 'ab') as f:
+        f.write(b'more')
+    assert check(rpm_host) == (True, [('probe', True), ('verify', None)])
+    assert len(stubs.calls('rpmdb_verify')) == 1
+    assert stubs.calls('rpm').count('-qa') == 1
+
+
+def test_health_check_verifies_again_when_the_database_changes(rpm_host):
+    stubs, db_dir, state_file = rpm_host
+    check(rpm_host)
+    with open(os.path.join(db_dir, 'Packages'), 'ab') as f:
+        f.write(b'another header')
+    assert check(rpm_host) == (True, [('probe', True), ('verify', True)])
+    assert len(stubs.calls('rpmdb_verify')) == 2
+
+
+def test_failed_probe_escalates_to_the_full_verify(rpm_host):
+    stubs, db_dir, state_file = rpm_host
+    check(rpm_host)
+    (stubs.path / 'probe.status').write_text('1')
+    assert check(rpm_host) == (True, [('probe', False), ('verify', True)])
+    # a failed verify forgets the cached verdict
+    stubs.write('rpmdb_verify', 'exit 1')
+    assert check(rpm_host) == (False, [('probe', False), ('verify', False)])
+    assert not os.path.exists(state_file)
+
+
+def test_check_rpm_logs_every_tier(rpm_host, caplog):
+    stubs, db_dir, state_file = rpm_host
+    caplog.set_level(logging.INFO)
+    assert rpm_database_cleanup.check_rpm(db_dir, state_file)
+    rpm_database_cleanup.commands.reset()
+    assert rpm_database_cleanup.check_rpm(db_dir, state_file)
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages[0].startswith('RPM health probe: passed in ')
+    assert messages[1].startswith('RPM health verify: passed in ')
+    assert messages[3] == 'RPM health verify: skipped, the database is unchanged since the last healthy verify'
+
+
+@pytest.fixture
+def rpm_db(tmp_path):
+    # a small Berkeley DB style database and an empty backup store
+    db_dir = tmp_path / 'lib' / 'rpm'
+    db_dir.mkdir(parents=True)
+    (db_dir / 'Packages').write_bytes(os.urandom(64 * 1024))
+    (db_dir / 'Name').write_bytes(b'bash\0glibc\0rpm\0')
+    (db_dir / '__db.001').write_bytes(b'environment')
+    os.chmod(db_dir / 'Name', 0o640)
+    return str(db_dir), str(tmp_path / 'preserve')
+
+
+def stored_objects(store):
+    return sorted(os.path.relpath(os.path.join(directory, name), store)
+                  for directory, _, names in os.walk(os.path.join(store, 'objects')) for name in names)
+
+
+def test_backup_stores_each_file_once_and_skips_an_unchanged_database(rpm_db):
+    db_dir, store = rpm_db
+    first = rpm_database_cleanup.backup_rpm_database(db_dir, store)
+    files = rpm_database_cleanup.load_manifest(first)['files']
+    assert sorted(files) == ['Name', 'Packages']
+    assert files['Name']['mode'] == 0o640
+    objects = stored_objects(store)
+    assert len(objects) == 2
+    for entry in files.values():
+        with gzip.open(rpm_database_cleanup.object_path(store, entry['sha256'])) as f:
+            assert hashlib.sha256(f.read()).hexdigest() == entry['sha256']
+
+    assert rpm_database_cleanup.backup_rpm_database(db_dir, store) == first
+    assert rpm_database_cleanup.list_snapshots(store) == [first]
+    assert stored_objects(store) == objects
+
+
+def test_incremental_backup_stores_only_the_changed_files(rpm_db, monkeypatch):
+    db_dir, store = rpm_db
+    first = rpm_database_cleanup.backup_rpm_database(db_dir, store)
+    packages = rpm_database_cleanup.load_manifest(first)['files']['Packages']
+    with open(os.path.join(db_dir, 'Name'), 'ab') as f:
+        f.write(b'coreutils\0')
+    stored = []
+    store_file = rpm_database_cleanup.store_file
+
+    def record(store, source):
+        stored.append(source)
+        return store_file(store, source)
+    monkeypatch.setattr(rpm_database_cleanup, 'store_file', record)
+    second = rpm_database_cleanup.backup_rpm_database(db_dir, store)
+    assert second != first
+    assert stored == [os.path.join(db_dir, 'Name')]
+    assert rpm_database_cleanup.load_manifest(second)['files']['Packages'] == packages
+    assert len(stored_objects(store)) == 3
+
+
+def test_backup_keeps_only_the_retained_snapshots_and_their_objects(rpm_db):
+    db_dir, store = rpm_db
+    for release in range(3):
+        with open(os.path.join(db_dir, 'Name'), 'ab') as f:
+            f.write(b'release%d\0' % release)
+        latest = rpm_database_cleanup.backup_rpm_database(db_dir, store, retain=2)
+    snapshots = rpm_database_cleanup.list_snapshots(store)
+    assert len(snapshots) == 2 and snapshots[-1] == latest
+    # Packages is shared by both snapshots, the first version of Name went with the pruned snapshot
+    assert len(stored_objects(store)) == 3
+
+
+def read_dir(path):
+    return {name: (path / name).read_bytes() for name in sorted(os.listdir(path))}
+
+
+@pytest.fixture
+def restore_host(rpm_db, stub_bin):
+    # the database after an update, its backup from before and a restorecon that does nothing
+    db_dir, store = rpm_db
+    stub_bin.write('restorecon', 'exit 0')
+    manifest = rpm_database_cleanup.backup_rpm_database(db_dir, store)
+    backed_up = read_dir(pathlib.Path(db_dir))
+    with open(os.path.join(db_dir, 'Packages'), 'wb') as f:
+        f.write(b'after the update')
+    return pathlib.Path(db_dir), manifest, backed_up
+
+
+def test_compress_stream_writes_one_gzip_member_per_block():
+    data = os.urandom(10000)
+    dst = io.BytesIO()
+    sha256 = rpm_database_cleanup.compress_stream(io.BytesIO(data), dst, workers=2, block_size=1024)
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    assert gzip.decompress(dst.getvalue()) == data
+    assert dst.getvalue().count(b'\x1f\x8b\x08') >= 10
+
+
+def test_restore_from_a_manifest_swaps_the_database_and_keeps_the_old_one(restore_host):
+    db_dir, manifest, backed_up = restore_host
+    previous = read_dir(db_dir)
+    replaced = rpm_database_cleanup.restore_rpm_database(manifest, str(db_dir))
+    # the environment file was not backed up, it stays with the replaced database
+    assert read_dir(db_dir) == {name: data for name, data in backed_up.items() if not name.startswith('__db')}
+    assert (db_dir / 'Name').stat().st_mode & 0o7777 == 0o640
+    assert read_dir(pathlib.Path(replaced)) == previous
+    assert replaced.startswith(f'{db_dir}.pre-restore-')
+
+
+def test_restore_from_a_tar_backup(restore_host, tmp_path):
+    db_dir, manifest, backed_up = restore_host
+    backup = tmp_path / 'rpm.tar.gz'
+    with tarfile.open(backup, 'w:gz') as archive:
+        for name, data in (('rpm/Packages', b'from the tar'), ('rpm/Name', b'bash\0'), ('etc/passwd', b'root'),
+                           ('rpm/nested/file', b'skipped')):
+            member = tarfile.TarInfo(name)
+            member.size, member.mode, member.uid, member.gid = len(data), 0o600, os.getuid(), os.getgid()
+            archive.addfile(member, io.BytesIO(data))
+    assert rpm_database_cleanup.restore_rpm_database(str(backup), str(db_dir))
+    assert read_dir(db_dir) == {'Name': b'bash\0', 'Packages': b'from the tar'}
+    assert (db_dir / 'Packages').stat().st_mode & 0o7777 == 0o600
+
+
+def test_corrupt_object_aborts_before_the_live_database_is_touched(restore_host):
+    db_dir, manifest, backed_up = restore_host
+    store = os.path.dirname(os.path.dirname(manifest))
+    entry = rpm_database_cleanup.load_manifest(manifest)['files']['Packages']
+    with open(rpm_database_cleanup.object_path(store, entry['sha256']), 'wb') as f:
+        f.write(gzip.compress(b'not what was backed up'))
+    before = read_dir(db_dir)
+    assert rpm_database_cleanup.restore_rpm_database(manifest, str(db_dir)) is None
+    assert read_dir(db_dir) == before
+    assert glob.glob(f'{db_dir}.pre-restore-*') == []
+
+
+def test_restores_in_the_same_second_get_their_own_directories(restore_host):
+    db_dir, manifest, backed_up = restore_host
+    first = rpm_database_cleanup.restore_rpm_database(manifest, str(db_dir))
+    second = rpm_database_cleanup.restore_rpm_database(manifest, str(db_dir))
+    assert first and second and first != second
+
+
+@pytest.mark.parametrize('renameat2', [True, False])
+def test_exchange_directories_swaps_the_two_paths(tmp_path, monkeypatch, renameat2):
+    if not renameat2:
+        # C libraries without renameat2(), such as the one on RHEL 7
+        monkeypatch.setattr(rpm_database_cleanup.ctypes, 'CDLL', lambda name, use_errno: object())
+    live, staging = tmp_path / 'rpm', tmp_path / 'rpm.staging'
+    live.mkdir()
+    staging.mkdir()
+    (live / 'Packages').write_bytes(b'old')
+    (staging / 'Packages').write_bytes(b'new')
+    rpm_database_cleanup.exchange_directories(str(staging), str(live))
+    assert read_dir(live) == {'Packages': b'new'}
+    assert read_dir(staging) == {'Packages': b'old'}
+    assert sorted(os.listdir(tmp_path)) == ['rpm', 'rpm.staging']
@@ -0,0 +1,148 @@
+import io
+
+import pytest
+
+import xml_decorator
+from xml_decorator import emit_facts, format_output
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    # every test registers its facts in an empty registry, on a clock it moves itself
+    monkeypatch.setattr(xml_decorator, 'facts', {})
+    clock = Clock()
+    monkeypatch.setattr(xml_decorator, 'clock', clock)
+    return clock
+
+
+class Counter:
+    # how many times a fact was computed
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        return value
+
+
+def test_bare_decorator_escapes_the_value():
+    @format_output
+    def release():
+        return 'a < b && c > d'
+    assert release() == '<release>a &lt; b &amp;&amp; c &gt; d</release>'
+
+
+def test_none_renders_as_an_empty_tag():
+    @format_output(name='node')
+    def missing():
+        return None
+    assert missing() == '<node></node>'
+
+
+def test_generator_pieces_are_escaped_and_joined():
+    @format_output
+    def nodes():
+        yield 'node01'
+        yield None
+        yield ',<node02>'
+    assert nodes() == '<nodes>node01,&lt;node02&gt;</nodes>'
+
+
+def test_uncached_fact_is_computed_every_call():
+    count = Counter()
+
+    @format_output
+    def fqdn():
+        return count('node01')
+    fqdn()
+    fqdn()
+    assert count.calls == 2
+
+
+def test_ttl_reuses_the_value_until_it_expires(registry):
+    count = Counter()
+
+    @format_output(ttl=30)
+    def fqdn(suffix):
+        return count(f'node01{suffix}')
+    assert [fqdn('.a'), fqdn('.a'), fqdn('.b')] == ['<fqdn>node01.a</fqdn>'] * 2 + ['<fqdn>node01.b</fqdn>']
+    assert count.calls == 2
+    registry.now += 29
+    fqdn('.a')
+    assert count.calls == 2
+    registry.now += 1
+    fqdn('.a')
+    assert count.calls == 3
+
+
+def test_file_change_invalidates_the_value(tmp_path):
+    cib = tmp_path / 'cib.xml'
+    cib.write_text('<cib/>')
+    count = Counter()
+
+    @format_output(files=[str(cib)])
+    def cluster():
+        return count(cib.read_text())
+    assert cluster() == cluster() == '<cluster>&lt;cib/&gt;</cluster>'
+    assert count.calls == 1
+    cib.write_text('<cib epoch="2"/>')
+    assert cluster() == '<cluster>&lt;cib epoch="2"/&gt;</cluster>'
+    cib.unlink()
+    cluster.fact.func = lambda: count('gone')
+    assert cluster() == '<cluster>gone</cluster>'
+    assert count.calls == 3
+
+
+def test_unhashable_arguments_are_cached_by_value():
+    count = Counter()
+
+    @format_output(ttl=30)
+    def properties(names, options):
+        return count(','.join(names))
+    assert properties(['a', 'b'], {'x': [1]}) == properties(['a', 'b'], {'x': [1]}) == '<properties>a,b</properties>'
+    assert count.calls == 1
+    properties(['a'], {'x': [1]})
+    assert count.calls == 2
+
+
+def test_arguments_that_cannot_be_hashed_skip_the_cache():
+    count = Counter()
+
+    @format_output(ttl=30)
+    def size(buffer):
+        return count(len(buffer))
+    assert size(bytearray(b'abc')) == size(bytearray(b'abc')) == '<size>3</size>'
+    assert count.calls == 2
+
+
+def test_emit_facts_writes_every_fact_in_one_write():
+    @format_output
+    def os_release():
+        return 7.9
+
+    @format_output(ttl=30)
+    def nodes():
+        yield 'node01,'
+        yield 'node02'
+
+    class File(io.StringIO):
+        writes = 0
+
+        def write(self, text):
+            self.writes += 1
+            return super().write(text)
+    out = File()
+    emit_facts(out)
+    assert out.getvalue() == '<os_release>7.9</os_release><nodes>node01,node02</nodes>'
+    assert out.writes == 1
+    out = File()
+    emit_facts(out, names=['nodes'])
+    assert out.getvalue() == '<nodes>node01,node02</nodes>'
@@ -1,17 +1,162 @@
 """Takes a function and its arguments as input and converts the text to xml
 
 Args:
-    func (function): The function 
+    func (function): The function
+    ttl (float): seconds a computed value is reused, None to never expire on time
+    files (list): paths whose (inode, mtime, size) changing invalidates the cached value
+    name (str): tag name, defaults to the function name
 
 Returns:
-    list: an xml string with the function name as the tag information
+    str: an xml string with the function name as the tag information
 
-Use: decorator
+Use: decorator, either bare as @format_output or configured as @format_output(ttl=300, files=[...]).
+Every decorated function is registered as a fact, and emit_facts() writes all of them in one write.
+The tags are built once when the function is decorated. Values are XML escaped and None renders
+as an empty tag. A generator function has the pieces it yields escaped and written one by one,
+so a large value is never joined in memory unless it has to be cached.
+
+Cached values are kept per argument tuple. Lists, dicts and sets among the arguments are turned
+into their hashable equivalents for the cache key, and a call with arguments that still cannot be
+hashed is computed every time.
 """
+import functools
+import inspect
+import io
+import os
+import sys
+import time
+from xml.sax.saxutils import escape
+
+# every decorated function by tag name, in the order they were decorated
+facts = {}
+# the clock TTLs are measured on
+clock = time.monotonic
+
+
+def file_stamp(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def freeze(value):
+    # a hashable stand-in for value, the same for equal values
+    if isinstance(value, (list, tuple)):
+        return tuple(map(freeze, value))
+    if isinstance(value, dict):
+        return frozenset((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (set, frozenset)):
+        return frozenset(map(freeze, value))
+    return value
+
+
+def cache_key(args):
+    """The cache key of an argument tuple, or None when it cannot be hashed even after freeze()."""
+    try:
+        hash(args)
+        return args
+    except TypeError:
+        pass
+    key = freeze(args)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class Fact:
+    """A registered fact: the wrapped function, its precomputed tags and its cached values per argument tuple."""
+
+    def __init__(self, func, name, ttl=None, files=()):
+        self.func = func
+        self.name = name
+        self.prefix = f'<{name}>'
+        self.suffix = f'</{name}>'
+        self.ttl = ttl
+        self.files = tuple(files)
+        self.streaming = inspect.isgeneratorfunction(func)
+        self.cache = {}
+
+    @property
+    def cached(self):
+        return self.ttl is not None or bool(self.files)
+
+    def pieces(self, *args):
+        # the escaped text of the value, as one string or as the pieces a generator yields
+        if self.streaming:
+            return (escape(str(piece)) for piece in self.func(*args) if piece is not None)
+        value = self.func(*args)
+        return (escape(str(value)),) if value is not None else ()
+
+    def lookup(self, args):
+        """The cached text for args, or None with the key and the (deadline, file stamps) to store a fresh one under.
+
+        The key is None when the fact is not cached or args cannot be hashed. The files are stamped before a value is
+        computed, so a change made while computing it invalidates it on the next call.
+        """
+        key = cache_key(args) if self.cached else None
+        if key is None:
+            return None, None, None
+        now = clock()
+        stamps = tuple(map(file_stamp, self.files))
+        entry = self.cache.get(key)
+        if entry is not None and (entry[0] is None or now < entry[0]) and entry[1] == stamps:
+            return entry[2], key, None
+        return None, key, (None if self.ttl is None else now + self.ttl, stamps)
+
+    def compute(self, key, expiry, *args):
+        value = ''.join(self.pieces(*args))
+        if key is not None:
+            self.cache[key] = expiry + (value,)
+        return value
+
+    def value(self, *args):
+        value, key, expiry = self.lookup(args)
+        return value if value is not None else self.compute(key, expiry, *args)
+
+    def render(self, *args):
+        return self.prefix + self.value(*args) + self.suffix
+
+    def render_into(self, write, *args):
+        value, key, expiry = self.lookup(args)
+        write(self.prefix)
+        if value is None and key is None:
+            # nothing to keep, so a generator's pieces are written as they come
+            for piece in self.pieces(*args):
+                write(piece)
+        else:
+            write(value if value is not None else self.compute(key, expiry, *args))
+        write(self.suffix)
+
+    def invalidate(self):
+        self.cache.clear()
+
+
+def format_output(func=None, *, ttl=None, files=(), name=None):
+
+    def decorate(func):
+        fact = Fact(func, name or func.__name__, ttl, files)
+        facts[fact.name] = fact
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return fact.render(*args)
+
+        wrapper.fact = fact
+        return wrapper
+
+    return decorate(func) if func is not None else decorate
 
-def format_output(func):
 
-    def wrapper(*args):
-        return f'<{str(func.__name__)}>{str(func(*args)) or ""}</{str(func.__name__)}>'
+def emit_facts(file=None, names=None):
+    """Render every registered fact, or only those in names, called without arguments, and write them in one write call.
 
-    return wrapper
+    The facts are rendered into one buffer first so a reader of file never sees half of the output.
+    """
+    buffer = io.StringIO()
+    for fact_name in names or list(facts):
+        facts[fact_name].render_into(buffer.write)
+    (file or sys.stdout).write(buffer.getvalue())
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Polls the long running operation monitors in this directory and works out their ETAs.
+
+Every tick runs rollback_monitor.sql, rman_monitor.sql, index_monitor.sql, datapump_mon.sql and
+generic_longops_monitor.sql against each instance, over one connection per instance kept open
+between ticks. For every operation it keeps the last samples of its progress, smooths the rate
+and prints the ETA as one JSON line per operation. Rollbacks are included, their rate is how fast
+USED_UBLK falls, which the README otherwise has you work out by hand between one minute runs.
+
+Instances are given as NAME=DSN. An Oracle DSN is a sqlplus style user/password@connect_string
+and needs the oracledb module. sqlite:PATH opens a SQLite database laid out like the Oracle views
+these queries read, as written by create_standin(); --standin runs against a simulated one.
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import deque
+
+try:
+    import oracledb
+except ImportError:
+    oracledb = None
+
+SQL_DIR = os.path.dirname(os.path.abspath(__file__))
+INTERVAL = 60
+# samples kept per operation and the weight of the newest rate in the smoothed rate
+HISTORY = 10
+SMOOTHING = 0.3
+
+
+class Monitor:
+    """One of the .sql monitors: which columns identify an operation and which ones measure its progress.
+
+    Progress is either sofar out of totalwork, or a remaining count that falls to 0 (rollback's USED_UBLK).
+    Column names are matched in lower case, as Oracle and SQLite report them differently.
+    """
+    __slots__ = ('name', 'file', 'key', 'sofar', 'totalwork', 'remaining', 'oracle_eta_mins')
+
+    def __init__(self, name, file, key, sofar=None, totalwork=None, remaining=None, oracle_eta_mins=None):
+        self.name = name
+        self.file = file
+        self.key = key
+        self.sofar = sofar
+        self.totalwork = totalwork
+        self.remaining = remaining
+        self.oracle_eta_mins = oracle_eta_mins
+
+    def query(self, sql_dir=SQL_DIR):
+        with open(os.path.join(sql_dir, self.file)) as f:
+            return strip_sqlplus(f.read())
+
+
+MONITORS = (
+    Monitor('rollback', 'rollback_monitor.sql', ('sid', 'serial#'), remaining='used_ublk'),
+    Monitor('rman', 'rman_monitor.sql', ('operation', 'start_time'), sofar='percent complete', totalwork=100),
+    Monitor('index', 'index_monitor.sql', ('session id', 'index operation'), sofar='sofar', totalwork='totalwork',
+            oracle_eta_mins='eta mins'),
+    Monitor('datapump', 'datapump_mon.sql', ('opname', 'sid', 'serial#'), sofar='sofar', totalwork='totalwork'),
+    Monitor('longops', 'generic_longops_monitor.sql', ('session id', 'long'), sofar='sofar', totalwork='totalwork',
+            oracle_eta_mins='eta mins'),
+)
+
+SQLPLUS_COMMAND = re.compile(r'^\s*(set|col|column)\s', re.IGNORECASE)
+
+
+def strip_sqlplus(text):
+    # drop the sqlplus formatting commands, the / that runs the buffer and the closing ;
+    lines = [line for line in text.splitlines() if not SQLPLUS_COMMAND.match(line) and line.strip() != '/']
+    return '\n'.join(lines).strip().rstrip(';')
+
+
+def sqlite_dialect(sql):
+    """Rewrite the Oracle only bits of a monitor query so SQLite runs it against a stand-in database.
+
+    Identifiers ending in # are quoted and sysdate becomes a julian day number, which is what the
+    stand-in stores dates as, so Oracle's date arithmetic in days still works.
+    """
+    sql = re.sub(r'(?<!")\b(\w+#)', r'"\1"', sql)
+    return re.sub(r'\bsysdate\b', "julianday('now')", sql, flags=re.IGNORECASE)
+
+
+def sqlite_to_char(value, _format=None):
+    if value is None:
+        return None
+    return (datetime.datetime(1970, 1, 1) + datetime.timedelta(days=value - 2440587.5)).strftime('%d-%b-%Y %H:%M:%S').upper()
+
+
+def connect_sqlite(path):
+    connection = sqlite3.connect(path, check_same_thread=False)
+    # the Oracle functions the monitor queries call
+    connection.create_function('sys_context', 2, lambda namespace, parameter: -1)
+    connection.create_function('to_char', 2, sqlite_to_char)
+    return connection
+
+
+def connect(dsn):
+    """Open a DB-API connection from a sqlite:PATH or user/password@connect_string DSN."""
+    if dsn.startswith('sqlite:'):
+        return connect_sqlite(dsn[len('sqlite:'):])
+    if oracledb is None:
+        raise RuntimeError('the oracledb module is required for Oracle instances')
+    credentials, _, connect_string = dsn.rpartition('@')
+    user, _, password = credentials.partition('/')
+    return oracledb.connect(user=user, password=password, dsn=connect_string)
+
+
+class ConnectionPool:
+    """One open connection per instance, reused every tick and reopened after an error."""
+
+    def __init__(self, dsns, connect=connect):
+        self.dsns = dict(dsns)
+        self.connect = connect
+        self.connections = {}
+
+    def get(self, instance):
+        connection = self.connections.get(instance)
+        if connection is None:
+            connection = self.connections[instance] = self.connect(self.dsns[instance])
+        return connection
+
+    def discard(self, instance):
+        connection = self.connections.pop(instance, None)
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def close(self):
+        for instance in list(self.connections):
+            self.discard(instance)
+
+
+class Operation:
+    """The recent progress samples of one operation and its smoothed rate, in units of work per second."""
+    __slots__ = ('samples', 'rate')
+
+    def __init__(self):
+        self.samples = deque(maxlen=HISTORY)
+        self.rate = None
+
+    def add(self, now, done):
+        if self.samples and now > self.samples[-1][0]:
+            last_time, last_done = self.samples[-1]
+            rate = (done - last_done) / (now - last_time)
+            self.rate = rate if self.rate is None else self.rate + SMOOTHING * (rate - self.rate)
+        self.samples.append((now, done))
+
+
+class LongOpsPoller:
+    """Runs every monitor on every instance each tick and turns the rows into progress records with ETAs."""
+
+    def __init__(self, pool, monitors=MONITORS, sql_dir=SQL_DIR, clock=time.monotonic):
+        self.pool = pool
+        self.monitors = monitors
+        self.clock = clock
+        self.queries = {monitor.name: monitor.query(sql_dir) for monitor in monitors}
+        self.operations = {}
+
+    def run_query(self, instance, monitor):
+        connection = self.pool.get(instance)
+        sql = self.queries[monitor.name]
+        if isinstance(connection, sqlite3.Connection):
+            sql = sqlite_dialect(sql)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql)
+            columns = [description[0].lower() for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def tick(self):
+        """Poll everything once and return the progress records of the operations still running."""
+        records = []
+        seen = set()
+        for instance in self.pool.dsns:
+            for monitor in self.monitors:
+                try:
+                    rows = self.run_query(instance, monitor)
+                except Exception as e:
+                    records.append({'instance': instance, 'monitor': monitor.name, 'error': str(e)})
+                    self.pool.discard(instance)
+                    continue
+                now = self.clock()
+                for row in rows:
+                    key = (instance, monitor.name) + tuple(str(row.get(column)) for column in monitor.key)
+                    seen.add(key)
+                    records.append(self.record(key, monitor, row, now))
+        # operations that finished or went away take their history with them
+        for key in set(self.operations) - seen:
+            del self.operations[key]
+        return records
+
+    def record(self, key, monitor, row, now):
+        operation = self.operations.get(key)
+        if operation is None:
+            operation = self.operations[key] = Operation()
+        if monitor.remaining is not None:
+            # work done is how far the remaining count has fallen, a count that grows is not rolling back
+            remaining = float(row[monitor.remaining] or 0)
+            sofar = totalwork = None
+            operation.add(now, -remaining)
+        else:
+            sofar = float(row[monitor.sofar] or 0)
+            totalwork = float(monitor.totalwork if isinstance(monitor.totalwork, (int, float)) else row[monitor.totalwork] or 0)
+            remaining = max(0.0, totalwork - sofar)
+            operation.add(now, sofar)
+        rate = operation.rate
+        eta = remaining / rate if rate and rate > 0 else None
+        oracle_eta = row.get(monitor.oracle_eta_mins) if monitor.oracle_eta_mins else None
+        return {
+            'instance': key[0],
+            'monitor': monitor.name,
+            'key': list(key[2:]),
+            'sofar': sofar,
+            'totalwork': totalwork,
+            'remaining': remaining,
+            'rate_per_s': rate,
+            'eta_s': eta,
+            'eta': (datetime.datetime.now() + datetime.timedelta(seconds=eta)).isoformat(timespec='seconds') if eta is not None else None,
+            'oracle_eta_s': float(oracle_eta) * 60 if oracle_eta is not None else None,
+            'samples': len(operation.samples),
+        }
+
+    def stream(self, output, interval=INTERVAL, ticks=None):
+        """Write the records of every tick to output as JSON lines, forever or for the given number of ticks."""
+        done = 0
+        while ticks is None or done < ticks:
+            start = self.clock()
+            stamp = datetime.datetime.now().isoformat(timespec='seconds')
+            for record in self.tick():
+                output.write(json.dumps(dict(record, time=stamp)) + '\n')
+            output.flush()
+            done += 1
+            if ticks is None or done < ticks:
+                time.sleep(max(0, interval - (self.clock() - start)))
+
+
+STANDIN_SCHEMA = '''
+CREATE TABLE "gv$session_longops" (inst_id, sid, "serial#", opname, target, context, sofar, totalwork,
+                                   elapsed_seconds, time_remaining, sql_address);
+CREATE TABLE "gv$session" (inst_id, sid, "serial#", username, status, sql_address, saddr, paddr);
+CREATE TABLE "gv$sql" (inst_id, address, sql_text);
+CREATE TABLE "gv$transaction" (inst_id, ses_addr, xidusn, used_ublk, used_urec);
+CREATE TABLE "gv$rollstat" (inst_id, usn, rssize, status);
+CREATE TABLE "gv$process" (inst_id, addr);
+CREATE TABLE dba_rollback_segs (segment_id, segment_name);
+CREATE TABLE dba_datapump_sessions (job_name, saddr);
+CREATE TABLE "v$rman_status" (operation, start_time, mbytes_processed, status);
+CREATE TABLE "v$datafile" (bytes);
+CREATE TABLE dual (dummy);
+INSERT INTO dual VALUES ('X');
+CREATE VIEW "v$session_longops" AS SELECT * FROM "gv$session_longops";
+CREATE VIEW "v$session" AS SELECT * FROM "gv$session";
+CREATE VIEW "v$sql" AS SELECT * FROM "gv$sql";
+CREATE VIEW "v$transaction" AS SELECT * FROM "gv$transaction";
+'''
+
+
+class StandIn:
+    """A SQLite database shaped like the Oracle views the monitors read, with operations that progress on advance().
+
+    It holds a rollback, an index build, a datapump job, an RMAN backup and another long operation.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = connect_sqlite(path)
+        self.connection.executescript(STANDIN_SCHEMA)
+        self.rates = {}
+        self.seed()
+
+    def seed(self):
+        execute = self.connection.execute
+        sessions = [(101, 'ROLLBACK', 'sql1'), (102, 'INDEX', 'sql2'), (103, 'DATAPUMP', 'sql3'), (104, 'LONGOPS', 'sql4')]
+        for sid, username, address in sessions:
+            execute('INSERT INTO "gv$session" VALUES (1, ?, ?, ?, ?, ?, ?, ?)', (sid, sid * 10, username, 'ACTIVE', address, f'saddr{sid}', f'paddr{sid}'))
+            execute('INSERT INTO "gv$process" VALUES (1, ?)', (f'paddr{sid}',))
+        execute('INSERT INTO "gv$sql" VALUES (1, ?, ?)', ('sql2', 'CREATE INDEX big_idx ON big_table (id)'))
+        execute('INSERT INTO "gv$sql" VALUES (1, ?, ?)', ('sql4', 'UPDATE big_table SET flag = 1'))
+        # a transaction rolling back 1000 undo blocks a second
+        execute('INSERT INTO "gv$transaction" VALUES (1, ?, ?, ?, ?)', ('saddr101', 7, 600000, 900000))
+        execute('INSERT INTO "gv$rollstat" VALUES (1, 7, 104857600, ?)', ('ONLINE',))
+        execute('INSERT INTO dba_rollback_segs VALUES (7, ?)', ('_SYSSMU7$',))
+        self.rates['rollback'] = -1000
+        for sid, opname, totalwork, rate, address in [(102, 'Sort Output', 500000, 2500, 'sql2'), (103, 'SYS_EXPORT_FULL_01', 80000, 100, 'sql3'),
+                                                     (104, 'Table Scan', 2000000, 8000, 'sql4')]:
+            execute('INSERT INTO "gv$session_longops" VALUES (1, ?, ?, ?, ?, ?, 0, ?, 0, NULL, ?)',
+                    (sid, sid * 10, opname, 'BIG_TABLE', 'x', totalwork, address))
+            self.rates[sid] = rate
+        execute('INSERT INTO dba_datapump_sessions VALUES (?, ?)', ('SYS_EXPORT_FULL_01', 'saddr103'))
+        # a backup of a 2 TB database an hour in, at 200 MB/s
+        execute('INSERT INTO "v$rman_status" VALUES (?, julianday(\'now\') - 1 / 24.0, 720000, ?)', ('BACKUP', 'RUNNING'))
+        execute('INSERT INTO "v$datafile" VALUES (?)', (2 * 1024 ** 4,))
+        self.rates['rman'] = 200
+        self.connection.commit()
+
+    def advance(self, seconds):
+        execute = self.connection.execute
+        execute('UPDATE "gv$transaction" SET used_ublk = max(0, used_ublk + ?)', (self.rates['rollback'] * seconds,))
+        for sid, rate in self.rates.items():
+            if isinstance(sid, int):
+                execute('UPDATE "gv$session_longops" SET sofar = min(totalwork, sofar + ?), elapsed_seconds = elapsed_seconds + ?, '
+                        'time_remaining = (totalwork - min(totalwork, sofar + ?)) / ? WHERE sid = ?',
+                        (rate * seconds, seconds, rate * seconds, rate, sid))
+        execute('UPDATE "v$rman_status" SET mbytes_processed = mbytes_processed + ?', (self.rates['rman'] * seconds,))
+        self.connection.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Poll the long operation monitors of one or more Oracle instances and estimate ETAs")
+    parser.add_argument('instances', nargs='*', metavar='NAME=DSN', help="user/password@connect_string, or sqlite:PATH")
+    parser.add_argument('--interval', type=float, default=INTERVAL, help="seconds between ticks")
+    parser.add_argument('--ticks', type=int, help="stop after this many ticks")
+    parser.add_argument('--output', help="append the JSON lines to this file instead of writing them to stdout")
+    parser.add_argument('--standin', action='store_true', help="poll a simulated SQLite stand-in instead of real instances")
+    args = parser.parse_args()
+
+    dsns = dict(instance.split('=', 1) for instance in args.instances)
+    standin = None
+    if args.standin:
+        path = os.path.join(os.environ.get('TMPDIR', '/tmp'), f'longops_standin.{os.getpid()}.db')
+        standin = StandIn(path)
+        dsns['standin'] = f'sqlite:{path}'
+    if not dsns:
+        parser.error("no instances given")
+
+    pool = ConnectionPool(dsns)
+    poller = LongOpsPoller(pool)
+    if standin is not None:
+        # the simulated operations move on by one interval each tick
+        poll = poller.tick
+
+        def tick():
+            standin.advance(args.interval)
+            return poll()
+        poller.tick = tick
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        poller.stream(output, args.interval, args.ticks)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.close()
+        if args.output:
+            output.close()
+        if standin is not None:
+            standin.connection.close()
+            os.remove(standin.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import pytest
+
+from longops_poller import MONITORS, ConnectionPool, LongOpsPoller, StandIn
+
+INTERVAL = 60
+TABLE_SCAN = ['104', 'UPDATE big_table SET flag = 1']
+
+
+class Clock:
+    # a monotonic clock that only moves when the test says so
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def standin(tmp_path):
+    standin = StandIn(str(tmp_path / 'standin.db'))
+    yield standin
+    standin.connection.close()
+
+
+@pytest.fixture
+def poll(standin):
+    clock = Clock()
+    pool = ConnectionPool({'db': f'sqlite:{standin.path}'})
+    poller = LongOpsPoller(pool, monitors=[monitor for monitor in MONITORS if monitor.name in ('rollback', 'longops')],
+                           clock=clock)
+
+    def poll(seconds=INTERVAL):
+        # the operations move on by seconds, then the poller runs one tick, seconds later than the last one
+        standin.advance(seconds)
+        clock.now += seconds
+        return {(record['monitor'], *record['key']): record for record in poller.tick()}
+
+    poll.poller = poller
+    yield poll
+    pool.close()
+
+
+def table_scan(records):
+    return records.get(('longops', *TABLE_SCAN))
+
+
+def test_first_sample_has_no_rate(poll):
+    record = table_scan(poll())
+    assert (record['samples'], record['rate_per_s'], record['eta_s'], record['eta']) == (1, None, None, None)
+
+
+def test_no_progress_has_no_eta(standin, poll):
+    standin.rates[104] = 0
+    for _ in range(3):
+        record = table_scan(poll())
+    assert record['sofar'] == 0
+    assert record['rate_per_s'] == 0
+    assert (record['eta_s'], record['eta']) == (None, None)
+
+
+def test_rollback_that_grows_has_no_eta(standin, poll):
+    standin.rates['rollback'] = 500
+    for _ in range(3):
+        records = poll()
+    (record,) = [record for record in records.values() if record['monitor'] == 'rollback']
+    assert record['rate_per_s'] == pytest.approx(-500)
+    assert record['eta_s'] is None
+
+
+def test_steady_progress_gives_the_remaining_time(poll):
+    for _ in range(3):
+        record = table_scan(poll())
+    assert record['rate_per_s'] == pytest.approx(8000)
+    assert record['eta_s'] == pytest.approx(record['remaining'] / 8000)
+
+
+def test_stalled_operation_slows_its_rate_and_pushes_its_eta_out(standin, poll):
+    for _ in range(3):
+        poll()
+    standin.rates[104] = 0
+    records = [table_scan(poll()) for _ in range(4)]
+    assert len({record['remaining'] for record in records}) == 1
+    rates = [record['rate_per_s'] for record in records]
+    assert rates == sorted(rates, reverse=True) and rates[-1] > 0
+    assert rates[-1] == pytest.approx(8000 * 0.7 ** 4)
+    etas = [record['eta_s'] for record in records]
+    assert etas == sorted(etas)
+
+
+def test_operation_that_finishes_between_polls_is_forgotten(standin, poll):
+    for _ in range(3):
+        poll()
+    standin.connection.execute('DELETE FROM "gv$session_longops" WHERE sid = 104')
+    standin.connection.commit()
+    records = poll()
+    assert table_scan(records) is None
+    assert ('db', 'longops', *TABLE_SCAN) not in poll.poller.operations
+    # the rollback is still tracked with its history
+    assert [record['samples'] for record in records.values() if record['monitor'] == 'rollback'] == [4]
+
+
+def test_operation_that_comes_back_starts_a_new_history(standin, poll):
+    for _ in range(3):
+        poll()
+    row = standin.connection.execute('SELECT * FROM "gv$session_longops" WHERE sid = 104').fetchone()
+    standin.connection.execute('DELETE FROM "gv$session_longops" WHERE sid = 104')
+    poll()
+    standin.connection.execute(f'INSERT INTO "gv$session_longops" VALUES ({", ".join("?" * len(row))})', row)
+    standin.connection.commit()
+    record = table_scan(poll())
+    assert (record['samples'], record['rate_per_s'], record['eta_s']) == (1, None, None)
@@ -0,0 +1,533 @@
+#!/usr/bin/env python3
+"""
+Keeps WebSphere JVMs from starving each other, using cgroup v2.
+
+cgroup_manager_was.sh places the WAS JVMs in cgroups once, with static settings. This controller
+does the same discovery, the JVMs of the wasadmin user whose command line carries the local node
+name, and places them in was.jvm.<group> cgroups. It then samples every group's cpu.stat,
+memory.current, io.stat and pressure files each interval. When a latency sensitive group (by
+default sec_service) stalls on CPU or IO, the controller raises its cpu.weight and tightens
+cpu.max and io.max of the other groups a step at a time. After a few calm intervals it relaxes
+them again, always within the bounds configured for each group.
+
+Every sample is logged with the group's memory use, and every adjustment with the reason for it
+and the memory use of the group adjusted, and so is the time each decision loop takes.
+A decision loop that fails is logged and the next one runs as usual, and on exit, SIGTERM
+included, every group gets back the cpu.weight, cpu.max and io.max it had before.
+--cgroup-root and --proc-root point the controller at fake trees, see write_fake_cgroup().
+"""
+import argparse
+import json
+import logging
+import os
+import pwd
+import re
+import signal
+import socket
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('cgroup_controller_was')
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+PROC_ROOT = '/proc'
+CGROUP_PREFIX = 'was.jvm'
+WAS_USER = 'wasadmin'
+INTERVAL = 10
+CPU_PERIOD = 100000
+CONTROLLERS = ('cpu', 'io', 'memory')
+# fraction a limit or weight moves per decision, and calm intervals before limits are relaxed again
+STEP = 0.25
+RELAX_AFTER = 3
+# pressure (PSI "some" avg10, percent) of a latency sensitive group that counts as starving
+CPU_PRESSURE_LIMIT = 20.0
+IO_PRESSURE_LIMIT = 20.0
+
+# the groups JVMs are placed in, first matching pattern wins, and the bounds the controller keeps each group within:
+#   weight          cpu.weight [min, max], and the default the controller relaxes back to
+#   cpu_max_cores   cpu.max [min, max] in cores, max None means unlimited
+#   io_max_bps      io.max rbps/wbps [min, max] per device, max None means unlimited
+DEFAULT_CONFIG = {
+    'groups': [
+        {'name': 'sec_service', 'match': 'sec_service', 'latency_sensitive': True,
+         'weight': [100, 1000], 'default_weight': 200, 'cpu_max_cores': [None, None], 'io_max_bps': [None, None]},
+        {'name': 'default', 'match': '', 'latency_sensitive': False,
+         'weight': [50, 100], 'default_weight': 100, 'cpu_max_cores': [1, None], 'io_max_bps': [10 * 1024 * 1024, None]},
+    ],
+}
+
+
+def load_config(path=None):
+    if path is None:
+        return DEFAULT_CONFIG
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def write_file(path, value):
+    with open(path, 'w') as f:
+        f.write(value)
+
+
+def read_keyed(path):
+    # "key value" lines such as cpu.stat
+    values = {}
+    for line in read_file(path).splitlines():
+        key, _, value = line.partition(' ')
+        if value.isdigit():
+            values[key] = int(value)
+    return values
+
+
+def read_io_stat(path):
+    # "MAJ:MIN rbytes=.. wbytes=.. rios=.. wios=.." per device, returned as {device: rbytes + wbytes}
+    devices = {}
+    for line in read_file(path).splitlines():
+        device, *fields = line.split()
+        counters = dict(field.split('=', 1) for field in fields)
+        devices[device] = int(counters.get('rbytes', 0)) + int(counters.get('wbytes', 0))
+    return devices
+
+
+def read_io_max(path):
+    # "MAJ:MIN rbps=.. wbps=.. riops=.. wiops=.." per device, returned as {device: the limits after it}
+    limits = {}
+    for line in read_file(path).splitlines():
+        device, _, values = line.partition(' ')
+        if values:
+            limits[device] = values
+    return limits
+
+
+def read_memory(path):
+    """memory.current in bytes, or None when the kernel does not provide it."""
+    try:
+        return int(read_file(path))
+    except (OSError, ValueError):
+        return None
+
+
+def format_memory(memory):
+    return 'unknown' if memory is None else f'{memory / 2 ** 20:.0f} MiB'
+
+
+def read_pressure(path):
+    """The "some" avg10 of a cgroup pressure file in percent, or None when the kernel has no PSI."""
+    try:
+        for line in read_file(path).splitlines():
+            if line.startswith('some'):
+                return float(line.split()[1].partition('=')[2])
+    except OSError:
+        return None
+    return None
+
+
+def discover_jvms(node=None, user=WAS_USER, proc_root=PROC_ROOT):
+    """Return {pid: jvm name} of the WAS JVMs, as `pgrep -u wasadmin -af <node>` does in cgroup_manager_was.sh.
+
+    The JVM name is the last argument of the command line with _<node> and anything after it removed.
+    """
+    node = node or socket.gethostname().split('.')[0]
+    try:
+        uid = pwd.getpwnam(user).pw_uid
+    except KeyError:
+        return {}
+    strip = re.compile(f'_{re.escape(node)}.*')
+    jvms = {}
+    with os.scandir(proc_root) as entries:
+        for entry in entries:
+            if not entry.name.isdigit():
+                continue
+            try:
+                if entry.stat().st_uid != uid:
+                    continue
+                with open(f'{entry.path}/cmdline', 'rb') as f:
+                    argv = f.read().rstrip(b'\0').decode(errors='replace').split('\0')
+            except OSError:
+                continue
+            if not argv or node not in ' '.join(argv):
+                continue
+            jvms[int(entry.name)] = strip.sub('', argv[-1])
+    return jvms
+
+
+class GroupState:
+    """One was.jvm.<name> cgroup: its configuration, the settings it had before, those last written and the previous sample."""
+    __slots__ = ('config', 'name', 'path', 'pattern', 'weight', 'cpu_max_cores', 'io_max_bps', 'original', 'sample', 'rates')
+
+    def __init__(self, config, cgroup_root):
+        self.config = config
+        self.name = config['name']
+        self.path = os.path.join(cgroup_root, f"{CGROUP_PREFIX}.{self.name}")
+        self.pattern = re.compile(config.get('match', ''))
+        self.weight = config['default_weight']
+        self.cpu_max_cores = config['cpu_max_cores'][1]
+        self.io_max_bps = {}
+        # cpu.weight, cpu.max and io.max as setup() found them, restored on exit
+        self.original = None
+        self.sample = None
+        self.rates = None
+
+    @property
+    def latency_sensitive(self):
+        return self.config.get('latency_sensitive', False)
+
+
+class Decision:
+    __slots__ = ('group', 'knob', 'old', 'new', 'reason')
+
+    def __init__(self, group, knob, old, new, reason):
+        self.group = group
+        self.knob = knob
+        self.old = old
+        self.new = new
+        self.reason = reason
+
+    def __repr__(self):
+        return f"Decision({self.group!r}, {self.knob!r}, {self.old!r} -> {self.new!r}, {self.reason!r})"
+
+
+class CgroupController:
+    """Places WAS JVMs in their cgroups and adjusts the cgroup limits from what the groups use and how they stall."""
+
+    def __init__(self, config=DEFAULT_CONFIG, cgroup_root=CGROUP_ROOT, proc_root=PROC_ROOT, node=None, user=WAS_USER,
+                 dry_run=False, clock=time.monotonic, cpus=None):
+        self.cgroup_root = cgroup_root
+        self.proc_root = proc_root
+        self.node = node
+        self.user = user
+        self.dry_run = dry_run
+        self.clock = clock
+        self.cpus = cpus or os.cpu_count() or 1
+        self.groups = [GroupState(group, cgroup_root) for group in config['groups']]
+        self.calm = 0
+
+    def group_for(self, jvm):
+        return next((group for group in self.groups if group.pattern.search(jvm)), None)
+
+    def write(self, group, name, value):
+        if not self.dry_run:
+            write_file(os.path.join(group.path, name), value)
+
+    def setup(self):
+        # create the groups and let them use the controllers we adjust
+        subtree_control = os.path.join(self.cgroup_root, 'cgroup.subtree_control')
+        if not self.dry_run:
+            write_file(subtree_control, ' '.join(f'+{controller}' for controller in CONTROLLERS))
+        for group in self.groups:
+            if not self.dry_run:
+                os.makedirs(group.path, exist_ok=True)
+            group.original = self.read_limits(group)
+            self.write(group, 'cpu.weight', str(group.weight))
+            self.write(group, 'cpu.max', self.cpu_max_value(group.cpu_max_cores))
+
+    def place(self):
+        """Move every WAS JVM that is not yet in its group into it, returning {pid: group name} of the moves."""
+        moved = {}
+        members = {}
+        for group in self.groups:
+            try:
+                members[group.name] = {int(pid) for pid in read_file(os.path.join(group.path, 'cgroup.procs')).split()}
+            except OSError:
+                members[group.name] = set()
+        for pid, jvm in discover_jvms(self.node, self.user, self.proc_root).items():
+            group = self.group_for(jvm)
+            if group is None or pid in members[group.name]:
+                continue
+            try:
+                if not self.dry_run:
+                    # appending is how cgroup.procs takes a pid, and keeps a fake cgroupfs listing every member
+                    with open(os.path.join(group.path, 'cgroup.procs'), 'a') as f:
+                        f.write(f'{pid}\n')
+            except ProcessLookupError:
+                continue
+            except OSError as e:
+                logger.error("Failed to place %s (pid %d) in %s: %s", jvm, pid, group.path, e)
+                continue
+            moved[pid] = group.name
+            logger.info("Placed %s (pid %d) in %s", jvm, pid, group.path)
+        return moved
+
+    def read_limits(self, group):
+        limits = {}
+        for name, read in (('cpu.weight', read_file), ('cpu.max', read_file), ('io.max', read_io_max)):
+            try:
+                limits[name] = read(os.path.join(group.path, name))
+            except OSError:
+                limits[name] = None
+        return limits
+
+    def restore(self):
+        """Write back the cpu.weight, cpu.max and io.max every group had before setup(), as far as the groups still exist."""
+        for group in self.groups:
+            if group.original is None:
+                continue
+            writes = [(name, (group.original[name] or '').strip()) for name in ('cpu.weight', 'cpu.max')]
+            writes = [(name, value) for name, value in writes if value]
+            if group.original['io.max'] is not None:
+                # only the devices the controller limited, back to their own limits or unlimited
+                writes += [('io.max', f"{device} {group.original['io.max'].get(device, 'rbps=max wbps=max')}")
+                           for device in group.io_max_bps]
+            try:
+                for name, value in writes:
+                    self.write(group, name, value)
+            except OSError as e:
+                logger.error("Failed to restore the limits of %s: %s", group.path, e)
+                continue
+            logger.info("Restored the limits of %s", group.path)
+
+    def deactivate(self):
+        # move every pid of our groups back to the root cgroup
+        for group in self.groups:
+            try:
+                pids = read_file(os.path.join(group.path, 'cgroup.procs')).split()
+            except OSError:
+                continue
+            for pid in pids:
+                if not self.dry_run:
+                    with open(os.path.join(self.cgroup_root, 'cgroup.procs'), 'a') as f:
+                        f.write(f'{pid}\n')
+            logger.info("Moved %d processes out of %s", len(pids), group.path)
+
+    def sample(self):
+        """Read every group's counters and return {name: rates} since the previous sample."""
+        now = self.clock()
+        rates = {}
+        for group in self.groups:
+            try:
+                cpu = read_keyed(os.path.join(group.path, 'cpu.stat'))
+                io = read_io_stat(os.path.join(group.path, 'io.stat'))
+            except (OSError, ValueError):
+                group.sample = None
+                group.rates = None
+                continue
+            sample = (now, cpu.get('usage_usec', 0), cpu.get('throttled_usec', 0), io)
+            previous = group.sample
+            group.sample = sample
+            group.rates = None
+            if previous is None or now <= previous[0]:
+                continue
+            elapsed = now - previous[0]
+            group.rates = {
+                'cpu_cores': (sample[1] - previous[1]) / elapsed / 1e6,
+                'throttled': (sample[2] - previous[2]) / elapsed / 1e6,
+                'io_bps': {device: (total - previous[3].get(device, 0)) / elapsed for device, total in io.items()},
+                'cpu_pressure': read_pressure(os.path.join(group.path, 'cpu.pressure')),
+                'io_pressure': read_pressure(os.path.join(group.path, 'io.pressure')),
+                # older kernels have no memory.current, the group is sampled without it
+                'memory': read_memory(os.path.join(group.path, 'memory.current')),
+            }
+            rates[group.name] = group.rates
+        return rates
+
+    def starving(self, group):
+        """Why the latency sensitive group is being starved, as (cpu reason, io reason), None where it is not."""
+        rates = group.rates
+        cpu = io = None
+        if rates['cpu_pressure'] is not None:
+            if rates['cpu_pressure'] > CPU_PRESSURE_LIMIT:
+                cpu = f"cpu pressure {rates['cpu_pressure']:.1f}%"
+        else:
+            # without PSI, treat a host whose WAS groups use nearly every core as contended
+            used = sum(other.rates['cpu_cores'] for other in self.groups if other.rates)
+            if used > 0.9 * self.cpus:
+                cpu = f"WAS groups use {used:.1f} of {self.cpus} cpus"
+        if rates['throttled'] > 0:
+            cpu = f"throttled {rates['throttled']:.2f}s/s"
+        if rates['io_pressure'] is not None and rates['io_pressure'] > IO_PRESSURE_LIMIT:
+            io = f"io pressure {rates['io_pressure']:.1f}%"
+        return cpu, io
+
+    def decide(self):
+        """Return the adjustments for this interval from the last sample."""
+        decisions = []
+        cpu_reasons = []
+        io_reasons = []
+        for group in self.groups:
+            if group.latency_sensitive and group.rates:
+                cpu, io = self.starving(group)
+                if cpu:
+                    cpu_reasons.append(f"{group.name}: {cpu}")
+                if io:
+                    io_reasons.append(f"{group.name}: {io}")
+        self.calm = 0 if cpu_reasons or io_reasons else self.calm + 1
+        relax = self.calm >= RELAX_AFTER
+        for group in self.groups:
+            # a group without rates is new or could not be read, its cgroup may be gone
+            if group.rates is None:
+                continue
+            if group.latency_sensitive:
+                low, high = group.config['weight']
+                if cpu_reasons:
+                    decisions.append(self.set_weight(group, min(high, round(group.weight * (1 + STEP * 4))), '; '.join(cpu_reasons)))
+                elif relax and group.weight != group.config['default_weight']:
+                    target = max(group.config['default_weight'], round(group.weight * (1 - STEP)))
+                    decisions.append(self.set_weight(group, max(low, target), 'no contention'))
+                continue
+            if cpu_reasons:
+                decisions.append(self.set_cpu_max(group, self.tighter(group.cpu_max_cores, group.rates['cpu_cores'],
+                                                                      group.config['cpu_max_cores'], self.cpus), '; '.join(cpu_reasons)))
+                low = group.config['weight'][0]
+                decisions.append(self.set_weight(group, max(low, round(group.weight * (1 - STEP))), '; '.join(cpu_reasons)))
+            elif relax:
+                decisions.append(self.set_cpu_max(group, self.looser(group.cpu_max_cores, group.config['cpu_max_cores'], self.cpus), 'no contention'))
+                if group.weight != group.config['default_weight']:
+                    decisions.append(self.set_weight(group, min(group.config['default_weight'], round(group.weight * (1 + STEP)) + 1), 'no contention'))
+            for device, bps in group.rates['io_bps'].items():
+                current = group.io_max_bps.get(device)
+                if io_reasons:
+                    target = self.tighter(current, bps, group.config['io_max_bps'], None)
+                    decisions.append(self.set_io_max(group, device, target, '; '.join(io_reasons)))
+                elif relax:
+                    decisions.append(self.set_io_max(group, device, self.looser(current, group.config['io_max_bps'], None), 'no contention'))
+        return [decision for decision in decisions if decision is not None]
+
+    @staticmethod
+    def tighter(current, used, bounds, ceiling):
+        # a step below what the group uses now, or below its current limit if that is lower, never under the minimum
+        low, high = bounds
+        candidates = [value for value in (current, used or None, high, ceiling) if value is not None]
+        if not candidates:
+            return current
+        target = min(candidates) * (1 - STEP)
+        return target if low is None else max(low, target)
+
+    @staticmethod
+    def looser(current, bounds, ceiling):
+        # a step up towards the maximum, and back to the configured maximum (None is unlimited) once it is reached
+        high = bounds[1]
+        if current is None:
+            return None
+        limit = high if high is not None else ceiling
+        target = current * (1 + STEP)
+        return high if limit is None or target >= limit else target
+
+    @staticmethod
+    def cpu_max_value(cores):
+        return 'max %d' % CPU_PERIOD if cores is None else '%d %d' % (max(1000, cores * CPU_PERIOD), CPU_PERIOD)
+
+    def set_weight(self, group, weight, reason):
+        if weight == group.weight:
+            return None
+        decision = Decision(group.name, 'cpu.weight', group.weight, weight, reason)
+        self.write(group, 'cpu.weight', str(weight))
+        group.weight = weight
+        return decision
+
+    def set_cpu_max(self, group, cores, reason):
+        if cores == group.cpu_max_cores or (cores is not None and group.cpu_max_cores is not None and abs(cores - group.cpu_max_cores) < 0.01):
+            return None
+        decision = Decision(group.name, 'cpu.max', self.cpu_max_value(group.cpu_max_cores), self.cpu_max_value(cores), reason)
+        self.write(group, 'cpu.max', self.cpu_max_value(cores))
+        group.cpu_max_cores = cores
+        return decision
+
+    def set_io_max(self, group, device, bps, reason):
+        current = group.io_max_bps.get(device)
+        if bps == current or (bps is not None and current is not None and abs(bps - current) < 1024):
+            return None
+        value = 'max' if bps is None else str(int(bps))
+        decision = Decision(group.name, 'io.max', f"{device} {'max' if current is None else int(current)}", f"{device} {value}", reason)
+        self.write(group, 'io.max', f"{device} rbps={value} wbps={value}")
+        if bps is None:
+            group.io_max_bps.pop(device, None)
+        else:
+            group.io_max_bps[device] = bps
+        return decision
+
+    def tick(self):
+        """One decision loop: place new JVMs, sample, adjust. Returns the decisions taken and the seconds it took.
+
+        An error is logged and ends only this loop, with no decisions.
+        """
+        start = time.perf_counter()
+        rates = {}
+        try:
+            self.place()
+            rates = self.sample()
+            decisions = self.decide()
+        except Exception:
+            logger.exception("Decision loop failed")
+            decisions = []
+        elapsed = time.perf_counter() - start
+        for name, group_rates in rates.items():
+            logger.info("%s: %.2f cpus, throttled %.2fs/s, cpu pressure %s, io pressure %s, memory %s", name,
+                        group_rates['cpu_cores'], group_rates['throttled'], group_rates['cpu_pressure'],
+                        group_rates['io_pressure'], format_memory(group_rates['memory']))
+        for decision in decisions:
+            memory = rates.get(decision.group, {}).get('memory')
+            logger.info("%s %s: %s -> %s (%s, memory %s)", decision.group, decision.knob, decision.old, decision.new,
+                        decision.reason, format_memory(memory))
+        logger.info("Decision loop took %.3f ms, %d adjustments", elapsed * 1000, len(decisions))
+        return decisions, elapsed
+
+    def run(self, interval=INTERVAL):
+        # SIGTERM exits through the finally like Ctrl-C does, so the groups get their limits back
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        try:
+            self.setup()
+            while True:
+                decisions, elapsed = self.tick()
+                time.sleep(max(0, interval - elapsed))
+        finally:
+            self.restore()
+
+
+def write_fake_cgroup(cgroup_root, name, usage_usec=0, throttled_usec=0, memory=0, io=None, cpu_pressure=None, io_pressure=None):
+    """Write or update a cgroup directory with the files the controller reads, for testing against a fake cgroupfs.
+
+    memory None leaves memory.current out, as on kernels without it.
+    """
+    path = os.path.join(cgroup_root, name)
+    os.makedirs(path, exist_ok=True)
+    for created in ('cgroup.procs', 'cpu.weight', 'cpu.max', 'io.max'):
+        if not os.path.exists(os.path.join(path, created)):
+            write_file(os.path.join(path, created), '')
+    write_file(os.path.join(path, 'cpu.stat'), f'usage_usec {usage_usec}\nuser_usec {usage_usec}\nsystem_usec 0\n'
+                                                f'nr_periods 0\nnr_throttled 0\nthrottled_usec {throttled_usec}\n')
+    if memory is not None:
+        write_file(os.path.join(path, 'memory.current'), f'{memory}\n')
+    elif os.path.exists(os.path.join(path, 'memory.current')):
+        os.remove(os.path.join(path, 'memory.current'))
+    write_file(os.path.join(path, 'io.stat'), ''.join(f'{device} rbytes={total} wbytes=0 rios=0 wios=0\n' for device, total in (io or {}).items()))
+    for pressure, value in (('cpu.pressure', cpu_pressure), ('io.pressure', io_pressure)):
+        if value is not None:
+            write_file(os.path.join(path, pressure), f'some avg10={value:.2f} avg60=0.00 avg300=0.00 total=0\n'
+                                                     f'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n')
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Place WAS JVMs in cgroup v2 groups and adjust their CPU and IO limits")
+    parser.add_argument('--config', help="JSON file with the groups and their bounds, see DEFAULT_CONFIG")
+    parser.add_argument('--interval', type=float, default=INTERVAL, help="seconds between decision loops")
+    parser.add_argument('--once', action='store_true', help="place the JVMs and set up the groups, then exit")
+    parser.add_argument('--deactivate', action='store_true', help="move all WAS JVMs back to the root cgroup and exit")
+    parser.add_argument('--dry-run', action='store_true', help="log the decisions without writing to the cgroup files")
+    parser.add_argument('--cgroup-root', default=CGROUP_ROOT, help="cgroup v2 mount point")
+    parser.add_argument('--proc-root', default=PROC_ROOT, help=argparse.SUPPRESS)
+    parser.add_argument('--user', default=WAS_USER, help="user the JVMs run as")
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.cgroup_root, 'cgroup.controllers')):
+        logger.error("%s is not a cgroup v2 hierarchy", args.cgroup_root)
+        exit(1)
+    controller = CgroupController(load_config(args.config), args.cgroup_root, args.proc_root, user=args.user, dry_run=args.dry_run)
+    if args.deactivate:
+        controller.deactivate()
+        return
+    if args.once:
+        controller.setup()
+        controller.place()
+        return
+    controller.run(args.interval)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import logging
+import os
+import shutil
+import signal
+import threading
+
+import pytest
+
+from cgroup_controller_was import CgroupController, read_file, write_fake_cgroup
+
+SEC = 'was.jvm.sec_service'
+DEFAULT = 'was.jvm.default'
+
+
+class Clock:
+    # a monotonic clock that moves 10 seconds every time it is read
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        self.now += 10
+        return self.now
+
+
+@pytest.fixture
+def cgroup_root(tmp_path):
+    root = tmp_path / 'cgroup'
+    (tmp_path / 'proc').mkdir()
+    for name in (SEC, DEFAULT):
+        path = write_fake_cgroup(str(root), name)
+        # the limits the kernel gives a new cgroup
+        for knob, value in (('cpu.weight', '100\n'), ('cpu.max', 'max 100000\n')):
+            with open(os.path.join(path, knob), 'w') as f:
+                f.write(value)
+    return root
+
+
+@pytest.fixture
+def controller(cgroup_root):
+    controller = CgroupController(cgroup_root=str(cgroup_root), proc_root=str(cgroup_root.parent / 'proc'), cpus=4,
+                                  clock=Clock())
+    controller.setup()
+    return controller
+
+
+def knob(cgroup_root, name, knob):
+    return read_file(os.path.join(cgroup_root, name, knob)).strip()
+
+
+def contend(cgroup_root, usage_usec, pressure):
+    # sec_service stalls on cpu and io while the default group runs two cores and reads 40 MB/s
+    write_fake_cgroup(str(cgroup_root), SEC, cpu_pressure=pressure, io_pressure=pressure)
+    write_fake_cgroup(str(cgroup_root), DEFAULT, usage_usec=usage_usec, io={'8:0': usage_usec * 20}, cpu_pressure=0, io_pressure=0)
+
+
+def test_tick_throttles_the_other_groups_when_sec_service_stalls(controller, cgroup_root):
+    contend(cgroup_root, 0, 0)
+    assert controller.tick()[0] == []
+    contend(cgroup_root, 20000000, 50)
+    decisions, _ = controller.tick()
+    assert {(decision.group, decision.knob) for decision in decisions} == {
+        ('sec_service', 'cpu.weight'), ('default', 'cpu.max'), ('default', 'cpu.weight'), ('default', 'io.max')}
+    assert knob(cgroup_root, SEC, 'cpu.weight') == '400'
+    assert knob(cgroup_root, DEFAULT, 'cpu.weight') == '75'
+    assert knob(cgroup_root, DEFAULT, 'cpu.max') == '150000 100000'
+    assert knob(cgroup_root, DEFAULT, 'io.max') == '8:0 rbps=30000000 wbps=30000000'
+
+
+def test_tick_relaxes_the_limits_after_calm_intervals(controller, cgroup_root):
+    usage = 0
+    for pressure in (0, 50):
+        usage += 20000000
+        contend(cgroup_root, usage, pressure)
+        controller.tick()
+    for _ in range(2):
+        usage += 20000000
+        contend(cgroup_root, usage, 0)
+        assert controller.tick()[0] == []
+    for _ in range(10):
+        usage += 20000000
+        contend(cgroup_root, usage, 0)
+        controller.tick()
+    assert knob(cgroup_root, SEC, 'cpu.weight') == '200'
+    assert knob(cgroup_root, DEFAULT, 'cpu.weight') == '100'
+    assert knob(cgroup_root, DEFAULT, 'cpu.max') == 'max 100000'
+    assert knob(cgroup_root, DEFAULT, 'io.max') == '8:0 rbps=max wbps=max'
+
+
+def test_restore_writes_back_the_limits_found_at_setup(controller, cgroup_root):
+    contend(cgroup_root, 0, 0)
+    controller.tick()
+    contend(cgroup_root, 20000000, 50)
+    controller.tick()
+    controller.restore()
+    assert [knob(cgroup_root, name, 'cpu.weight') for name in (SEC, DEFAULT)] == ['100', '100']
+    assert knob(cgroup_root, DEFAULT, 'cpu.max') == 'max 100000'
+    assert knob(cgroup_root, DEFAULT, 'io.max') == '8:0 rbps=max wbps=max'
+
+
+def test_tick_skips_a_cgroup_that_disappeared(controller, cgroup_root):
+    contend(cgroup_root, 0, 0)
+    controller.tick()
+    shutil.rmtree(cgroup_root / DEFAULT)
+    write_fake_cgroup(str(cgroup_root), SEC, cpu_pressure=50)
+    decisions, _ = controller.tick()
+    assert [(decision.group, decision.knob) for decision in decisions] == [('sec_service', 'cpu.weight')]
+    assert not (cgroup_root / DEFAULT).exists()
+
+
+def test_tick_logs_a_failed_loop_and_the_next_one_runs(controller, cgroup_root, caplog):
+    contend(cgroup_root, 0, 0)
+    controller.tick()
+    # cpu.max can no longer be written
+    os.remove(cgroup_root / DEFAULT / 'cpu.max')
+    os.mkdir(cgroup_root / DEFAULT / 'cpu.max')
+    contend(cgroup_root, 20000000, 50)
+    assert controller.tick()[0] == []
+    assert 'Decision loop failed' in caplog.messages
+    shutil.rmtree(cgroup_root / DEFAULT)
+    write_fake_cgroup(str(cgroup_root), SEC, cpu_pressure=50)
+    assert controller.tick()[0] != []
+
+
+def test_run_restores_the_limits_on_sigterm(cgroup_root):
+    contend(cgroup_root, 0, 50)
+    controller = CgroupController(cgroup_root=str(cgroup_root), proc_root=str(cgroup_root.parent / 'proc'), cpus=4,
+                                  clock=Clock())
+    handler = signal.getsignal(signal.SIGTERM)
+    timer = threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM))
+    timer.start()
+    try:
+        with pytest.raises(SystemExit):
+            controller.run(interval=0.01)
+    finally:
+        timer.cancel()
+        signal.signal(signal.SIGTERM, handler)
+    # sec_service was raised to its maximum weight while it stalled
+    assert controller.groups[0].weight == 1000
+    assert knob(cgroup_root, SEC, 'cpu.weight') == '100'
+    assert knob(cgroup_root, DEFAULT, 'cpu.weight') == '100'
+    assert knob(cgroup_root, DEFAULT, 'cpu.max') == 'max 100000'
+
+
+def test_memory_is_sampled_and_logged_with_the_decisions(controller, cgroup_root, caplog):
+    caplog.set_level(logging.INFO)
+    contend(cgroup_root, 0, 0)
+    controller.tick()
+    write_fake_cgroup(str(cgroup_root), SEC, memory=512 * 2 ** 20, cpu_pressure=50, io_pressure=0)
+    # an older kernel without memory.current
+    write_fake_cgroup(str(cgroup_root), DEFAULT, usage_usec=20000000, memory=None, cpu_pressure=0, io_pressure=0)
+    controller.tick()
+    assert [group.rates['memory'] for group in controller.groups] == [512 * 2 ** 20, None]
+    assert ('sec_service: 0.00 cpus, throttled 0.00s/s, cpu pressure 50.0, io pressure 0.0, memory 512 MiB'
+            in caplog.messages)
+    assert ('default: 2.00 cpus, throttled 0.00s/s, cpu pressure 0.0, io pressure 0.0, memory unknown'
+            in caplog.messages)
+    assert 'sec_service cpu.weight: 200 -> 400 (sec_service: cpu pressure 50.0%, memory 512 MiB)' in caplog.messages
+    assert ('default cpu.max: max 100000 -> 150000 100000 (sec_service: cpu pressure 50.0%, memory unknown)'
+            in caplog.messages)